@@ -1,49 +1,120 @@
 import math
-from time import time as current_time
+from json import dumps as to_json
+from functools import partial
+from time import time as current_time, perf_counter_ns, monotonic
 
-from logger import Logger
-from camera import Camera
-from crash_reporter import AccidentReporter, Accident
+# Boot time is measured from here, heavy imports are deferred to the startup steps
+BOOT_STARTED_AT = perf_counter_ns()
+
+import utils
+from logger import Logger, writer as log_writer
+from tracing import tracer
+from blackbox import recorder
+from captures import captures
+from geoindex import geoindex
+from keyframes import KeyframeExtractor
+from redaction import Redactor
+from metrics import registry, MetricsExporter
+from startup import StartupGraph
+from scheduler import Scheduler
+from supervisor import Supervisor
+from gsm import GSMModem, build_alert_text
+from crash_reporter import AccidentReporter, Accident, AccidentKeys, create_backend
 from car import Car, CarInfo, CrashDetectorCallback, InterruptionService
+from power import PowerManager, PowerState
+from memory import MemoryManager, MemoryBudget, MemoryPlan, frame_size
 
-from threading import Event
+from threading import Event, Lock
+from concurrent.futures import ThreadPoolExecutor
 
-from constants import IS_TESTING, FirebaseConstants
+from constants import IS_TESTING, FirebaseConstants, MetricsConstants, SupervisorConstants, PowerConstants, RedactionConstants, OutboxConstants, MemoryConstants
 
 if IS_TESTING:
-    # Use emulated GPS
-    from pc_toolkit import GPS
+    # Use emulated GPS & GSM modem
+    from pc_toolkit import GPS, GSMModemSimulator
 else:
     # Use actual GPS module
     from gps import GPS
 
 
-class AASSL(CrashDetectorCallback, InterruptionService.Callback):
+class AASSL(CrashDetectorCallback, InterruptionService.Callback, PowerManager.Callback, MemoryManager.Callback):
 
-    def __init__(self) -> None:
+    def __init__(self, backend=None) -> None:
         self.logger = Logger('AASSL')
         self.setup_signal = Event()
         self.running_signal = Event()
         self.logger.info("Creating AASSL instance...")
 
+        # Core scheduler all services run on
+        self.scheduler = Scheduler()
+
+        # Supervisor (the emulated system has no hardware watchdog)
+        self.supervisor = Supervisor(
+            self.scheduler,
+            watchdog_path=None if IS_TESTING else SupervisorConstants.WATCHDOG_PATH,
+            interval=SupervisorConstants.CHECK_INTERVAL,
+            base_delay=SupervisorConstants.RESTART_BASE_DELAY,
+            max_delay=SupervisorConstants.RESTART_MAX_DELAY
+        )
+
+        # Memory budget of the buffers (sized for the driving profile, the biggest one)
+        framerate = PowerConstants.CAMERA_PROFILES[PowerState.DRIVING][1]
+        self.memory = MemoryManager(self.scheduler, self, MemoryBudget.of_available(framerate=framerate))
+
         # Car
-        self.car = Car(CarInfo.get_default(), self)
+        self.car = Car(CarInfo.get_default(), self, self.scheduler)
 
         # AccidentReporter
-        self.crash_reporter = AccidentReporter()
+        if backend is None and IS_TESTING:
+            backend = create_backend('local')
+        self.crash_reporter = AccidentReporter(backend)
 
-        # Camera
-        self.camera = Camera(duration=5)
-        if self.camera is None:
-            self.logger.error("No camera was detected.")
+        # Keyframes of accident videos (previews)
+        self.keyframes = KeyframeExtractor()
+
+        # Faces & plates redaction of accident videos (optional)
+        self.redactor = Redactor() if RedactionConstants.ENABLED else None
+
+        # Camera (created by its startup step)
+        self.camera = None
+        # Held while an accident video is captured, so the capture profile can't change under it
+        self.capture_lock = Lock()
+        # Redacts & saves accident videos off the alert path, one at a time
+        self.video_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="AccidentVideo")
+        self.video_jobs = []  # Not done yet, each holds its buffers
 
         # GPS
-        self.gps = GPS()
-        if self.gps is None:
-            self.logger.error("No GPS module was detected.")
+        self.gps = GPS(self.scheduler)
+
+        # Power manager (driving / idle / parked)
+        self.power = PowerManager(self.scheduler, self.gps, self)
+
+        # GSM modem (SMS fallback channel)
+        if IS_TESTING:
+            self.gsm_simulator = GSMModemSimulator()
+            self.gsm = GSMModem(port=self.gsm_simulator.port, loop=self.scheduler.loop)
+        else:
+            self.gsm = GSMModem(loop=self.scheduler.loop)
+
+        # Metrics
+        self.metrics_exporter = MetricsExporter(
+            registry,
+            utils.metrics_file_path(),
+            host=MetricsConstants.EXPORT_HOST,
+            port=MetricsConstants.EXPORT_PORT,
+            snapshot_interval=MetricsConstants.SNAPSHOT_INTERVAL
+        )
+        self.accidents_count = registry.counter('accidents_total', 'Accidents detected.')
+        self.video_coverage = registry.gauge('accident_video_coverage_percent', 'Percent of the expected frames in the last accident video.')
+        self.encode_latency = registry.histogram('accident_encode_seconds', 'Duration of saving accident videos.')
+        self.boot_to_armed = registry.gauge('boot_to_armed_seconds', 'Secs from start until crash detection was armed.')
+        self.boot_to_ready = registry.gauge('boot_to_ready_seconds', 'Secs from start until every component was ready.')
+
+        # Startup
+        self.startup = self.create_startup_graph()
 
         # InterruptionService
-        self.interruption_service = InterruptionService(self)
+        self.interruption_service = InterruptionService(self, self.scheduler)
 
         self.logger.success("Created AASSL instance. Waiting for setup...")
 
@@ -53,46 +124,149 @@ class AASSL(CrashDetectorCallback, InterruptionService.Callback):
     def system_running(self):
         return self.running_signal.is_set()
 
-    def setup_system(self):
+    def boot(self):
+        """ Sets up & starts the system then runs it until it's stopped.
+
+        The crash detector and the pre-roll capture are armed first, the rest of the
+        components start concurrently as soon as the ones they depend on are ready.
+        """
         if self.system_ready():
             self.logger.warning("System setup already done.")
             return
-        
-        try:
-            self.car.setup()
-            self.gps.setup()
-            self.camera.setup()
-            self.crash_reporter.setup()
-            
+        # Only the running system logs to file
+        log_writer.open_file()
+        self.logger.info("Booting system...")
+        self.running_signal.set()
+        # Blocks until the system is stopped
+        self.scheduler.run(self.__boot)
+
+    async def __boot(self):
+        self.interruption_service.start()
+        # Steps block on hardware & network, they run off the loop
+        done = await self.scheduler.to_thread(self.startup.run, self.on_system_armed)
+        self.boot_to_ready.set((perf_counter_ns() - BOOT_STARTED_AT) / 1e9)
+        self.logger.info(f"Startup steps: {self.startup.summary()}")
+        if done:
             self.setup_signal.set()
-        except KeyboardInterrupt:
-            self.logger.error("SETUP WAS INTERRUPTED")
-        except Exception as e:
-            if isinstance(e, FileNotFoundError):
-                self.running_signal.clear()
-                self.logger.error(f"Couldn't find firebase config at path: '{FirebaseConstants.CREDENTIALS_FILE_PATH}'")
-            self.logger.error("One or more system components failed to setup. {}".format(e))
-
-    def start_system(self):
-        if not self.system_ready():
-            self.logger.warning("System isn't ready yet. Please setup the system first.")
+            self.logger.success(f"System is fully ready in {self.boot_to_ready.get() * 1000:.0f} ms since start.")
+        else:
+            self.logger.error("One or more system components failed to setup. System runs degraded.")
+
+    def create_startup_graph(self):
+        startup = StartupGraph()
+        # Arm crash detection & pre-roll capture first
+        startup.add('car', self.setup_car, critical=True)
+        startup.add('camera', self.setup_camera, critical=True)
+        # Then the rest
+        startup.add('codecs', self.load_codecs, deps=('camera',))
+        startup.add('blackbox', self.setup_blackbox)
+        startup.add('captures', captures.open)
+        startup.add('geoindex', geoindex.open)
+        if self.redactor is not None:
+            startup.add('redactor', self.redactor.open)
+        startup.add('gps', self.setup_gps, deps=('blackbox',))
+        startup.add('outbox', self.crash_reporter.open_outbox)
+        startup.add('reporter', self.setup_reporter, deps=('captures', 'outbox'))
+        startup.add('power', self.power.start, deps=('camera', 'gps'))
+        startup.add('memory', self.memory.start, deps=('camera',))
+        startup.add('gsm', self.setup_gsm)
+        startup.add('metrics', self.metrics_exporter.start)
+        startup.add('supervisor', self.supervisor.start)
+        return startup
+
+    def on_system_armed(self, armed: bool):
+        self.boot_to_armed.set((perf_counter_ns() - BOOT_STARTED_AT) / 1e9)
+        if not armed:
+            self.logger.error("Crash detection couldn't be armed.")
+            return
+        uptime = utils.system_uptime()
+        since_power_on = f" ({uptime:.1f} secs since power on)" if uptime is not None else ""
+        self.logger.success(f"Armed for crash detection in {self.boot_to_armed.get() * 1000:.0f} ms since start{since_power_on}.")
+
+    def setup_car(self):
+        self.car.setup()
+        self.car.start()
+        detector = self.car.crash_detector
+        self.supervisor.watch('detector', detector.heartbeat, SupervisorConstants.DETECTOR_TIMEOUT, detector.restart, lambda: detector.detecting, critical=True,
+                              max_inactive=SupervisorConstants.DETECTOR_MAX_SUSPENDED)
+
+    def setup_camera(self):
+        # Camera stack (& OpenCV) is imported here, concurrently with the other steps
+        from camera import Camera
+        resolution, framerate = self.camera_profile(PowerState.DRIVING)
+        camera = Camera(resolution=resolution, framerate=framerate, duration=self.memory.plan.duration)
+        camera.setup()
+        camera.start()
+        self.camera = camera
+        self.supervisor.watch('camera', camera.heartbeat, SupervisorConstants.CAMERA_TIMEOUT, camera.restart, lambda: camera.capturing, critical=True)
+
+    def camera_profile(self, state: str):
+        """ Returns (resolution, framerate) the camera captures at in the power state within the memory budget. """
+        resolution, framerate = PowerConstants.CAMERA_PROFILES[state]
+        # Full capture takes the best resolution the budget allows, the parked one only if it's smaller
+        if state != PowerState.PARKED or frame_size(resolution) > frame_size(self.memory.plan.resolution):
+            resolution = self.memory.plan.resolution
+        return resolution, framerate
+
+    def load_codecs(self):
+        from camera import load_codecs
+        load_codecs()
+
+    def setup_blackbox(self):
+        recorder.resize_pending(self.memory.plan.telemetry_records)
+        recorder.open()
+        recorder.start()
+        # Packages carry the window around their accident
+        self.crash_reporter.recorder = recorder
+
+    def setup_gps(self):
+        self.gps.setup()
+        self.gps.start()
+        if not IS_TESTING:
+            self.supervisor.watch('gps', self.gps.heartbeat, SupervisorConstants.GPS_TIMEOUT, self.gps.restart, lambda: self.gps.switcher.is_set())
+
+    def on_power_state_changed(self, state: str, previous: str):
+        resolution, framerate = self.camera_profile(state)
+        self.car.crash_detector.poll_interval = PowerConstants.DETECTOR_POLL_INTERVALS[state]
+        if self.camera is None:
             return
-        
-        if self.system_running():
-            self.logger.warning("System is already running.")
+        # Wait for the accident being captured (if any)
+        with self.capture_lock:
+            self.camera.unwatch_motion()
+            self.camera.reconfigure(resolution, framerate)
+            if state == PowerState.PARKED:
+                self.camera.watch_motion(self.power.wake, PowerConstants.MOTION_THRESHOLD)
+
+    def on_memory_plan_changed(self, plan: MemoryPlan, previous: MemoryPlan):
+        if self.crash_reporter.transcoder is not None:
+            self.crash_reporter.transcoder.threads = plan.encode_threads
+        if self.camera is None:
             return
-        
+        # Wait for the accident being captured (if any)
+        with self.capture_lock:
+            # Shorter buffer releases frames right away, a lower resolution needs a restart
+            self.camera.set_duration(plan.duration)
+            self.camera.reconfigure(*self.camera_profile(self.power.state))
+
+    def setup_reporter(self):
         try:
-            self.running_signal.set()
-            self.logger.info("Starting system...")
-            # Start system components
-            self.car.start()
-            self.gps.start()
-            self.camera.start()
-            self.interruption_service.start()
-        except Exception:
-            self.running_signal.clear()
-            self.logger.error("One or more system components failed to start.")
+            self.crash_reporter.setup()
+        except FileNotFoundError:
+            self.logger.error(f"Couldn't find firebase config at path: '{FirebaseConstants.CREDENTIALS_FILE_PATH}'")
+            raise
+        self.crash_reporter.transcoder.threads = self.memory.plan.encode_threads
+        self.crash_reporter.start()
+
+    def setup_gsm(self):
+        # SMS is a fallback channel, system runs without it
+        try:
+            if IS_TESTING:
+                self.gsm_simulator.start()
+            self.gsm.setup()
+            if self.gsm.state.ready:
+                self.gsm.start()
+        except Exception as e:
+            self.logger.warning(f"GSM modem isn't available. SMS alerts are disabled. Reason: {e}")
 
     def stop_system(self):
         if not self.system_running():
@@ -101,87 +275,230 @@ class AASSL(CrashDetectorCallback, InterruptionService.Callback):
         try:
             self.running_signal.clear()
             self.logger.info("Stopping system...")
+            # Disarm the watchdog first, components stop beating from now on
+            self.supervisor.stop()
             # Stop system components
+            self.power.stop()
+            self.memory.stop()
             self.car.stop()
             self.gps.stop()
-            self.camera.stop()
+            # Videos being saved are finished first, they're already reported
+            self.video_pool.shutdown(wait=True)
+            if self.camera is not None:
+                self.camera.stop()
+            self.crash_reporter.stop()
+            self.gsm.stop()
+            self.metrics_exporter.stop()
+            recorder.stop()
+            geoindex.close()
+            if self.redactor is not None:
+                self.redactor.close()
             self.logger.info("System stopped.")
         except:
             self.logger.error("One or more system components failed to stop.")
         finally:
-            # Exit
-            exit(0)
+            # Makes boot() return
+            self.scheduler.stop()
+
+    def dump_trace(self, timestamp: int):
+        try:
+            spans_count = tracer.dump_chrome_trace(timestamp, utils.get_trace_file_path(timestamp))
+            self.logger.info(f"Dumped {spans_count} trace span(s) of accident {timestamp}.")
+        except Exception as e:
+            self.logger.warning(f"Can't dump trace of accident {timestamp}. Reason: {e}")
 
     def on_interrupt(self):
         self.logger.info("SYSTEM WAS INTERRUPTED.")
         return self.stop_system()
 
-    def on_accident_happened(self):
-        self.logger.info("Received crash signal from CrashDetector. Handling it...")
-        # Wait until camera is initialized if it not
-        if not self.camera.initialized:
-            self.logger.info("Waiting for camera to initialize.")
-            self.camera.initialized_signal.wait()
-            self.logger.info("Camera is initialized.")
-        # Build accident model
-        timestamp = math.floor(current_time() * 1000)  # Timestamp in millis
-        self.camera.resume()
-        # Get before accident video buffer from camera
-        self.logger.info("Capturing before accident video...")
-        self.camera.wait_until_buffer_filled()
+    def snapshot_pre_roll(self, timestamp: int):
+        """ Grabs the frames buffered before the accident, the buffer then refills with the post-roll.
 
-        self.camera.suspend()
-        buffer_before_accident = self.camera.video_buffer.clone()
+        Returns:
+            tuple: (VideoBuffer of the pre-roll, whether the buffer was cleared for the post-roll)
+        """
+        # Busy capturing the post-roll of a previous accident, its frames are this one's pre-roll
+        restarted = self.capture_lock.acquire(blocking=False)
+        try:
+            with tracer.span("pre_roll_snapshot", timestamp):
+                # Whatever is buffered is the pre-roll, waiting for more would only add frames after the crash
+                self.camera.suspend()
+                buffer_before_accident = self.camera.video_buffer.clone()
+                if restarted:
+                    self.camera.video_buffer.clear()
+                self.camera.resume()
+        finally:
+            if restarted:
+                self.capture_lock.release()
         self.logger.info("Grabbed before accident video buffer: {}".format(buffer_before_accident))
+        return buffer_before_accident, restarted
 
-        # Resume the camera
-        self.camera.video_buffer.clear()
-        self.logger.info("Capturing 5 secs after accident...")
-        # Wait for camera to capture the next 5 secs video
-        self.camera.resume()
-        self.camera.wait_until_buffer_filled()
+    def pick_thumbnail(self, buffer_before_accident, accident: Accident):
+        """ Picks the thumbnail sent inline with the alert out of the pre-roll.
 
-        # Get after accident buffer from camera
-        buffer_after_accident = self.camera.video_buffer.clone()
-        self.logger.info("Grabbed after accident video buffer: {}".format(buffer_after_accident))
+        Returns:
+            str: Base64 JPEG of the thumbnail or None if there's no room or frame for it.
+        """
+        keyframes = self.pick_keyframes(buffer_before_accident, accident.timestamp, count=1)
+        if not keyframes:
+            return None
+        return self.keyframes.thumbnail(keyframes[0], accident.alert_room(self.car))
 
-        buffer_accident_video = self.camera.create_accident_buffer(
-            buffer_before=buffer_before_accident,
-            buffer_after=buffer_after_accident
-        )
-        self.camera.video_buffer.clear()
-        self.logger.info("Total accident video buffer: {}".format(buffer_accident_video))
-        # Save the video
-        filename = self.camera.save_captured_video(buffer_accident_video, timestamp)
+    def capture_accident_video(self, pre_roll, timestamp: int):
+        """ Captures the post-roll of the accident then picks the keyframes, redacts & saves the
+        video (runs off the alert path, the upload waits for it).
+
+        Returns:
+            dict: Payload fields of the saved video or None if it couldn't be saved.
+        """
+        try:
+            # Camera is armed along with the crash detector, it may still be starting
+            if not self.startup.wait('camera'):
+                return None
+            if pre_roll is None:
+                pre_roll = self.snapshot_pre_roll(timestamp)
+            buffer_before_accident, restarted = pre_roll
+            with self.capture_lock:
+                if not restarted:
+                    self.camera.video_buffer.clear()
+                self.logger.info(f"Capturing {self.camera.VIDEO_DURATION} secs after accident...")
+                # Wait for camera to capture the post-roll video
+                self.camera.resume()
+                with tracer.span("post_roll_fill", timestamp):
+                    self.camera.wait_until_buffer_filled()
+
+                    # Get after accident buffer from camera
+                    buffer_after_accident = self.camera.video_buffer.clone()
+                self.logger.info("Grabbed after accident video buffer: {}".format(buffer_after_accident))
+
+                buffer_accident_video = self.camera.create_accident_buffer(
+                    buffer_before=buffer_before_accident,
+                    buffer_after=buffer_after_accident
+                )
+                self.camera.video_buffer.clear()
+        except Exception as e:
+            # The accident is still reported, just without video
+            self.logger.error(f"Can't capture video of accident {timestamp}. Reason: {e}")
+            return None
+        finally:
+            # An impact wakes a parked unit, once the video at the current profile is captured
+            self.power.wake()
+        quality = buffer_accident_video.quality()
+        self.video_coverage.set(quality.coverage)
+        self.logger.info("Total accident video buffer: {} | {}".format(buffer_accident_video, quality))
+        # Keyframes are picked while the frames are still in memory
+        with tracer.span("keyframes", timestamp):
+            keyframes = self.pick_keyframes(buffer_accident_video, timestamp)
+        try:
+            self.keyframes.save(keyframes, timestamp)
+        except Exception as e:
+            self.logger.warning(f"Can't save keyframes of accident {timestamp}. Reason: {e}")
+        # Nothing raw leaves the unit
+        if self.redactor is not None:
+            with tracer.span("redact", timestamp):
+                self.redactor.redact(buffer_accident_video)
+        with tracer.span("encode", timestamp) as span:
+            filename = self.camera.save_captured_video(buffer_accident_video, timestamp)
+        self.encode_latency.observe((perf_counter_ns() - span.start) / 1e9)
         if filename is None:
-            self.logger.error("Camera was unable to save accident video. Aborted reporting.")
-            return
-        
+            return None
+        return {AccidentKeys.VIDEO_QUALITY: to_json(quality.as_dict(), separators=(',', ':'))}
+
+    def pick_keyframes(self, video_buffer, timestamp: int, count=None):
+        """ Picks the keyframes of the accident video & redacts them.
+
+        Returns:
+            list: Keyframes best first (empty if they couldn't be picked).
+        """
+        # Frames are stamped in monotonic time
+        crash_at = monotonic() - (current_time() - timestamp / 1000)
+        redact = None
+        if self.redactor is not None:
+            # Only the few keyframes are redacted before the alert, frames are blurred whole if the redactor isn't open in time
+            self.startup.wait('redactor', timeout=RedactionConstants.KEYFRAMES_TIMEOUT)
+            redact = partial(self.redactor.redact_frames, stride=1, timeout=RedactionConstants.KEYFRAMES_TIMEOUT)
+        try:
+            return self.keyframes.extract(video_buffer, crash_at, redact, count)
+        except Exception as e:
+            self.logger.warning(f"Can't pick keyframes of accident {timestamp}. Reason: {e}")
+            return []
+
+    def on_accident_happened(self):
+        self.logger.info("Received crash signal from CrashDetector. Handling it...")
+        self.accidents_count.inc()
+        timestamp = math.floor(current_time() * 1000)  # Timestamp in millis
+        tracer.open(timestamp)
+        try:
+            self.__handle_accident(timestamp)
+        except Exception as e:
+            self.logger.error(f"Handling accident {timestamp} failed. Reason: {e}")
+        finally:
+            # Re-arm whatever happened, one bad accident must not leave the unit disarmed
+            if self.camera is not None:
+                self.camera.resume()
+            self.car.crash_detector.resume()
+
+    def __handle_accident(self, timestamp: int):
         # Get last known location from GPS
-        location = self.gps.last_known_location
-        
+        location = tuple(self.gps.last_known_location)
+        # Send SMS alerts right away in parallel with the rest of the pipeline
+        if self.gsm.state.ready:
+            self.logger.info("Sending SMS alerts to emergency contacts...")
+            self.gsm.send_alert(self.car.emergency_contacts.split(','), build_alert_text(self.car, location, timestamp))
+        # Only the pre-roll is grabbed before the alert, the post-roll is captured along with the video
+        pre_roll = None
+        if self.startup.wait('camera', timeout=0):
+            try:
+                pre_roll = self.snapshot_pre_roll(timestamp)
+            except Exception as e:
+                # Video job grabs whatever is buffered then, the alert doesn't wait for it
+                self.logger.error(f"Can't grab pre-roll of accident {timestamp}. Reason: {e}")
+        # Camera may still be starting, the job waits for it (the upload then reports it without video if it can't)
+        filename, video_job = "", None
+        self.video_jobs = [job for job in self.video_jobs if not job.done()]
+        # Buffers of the videos in the works are budgeted, more would push the unit out of memory
+        if len(self.video_jobs) > MemoryConstants.QUEUED_VIDEOS:
+            self.logger.error(f"{len(self.video_jobs)} accident video(s) are still being saved. Reporting it without video.")
+        else:
+            filename = utils.get_video_filename(timestamp)
+            video_job = self.video_pool.submit(self.capture_accident_video, pre_roll, timestamp)
+            self.video_jobs.append(video_job)
+
+        # Find the emergency facilities around (empty until the index is opened)
+        with tracer.span("geo_lookup", timestamp):
+            facilities, street = geoindex.lookup(location[0], location[1])
+
         # Build accident model
         accident = Accident(
             lat=location[0],
             lng=location[1],
             timestamp=timestamp,
-            video_filename=filename
+            video_filename=filename,
+            facilities=facilities,
+            street=street
         )
+        # Best pre-roll keyframe goes inline with the alert if there's room for it, the package has them all
+        if pre_roll is not None:
+            with tracer.span("thumbnail", timestamp):
+                accident.thumbnail = self.pick_thumbnail(pre_roll[0], accident)
 
         # Report accident
         self.logger.info("Build accident record:\n{}".format(accident.as_json(self.car)))
-        reported = self.crash_reporter.report_accident(accident.as_dict(self.car))
-        if reported:
-            self.logger.success("Accident reported successfully.")
+
+        # Outbox doesn't wait for the backend, the drainer reports it once the reporter is up
+        queued = False
+        if self.startup.wait('outbox', timeout=OutboxConstants.OPEN_TIMEOUT):
+            with tracer.span("enqueue", timestamp):
+                queued = self.crash_reporter.submit_accident(accident.as_dict(self.car), video_job)
+        if queued:
+            self.logger.success("Accident queued for reporting.")
         else:
-            self.logger.error("Couldn't report accident.")
-        # Resume car crash detector
-        self.camera.resume()
-        self.car.crash_detector.resume()
+            self.logger.error("Couldn't queue accident for reporting.")
+        # Reporter rewrites it with the reporting spans once done
+        self.dump_trace(timestamp)
 
 
 if __name__ == '__main__':
     aassl = AASSL()
-    aassl.setup_system()
-    aassl.start_system()
+    aassl.boot()
     # aassl.stop_system()
@@ -0,0 +1,298 @@
+import os
+import json
+import struct
+from collections import deque
+from threading import Event, Lock, Thread
+from time import time as current_time, monotonic
+
+import utils
+from logger import Logger
+from constants import BlackBoxConstants
+
+# Record: timestamp (wall secs), type, padding, 6 values
+RECORD = struct.Struct('<dB7x6f')
+# Header of exported windows: magic, version, record size, records count
+EXPORT_HEADER = struct.Struct('<4sHHI')
+EXPORT_MAGIC = b'BBX1'
+
+
+class RecordType:
+    GPS_FIX = 1  # lat, lng, speed (km/h)
+    DETECTOR = 2  # state, power, detection
+    IMU = 3  # ax, ay, az, gx, gy, gz
+    SYSTEM = 4  # load avg, cpu temp (c), mem available (mb)
+    EVENT = 5  # code, value
+
+
+class BlackBoxRecorder:
+    """
+    Flight recorder of the unit telemetry.
+
+    Records have a fixed size and are written into a ring of preallocated segment files,
+    so the history never grows past `segments * records_per_segment` records. An index
+    of the time range of every segment lets a window be extracted without scanning.
+    Records are buffered and written by a background thread that fsyncs every
+    `fsync_interval` secs, so recording costs a struct pack and a deque append.
+    """
+
+    def __init__(self, dirpath: str, segments=8, records_per_segment=65536, fsync_interval=5.0, load_interval=1.0) -> None:
+        self.dirpath = dirpath
+        self.segments = segments
+        self.records_per_segment = records_per_segment
+        self.segment_size = records_per_segment * RECORD.size
+        self.fsync_interval = fsync_interval
+        self.load_interval = load_interval
+        self.logger = Logger("BlackBox")
+        # Records waiting to be written (oldest are dropped if writer falls behind)
+        self.pending = deque(maxlen=records_per_segment)
+        # Runtime
+        self.lock = Lock()
+        self.switcher = Event()
+        self.wakeup_signal = Event()
+        self.writer_thread = None
+        self.opened = False
+        self.fd = None
+        self.segment = 0
+        self.position = 0
+        self.index = []  # [first ts, last ts, count] per segment
+        self.last_fsync = 0.0
+
+    # Recording API (cheap, thread safe)
+
+    def record(self, kind: int, *values):
+        values = (tuple(values) + (0.0,) * 6)[:6]
+        self.pending.append(RECORD.pack(current_time(), kind, *values))
+
+    def record_gps(self, lat, lng, speed):
+        self.record(RecordType.GPS_FIX, lat, lng, speed)
+
+    def record_detector(self, state, powered, detecting):
+        self.record(RecordType.DETECTOR, state, powered, detecting)
+
+    def record_imu(self, ax, ay, az, gx, gy, gz):
+        self.record(RecordType.IMU, ax, ay, az, gx, gy, gz)
+
+    def record_event(self, code, value=0.0):
+        self.record(RecordType.EVENT, code, value)
+
+    def resize_pending(self, maxlen: int):
+        """ Caps records buffered in memory until they're written (meant before it's started). """
+        if maxlen != self.pending.maxlen:
+            self.pending = deque(self.pending, maxlen=maxlen)
+
+    # Lifecycle
+
+    def open(self):
+        if self.opened:
+            return
+        os.makedirs(self.dirpath, exist_ok=True)
+        self.__load_index()
+        self.__open_segment(self.segment, reset=False)
+        self.opened = True
+        self.logger.success(f"Opened black box at '{self.dirpath}' | Segment= {self.segment} Position= {self.position}")
+
+    def start(self):
+        if not self.switcher.is_set():
+            self.switcher.set()
+            self.wakeup_signal.clear()
+            self.writer_thread = Thread(name="BlackBoxWriter", target=self.__writer_job, daemon=True)
+            self.writer_thread.start()
+            Thread(name="BlackBoxLoad", target=self.__load_sampler_job, daemon=True).start()
+
+    def stop(self):
+        if self.switcher.is_set():
+            self.switcher.clear()
+            self.wakeup_signal.set()
+
+    def join(self, timeout=None):
+        """ Waits for the writer to finish its last flush once stopped.
+
+        Returns:
+            bool: Whether the writer is done.
+        """
+        if self.writer_thread is not None:
+            self.writer_thread.join(timeout)
+            return not self.writer_thread.is_alive()
+        return True
+
+    def flush(self, sync=True):
+        """ Writes pending records to disk (and fsyncs them). """
+        with self.lock:
+            if not self.opened:
+                return
+            self.__write_pending()
+            if sync:
+                os.fsync(self.fd)
+                self.__save_index()
+                self.last_fsync = monotonic()
+
+    def export(self, start: float, end: float, filepath: str):
+        """ Writes records between start and end (wall secs) to filepath.
+
+        Returns:
+            int: Count of exported records.
+        """
+        self.flush()
+        count = 0
+        with self.lock:
+            segments = [idx for idx, (first, last, size) in enumerate(self.index) if size > 0 and last >= start and first <= end]
+            # Oldest segment first
+            segments.sort(key=lambda idx: self.index[idx][0])
+            with open(filepath, 'wb') as output:
+                output.write(EXPORT_HEADER.pack(EXPORT_MAGIC, 1, RECORD.size, 0))
+                for idx in segments:
+                    size = self.index[idx][2]
+                    with open(self.__segment_path(idx), 'rb') as segment:
+                        lo = self.__bisect(segment, size, start)
+                        segment.seek(lo * RECORD.size)
+                        for _ in range(lo, size):
+                            data = segment.read(RECORD.size)
+                            if RECORD.unpack(data)[0] > end:
+                                break
+                            output.write(data)
+                            count += 1
+                output.seek(0)
+                output.write(EXPORT_HEADER.pack(EXPORT_MAGIC, 1, RECORD.size, count))
+        return count
+
+    @staticmethod
+    def read_export(filepath: str):
+        """ Yields (timestamp, type, values) of records in an exported window. """
+        with open(filepath, 'rb') as file:
+            magic, _, size, count = EXPORT_HEADER.unpack(file.read(EXPORT_HEADER.size))
+            if magic != EXPORT_MAGIC or size != RECORD.size:
+                raise ValueError("Not a black box export.")
+            for _ in range(count):
+                timestamp, kind, *values = RECORD.unpack(file.read(RECORD.size))
+                yield timestamp, kind, values
+
+    # Internals
+
+    def __segment_path(self, idx: int):
+        return os.path.join(self.dirpath, f"segment_{idx:03d}.bin")
+
+    def __index_path(self):
+        return os.path.join(self.dirpath, "index.json")
+
+    def __load_index(self):
+        self.index = [[0.0, 0.0, 0] for _ in range(self.segments)]
+        try:
+            with open(self.__index_path(), 'r') as file:
+                saved = json.load(file)
+            if len(saved['index']) == self.segments:
+                self.index = saved['index']
+                self.segment = saved['segment']
+        except Exception:
+            pass
+
+    def __save_index(self):
+        tmp_path = f"{self.__index_path()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump({'segment': self.segment, 'index': self.index}, file)
+        os.replace(tmp_path, self.__index_path())
+
+    def __open_segment(self, idx: int, reset: bool):
+        if self.fd is not None:
+            os.fsync(self.fd)
+            os.close(self.fd)
+        path = self.__segment_path(idx)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if reset or os.fstat(self.fd).st_size != self.segment_size:
+            # Preallocate zeroed segment so writes never have to grow the file
+            os.ftruncate(self.fd, 0)
+            try:
+                os.posix_fallocate(self.fd, 0, self.segment_size)
+            except (AttributeError, OSError):
+                os.ftruncate(self.fd, self.segment_size)
+            self.index[idx] = [0.0, 0.0, 0]
+        self.segment = idx
+        # Index may lag behind disk after a power cut, recover count from the zeroed tail
+        self.position = self.__recover_count(idx)
+        self.index[idx][2] = self.position
+
+    def __recover_count(self, idx: int):
+        with open(self.__segment_path(idx), 'rb') as segment:
+            lo, hi = 0, self.records_per_segment
+            while lo < hi:
+                mid = (lo + hi) // 2
+                segment.seek(mid * RECORD.size)
+                if RECORD.unpack(segment.read(RECORD.size))[0] > 0:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+    @staticmethod
+    def __bisect(segment, size: int, timestamp: float):
+        lo, hi = 0, size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            segment.seek(mid * RECORD.size)
+            if RECORD.unpack(segment.read(RECORD.size))[0] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def __write_pending(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.pending.popleft())
+            except IndexError:
+                break
+        offset = 0
+        while offset < len(batch):
+            if self.position >= self.records_per_segment:
+                # Rotate into the oldest segment
+                self.__save_index()
+                self.__open_segment((self.segment + 1) % self.segments, reset=True)
+            room = self.records_per_segment - self.position
+            chunk = batch[offset:offset + room]
+            os.pwrite(self.fd, b''.join(chunk), self.position * RECORD.size)
+            entry = self.index[self.segment]
+            if entry[2] == 0:
+                entry[0] = RECORD.unpack(chunk[0])[0]
+            entry[1] = RECORD.unpack(chunk[-1])[0]
+            self.position += len(chunk)
+            entry[2] = self.position
+            offset += len(chunk)
+
+    def __writer_job(self):
+        while self.switcher.is_set():
+            self.wakeup_signal.wait(0.5)
+            try:
+                self.flush(sync=monotonic() - self.last_fsync >= self.fsync_interval)
+            except Exception as e:
+                self.logger.error(f"Can't write records. Reason: {e}")
+        self.flush()
+
+    def __load_sampler_job(self):
+        while self.switcher.is_set():
+            load = os.getloadavg()[0] if hasattr(os, 'getloadavg') else 0.0
+            self.record(RecordType.SYSTEM, load, read_cpu_temperature(), read_available_memory() / (1024 * 1024))
+            self.wakeup_signal.wait(self.load_interval)
+
+
+def read_cpu_temperature():
+    try:
+        with open('/sys/class/thermal/thermal_zone0/temp', 'r') as file:
+            return int(file.read().strip()) / 1000.0
+    except Exception:
+        return 0.0
+
+
+def read_available_memory():
+    """ Returns available memory in bytes (0 if unknown). """
+    try:
+        with open('/proc/meminfo', 'r') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except Exception:
+        pass
+    return 0
+
+
+# Shared by the whole system, records are buffered until it's opened
+recorder = BlackBoxRecorder(utils.blackbox_dir_path(), fsync_interval=BlackBoxConstants.FSYNC_INTERVAL)
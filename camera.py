@@ -1,18 +1,21 @@
 import os
 import math
-import cv2 as cv
-from time import sleep
+from time import sleep, monotonic
 from logger import Logger
 from threading import Event, Thread
 
 import utils
+from metrics import registry
+from captures import captures
+from supervisor import Heartbeat
 from constants import IS_TESTING
 
 if IS_TESTING:
     # Use PC camera (for testing only)
     from pc_toolkit import (
         PCCamera as PiCamera,
-        RGBArray as PiRGBArray
+        RGBArray as PiRGBArray,
+        CameraError as PiCameraValueError
     )
 else:
     # Picamera on RPi
@@ -20,22 +23,107 @@ else:
     from picamera.array import PiRGBArray
     from picamera.exc import PiCameraValueError
 
+# OpenCV is only needed to save videos, it's loaded after the camera is armed
+cv = None
+
+# Buckets in secs of the intervals between frames & their deviation from the frame period
+FRAME_INTERVAL_BUCKETS = (0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1, 2.5)
+FRAME_JITTER_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+def load_codecs():
+    global cv
+    if cv is None:
+        import cv2
+        cv = cv2
+
+
+class ClipQuality:
+    """ How much of the time span of a video clip its frames cover. """
+
+    def __init__(self, frames: int, expected: int, longest_gap: float, jitter: float) -> None:
+        """
+        Args:
+            expected (int): Frames the camera delivers over the span of the clip.\n
+            longest_gap (float): Longest secs between two consecutive frames.\n
+            jitter (float): Mean secs consecutive frames are off the frame period.
+        """
+        self.frames = frames
+        self.expected = expected
+        self.longest_gap = longest_gap
+        self.jitter = jitter
+
+    @staticmethod
+    def of(stamps: list, framerate: int):
+        """ Returns quality of the clip of frames stamped with (sequence number, capture time). """
+        if not stamps:
+            return ClipQuality(0, 0, 0.0, 0.0)
+        period = 1 / framerate
+        longest_gap = 0.0
+        deviations = []
+        for (prev_seq, prev_at), (seq, at) in zip(stamps, stamps[1:]):
+            interval = at - prev_at
+            longest_gap = max(longest_gap, interval)
+            if seq - prev_seq == 1:
+                deviations.append(abs(interval - period))
+        expected = stamps[-1][0] - stamps[0][0] + 1
+        jitter = sum(deviations) / len(deviations) if deviations else 0.0
+        return ClipQuality(len(stamps), expected, longest_gap, jitter)
+
+    @property
+    def missing(self):
+        return max(0, self.expected - self.frames)
+
+    @property
+    def coverage(self):
+        """ Percent of the expected frames in the clip. """
+        return 100.0 * self.frames / self.expected if self.expected > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            'frames': self.frames,
+            'expected': self.expected,
+            'coverage': round(self.coverage, 1),
+            'longest_gap_ms': round(self.longest_gap * 1000),
+            'jitter_ms': round(self.jitter * 1000, 1),
+        }
+
+    def __repr__(self) -> str:
+        return f'ClipQuality[coverage= {self.coverage:.1f}% ({self.frames}/{self.expected} frames), longest gap= {self.longest_gap * 1000:.0f} ms, jitter= {self.jitter * 1000:.1f} ms]'
+
 
 class VideoBuffer:
 
     def __init__(self, framerate=30, max_frame_count=0, **buffers) -> None:
         self.framerate = framerate
         self.max_frame_count = max_frame_count
+        # (frame, sequence number, capture time) entries
         self.__data = []
+        # Set once the buffer holds max_frame_count frames
+        self.filled_signal = Event()
         if 'buf_before' in buffers:
-            self.__data.extend(buffers['buf_before'])
+            self.__data.extend(buffers['buf_before'].entries)
         if 'buf_after' in buffers:
-            self.__data.extend(buffers['buf_after'])
+            self.__data.extend(buffers['buf_after'].entries)
+        if 0 < self.max_frame_count <= self.occupied_size:
+            self.filled_signal.set()
 
     def __iter__(self):
-        for frame in self.__data:
+        for frame, _, _ in self.__data:
             yield frame
 
+    @property
+    def entries(self):
+        """ Snapshot of the (frame, sequence number, capture time) entries. """
+        return self.__data.copy()
+
+    @property
+    def stamps(self):
+        return [(seq, at) for _, seq, at in self.__data.copy()]
+
+    def quality(self):
+        return ClipQuality.of(self.stamps, self.framerate)
+
     @property
     def occupied_size(self):
         return len(self.__data)
@@ -44,23 +132,39 @@ class VideoBuffer:
     def duration(self):
         return int(round(self.max_frame_count / self.framerate, 0))
 
-    def push(self, frame):
+    def push(self, frame, seq=None, at=None):
+        if seq is None:
+            seq = self.__data[-1][1] + 1 if self.__data else 0
         # Ensure a slot of frame in video buffer
         if self.occupied_size >= self.max_frame_count:
             del self.__data[0]  # Remove the 1st frame from video buffer
         # Append frame to the end of data
-        self.__data.append(frame)
+        self.__data.append((frame, seq, monotonic() if at is None else at))
+        if self.occupied_size >= self.max_frame_count:
+            self.filled_signal.set()
+
+    def resize(self, max_frame_count: int):
+        """ Changes the frames the buffer holds, the oldest ones beyond it are released right away. """
+        self.max_frame_count = max_frame_count
+        excess = self.occupied_size - max_frame_count
+        if excess > 0:
+            del self.__data[:excess]
+        if 0 < self.max_frame_count <= self.occupied_size:
+            self.filled_signal.set()
+        else:
+            self.filled_signal.clear()
 
     def clear(self):
         print(f"Buffer clearing. CurrentSize= {self.occupied_size}")
         self.__data.clear()
+        self.filled_signal.clear()
         print(f"Buffer cleared. CurrentSize= {self.occupied_size}")
 
     def clone(self):
         return VideoBuffer(
-            frame_rate=self.framerate,
+            framerate=self.framerate,
             max_frame_count=self.max_frame_count,
-            buf_before=self.__data.copy())
+            buf_before=self)
 
     def __repr__(self) -> str:
         return f'VideoBuffer[frames_count= {self.occupied_size}]'
@@ -81,14 +185,33 @@ class Camera:
         self.suspending_switcher = Event()
         self.initialized_signal = Event()
         self.capture_after_accident_signal = Event()
+        self.heartbeat = Heartbeat()
+        # Set while frames are wanted (neither suspended nor saving)
+        self.active_signal = Event()
+        self.active_signal.set()
         # Global runtime
         self.logger = Logger("Camera")
         self.DURATION_FRAMES_COUNT = self.framerate * self.VIDEO_DURATION
         self.video_buffer = VideoBuffer(
-            frame_rate=self.framerate,
+            framerate=self.framerate,
             max_frame_count=self.DURATION_FRAMES_COUNT,
         )
         self.logger.info(f"Created VideoBuffer instance that can hold {self.video_buffer.max_frame_count} frame.")
+        # Motion watch (while parked)
+        self.motion_callback = None
+        self.motion_threshold = 0.0
+        self.motion_reference = None
+        # Frame numbering (the camera doesn't number frames delivered on the video port)
+        self.sequence = -1
+        self.last_frame_at = None
+        # Metrics
+        self.frames_captured = registry.counter('camera_frames_captured_total', 'Frames pushed to the video buffer.')
+        self.frames_dropped = registry.counter('camera_frames_dropped_total', 'Frames skipped while saving/suspended or failed to be pushed.')
+        self.frames_missed = registry.counter('camera_frames_missed_total', 'Frames that never reached the worker while capturing (late or stalled capture).')
+        self.frame_interval = registry.histogram('camera_frame_interval_seconds', 'Secs between consecutive captured frames.', buckets=FRAME_INTERVAL_BUCKETS)
+        self.frame_jitter = registry.histogram('camera_frame_jitter_seconds', 'Secs consecutive captured frames are off the frame period.', buckets=FRAME_JITTER_BUCKETS)
+        registry.gauge('camera_buffer_fill_ratio', 'Occupied fraction of the video buffer.').set_function(
+            lambda: self.video_buffer.occupied_size / max(1, self.video_buffer.max_frame_count))
         self.logger.info("Created Camera instance. Waiting for setup...")
 
     def setup(self):
@@ -110,6 +233,70 @@ class Camera:
             self.recording_signal.clear()
             self.picamera.close()
 
+    def restart(self):
+        self.stop()
+        # Let the stalled worker go before reopening the camera
+        self.camera_thread.join(timeout=5.0)
+        self.setup()
+        self.start()
+
+    def reconfigure(self, resolution, framerate):
+        """ Switches the capture profile, the video buffer is refilled at the new one.
+
+        Returns:
+            bool: True if the profile changed, False otherwise.
+        """
+        if resolution == self.resolution and framerate == self.framerate:
+            return False
+        recording = self.recording
+        if recording:
+            self.stop()
+            self.camera_thread.join(timeout=5.0)
+        self.resolution = resolution
+        self.framerate = framerate
+        self.DURATION_FRAMES_COUNT = self.framerate * self.VIDEO_DURATION
+        self.video_buffer = VideoBuffer(
+            framerate=self.framerate,
+            max_frame_count=self.DURATION_FRAMES_COUNT,
+        )
+        self.motion_reference = None
+        # No frames are expected while reconfiguring
+        self.last_frame_at = None
+        if recording:
+            self.setup()
+            self.start()
+        self.logger.info(f"Reconfigured camera | Resl[{self.resolution}] FR[{self.framerate} FPS]")
+        return True
+
+    def set_duration(self, duration: int):
+        """ Changes secs of video kept in the buffer without restarting the capture.
+
+        Returns:
+            bool: True if the duration changed, False otherwise.
+        """
+        if duration == self.VIDEO_DURATION:
+            return False
+        self.VIDEO_DURATION = duration
+        self.DURATION_FRAMES_COUNT = self.framerate * self.VIDEO_DURATION
+        self.video_buffer.resize(self.DURATION_FRAMES_COUNT)
+        self.logger.info(f"Video buffer now holds {self.DURATION_FRAMES_COUNT} frame ({duration} secs).")
+        return True
+
+    def watch_motion(self, callback, threshold: float):
+        """ Calls the callback once (from the camera thread) when consecutive frames differ by threshold or more. """
+        self.motion_reference = None
+        self.motion_threshold = threshold
+        self.motion_callback = callback
+
+    def unwatch_motion(self):
+        self.motion_callback = None
+        self.motion_reference = None
+
+    @property
+    def capturing(self):
+        """ Whether frames are expected to be pushed now. """
+        return self.recording and self.active_signal.is_set()
+
     def save_captured_video(self, video_buffer: VideoBuffer, timestamp: int):
         """ Saves the captured video recorded in video buffer to local storage
             then returns the path of it
@@ -119,8 +306,10 @@ class Camera:
         saved = False
         # Set saving switcher flag to true
         self.saving_switcher.set()
-        filename = f"{timestamp}.mp4"
-        filepath = f"./captures/{filename}"
+        self.__update_active()
+        filename = utils.get_video_filename(timestamp)
+        filepath = utils.get_capture_file_path(filename)
+        writer = None
         try:
             # Create captures folder if not exists
             if not utils.captures_dir_exists():
@@ -130,12 +319,18 @@ class Camera:
                     self.logger.info("Created captures folder.")
                 else:
                     raise Exception("Can't create captures folder.")
+            # Hand the reserved space over to this video
+            captures.release_reserve()
             # Save buffer video to file
+            load_codecs()
             fourcc = cv.VideoWriter_fourcc(*'mp4v')
-            writer = cv.VideoWriter(filepath, fourcc, self.framerate, self.resolution)
-            self.logger.info(f"Saving video in buffer.. Dur[{video_buffer.duration}] Resl[{self.resolution}] FR[{video_buffer.framerate} FPS] Frames[{video_buffer.occupied_size}] to Path[{filepath}]")
+            # Camera may have been reconfigured since, the video keeps the size & rate it was captured at
+            frames = list(video_buffer)
+            resolution = (frames[0].shape[1], frames[0].shape[0]) if frames else self.resolution
+            writer = cv.VideoWriter(filepath, fourcc, video_buffer.framerate, resolution)
+            self.logger.info(f"Saving video in buffer.. Dur[{video_buffer.duration}] Resl[{resolution}] FR[{video_buffer.framerate} FPS] Frames[{video_buffer.occupied_size}] to Path[{filepath}]")
             # Write video from buffer to file.
-            for frame in video_buffer:
+            for frame in frames:
                 writer.write(frame)
             # Check saved video filesize
             size = os.path.getsize(filepath)
@@ -143,13 +338,18 @@ class Camera:
                 raise Exception("Something happened while saving video, it's empty.. If you changed resolution of camera, return it to (640,480).")
             # Video file was saved
             saved = True
+            captures.track(f"{timestamp}")
             self.logger.success("Video was saved successfully to '{}' | Size= ({:.2f} KB)".format(filepath, size / 1024.0))
         except Exception as e:
             self.logger.error(e)
         finally:
-            writer.release()
+            if writer is not None:
+                writer.release()
             # Reset flag to continue capturing
             self.saving_switcher.clear()
+            self.__update_active()
+            # Evict old uploaded accidents & reserve space for the next one
+            captures.maintain(background=True)
         # Return the video filename
         return filename if saved else None
 
@@ -174,23 +374,28 @@ class Camera:
         return self.video_buffer.occupied_size < self.video_buffer.max_frame_count
 
     def wait_until_buffer_filled(self):
-        last_size = 0
-        curr_size = self.video_buffer.occupied_size
-        while self.filling_buffer:
-            if curr_size != last_size:
-                last_size = curr_size
-                self.logger.info(f"Filling buffer. CurrentSize={curr_size}")
+        # Worker signals when the buffer fills up, no need to poll it
+        while not self.video_buffer.filled_signal.wait(1.0):
+            self.logger.info("Filling buffer. CurrentSize=%d", self.video_buffer.occupied_size)
 
     def suspend(self):
         if not self.suspended:
             self.suspending_switcher.set()
+            self.__update_active()
             self.logger.info("Camera suspended.")
 
     def resume(self):
         if self.suspended:
             self.suspending_switcher.clear()
+            self.__update_active()
             self.logger.info("Camera resumed.")
 
+    def __update_active(self):
+        if self.saving or self.suspended:
+            self.active_signal.clear()
+        else:
+            self.active_signal.set()
+
     def create_accident_buffer(self, buffer_before: VideoBuffer, buffer_after: VideoBuffer):
         return VideoBuffer(
             buf_after=buffer_after,
@@ -199,6 +404,39 @@ class Camera:
             max_frame_count=self.DURATION_FRAMES_COUNT * 2
         )
 
+    def __check_motion(self, image):
+        # Every 8th pixel of every 8th row is plenty to tell a scene change
+        sample = image[::8, ::8].astype('int16')
+        reference = self.motion_reference
+        self.motion_reference = sample
+        if reference is None or reference.shape != sample.shape:
+            return
+        energy = float(abs(sample - reference).mean())
+        callback = self.motion_callback
+        if energy < self.motion_threshold or callback is None:
+            return
+        self.motion_callback = None
+        self.logger.info("Motion detected | Energy= %.1f", energy)
+        callback()
+
+    def __stamp_frame(self):
+        """ Numbers the frame just captured by the frame periods passed since the previous one.
+
+        Returns:
+            tuple: (sequence number, capture time, frames missed since the previous one)
+        """
+        now = monotonic()
+        advance = 1
+        if self.last_frame_at is not None:
+            advance = max(1, round((now - self.last_frame_at) * self.framerate))
+        self.sequence += advance
+        self.last_frame_at = now
+        return self.sequence, now, advance - 1
+
+    def __observe_interval(self, interval: float):
+        self.frame_interval.observe(interval)
+        self.frame_jitter.observe(abs(interval - 1 / self.framerate))
+
     def __camera_worker(self):
         self.logger.info("Starting Camera...")
         # Wait until camera warms up
@@ -208,22 +446,44 @@ class Camera:
             try:
                 # Create frame buffer to hold every frame captured
                 frame_buffer = PiRGBArray(self.picamera, self.resolution)
+                skipping = False
                 # Start capturing frames from camera
                 for _ in self.picamera.capture_continuous(frame_buffer, format='bgr', use_video_port=True):
+                    previous_at = self.last_frame_at
+                    seq, at, missed = self.__stamp_frame()
                     # Skip frame if camera is saving video or camera is suspended
-                    if self.saving or self.suspended:
+                    if not self.active_signal.is_set():
+                        self.frames_dropped.inc(1 + missed)
+                        skipping = True
+                        frame_buffer.truncate(0)
+                        # Hold the capture until resumed instead of spinning on dropped frames
+                        self.active_signal.wait(0.5)
                         continue
+                    if skipping:
+                        # Frames lost while waiting to be resumed were skipped on purpose
+                        self.frames_dropped.inc(missed)
+                        skipping = False
+                    elif previous_at is not None:
+                        self.frames_missed.inc(missed)
+                        self.__observe_interval(at - previous_at)
                     try:
                         
                         # Grab the frame then process it
                         image = frame_buffer.array
 
                         # Push frame to video buffer
-                        self.video_buffer.push(image)
+                        self.video_buffer.push(image, seq, at)
+                        self.frames_captured.inc()
+                        self.heartbeat.beat()
+
+                        # Check for motion (if watched)
+                        if self.motion_callback is not None:
+                            self.__check_motion(image)
 
                         # Clear frame buffer to write next frame
                         frame_buffer.truncate(0)
                     except Exception as e:
+                        self.frames_dropped.inc()
                         self.logger.warning(e)
 
                     # Check whether camera switcher is switched off
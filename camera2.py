@@ -147,7 +147,7 @@ class Camera:
             # Skip frame if camera is saving video
             if self.saving or self.suspended:
                 continue
-            self.logger.info("Processing captured frame...")
+            self.logger.debug("Processing captured frame...")
             # Grab the frame then process it
             frame = self.picamera.capture_array(wait=True)
             # Push frame to video buffer
@@ -0,0 +1,234 @@
+import os
+import json
+from threading import Lock, Thread
+from time import time as current_time
+
+import utils
+from logger import Logger
+from metrics import registry
+from constants import CapturesConstants
+
+RESERVE_FILENAME = '.reserve'
+INDEX_FILENAME = '.index.json'
+
+
+class CaptureEntry:
+    """ Files of one accident in captures (video, package, black box, trace...). """
+
+    __slots__ = ('key', 'created_at', 'files', 'uploaded', 'protected')
+
+    def __init__(self, key: str, created_at: float, files: dict = None, uploaded=False, protected=False) -> None:
+        self.key = key
+        self.created_at = created_at
+        self.files = files if files is not None else {}  # filename -> size
+        self.uploaded = uploaded
+        self.protected = protected
+
+    @property
+    def size(self):
+        return sum(self.files.values())
+
+    @property
+    def evictable(self):
+        return self.uploaded and not self.protected
+
+    def as_dict(self):
+        return {'created_at': self.created_at, 'files': self.files, 'uploaded': self.uploaded, 'protected': self.protected}
+
+    def __repr__(self) -> str:
+        return f'CaptureEntry[{self.key}: files= {len(self.files)}, size= {self.size}, uploaded= {self.uploaded}, protected= {self.protected}]'
+
+
+class CapturesManager:
+    """
+    Keeps the captures folder within its quota.
+
+    Files are grouped by the accident they belong to (the timestamp their names start with)
+    in an index persisted next to them, so startup reads one file instead of stating all.
+    Uploaded accidents that aren't protected are evicted oldest first when the folder
+    grows past `quota` bytes or the card has less than `reserve` bytes free. A reserve
+    file of `reserve` bytes is kept preallocated and released right before a video is
+    saved, so the write of the next accident can't run out of space.
+    """
+
+    def __init__(self, dirpath: str, quota: int, reserve: int) -> None:
+        self.dirpath = dirpath
+        self.quota = quota
+        self.reserve = reserve
+        self.logger = Logger("Captures")
+        self.lock = Lock()
+        self.entries = {}
+        self.opened = False
+        # Metrics
+        registry.gauge('captures_bytes', 'Bytes used by captures.').set_function(lambda: sum(entry.size for entry in list(self.entries.values())))
+        registry.gauge('captures_count', 'Accidents kept in captures.').set_function(lambda: len(self.entries))
+        self.evicted = registry.counter('captures_evicted_total', 'Accidents evicted from captures.')
+
+    @staticmethod
+    def key_of(filename: str):
+        """ Returns the accident key of a captures file ('1700000000000_tx.mp4' -> '1700000000000'). """
+        return filename.split('.', 1)[0].split('_', 1)[0]
+
+    @property
+    def used_bytes(self):
+        with self.lock:
+            return sum(entry.size for entry in self.entries.values())
+
+    def open(self):
+        os.makedirs(self.dirpath, exist_ok=True)
+        with self.lock:
+            if not self.__load_index():
+                self.logger.warning("Captures index is missing. Rebuilding it...")
+                self.__rebuild_index()
+                self.__save_index()
+            self.opened = True
+        self.logger.success(f"Opened captures with {len(self.entries)} accident(s) | Used= {self.used_bytes / (1024 * 1024):.1f} MB")
+        self.maintain()
+
+    def track(self, key: str):
+        """ Adds or refreshes the files of the accident in the index. """
+        with self.lock:
+            if not self.opened:
+                return
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = CaptureEntry(key, current_time())
+            entry.files = {}
+            with os.scandir(self.dirpath) as files:
+                for file in files:
+                    if not file.name.startswith('.') and self.key_of(file.name) == key and file.is_file():
+                        entry.files[file.name] = file.stat().st_size
+            self.__save_index()
+
+    def mark_uploaded(self, key: str):
+        with self.lock:
+            if not self.opened:
+                return
+            entry = self.entries.get(key)
+            if entry is not None and not entry.uploaded:
+                entry.uploaded = True
+                self.__save_index()
+
+    def protect(self, key: str, protected=True):
+        """ Protected accidents are never evicted (kept as evidence or until they're reported). """
+        with self.lock:
+            if not self.opened:
+                return
+            entry = self.entries.get(key)
+            if entry is None:
+                if not protected:
+                    return
+                # Files of the accident may not be saved yet, they're tracked into it later
+                entry = self.entries[key] = CaptureEntry(key, current_time())
+            if entry.protected != protected:
+                entry.protected = protected
+                self.__save_index()
+
+    def release_reserve(self):
+        """ Frees the reserved space for the video about to be saved. """
+        try:
+            os.remove(self.__reserve_path())
+        except FileNotFoundError:
+            pass
+
+    def maintain(self, background=False):
+        """ Evicts accidents over quota then restores the reserve. """
+        if background:
+            Thread(name="CapturesMaintenance", target=self.maintain, daemon=True).start()
+            return
+        try:
+            self.__evict()
+            self.__make_reserve()
+        except Exception as e:
+            self.logger.error(f"Can't maintain captures. Reason: {e}")
+
+    # Internals
+
+    def __index_path(self):
+        return os.path.join(self.dirpath, INDEX_FILENAME)
+
+    def __reserve_path(self):
+        return os.path.join(self.dirpath, RESERVE_FILENAME)
+
+    def __load_index(self):
+        try:
+            with open(self.__index_path(), 'r') as file:
+                saved = json.load(file)
+        except (OSError, ValueError):
+            return False
+        self.entries = {key: CaptureEntry(key, **fields) for key, fields in saved.items()}
+        return True
+
+    def __save_index(self):
+        tmp_path = f"{self.__index_path()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump({key: entry.as_dict() for key, entry in self.entries.items()}, file)
+        os.replace(tmp_path, self.__index_path())
+
+    def __rebuild_index(self):
+        self.entries = {}
+        with os.scandir(self.dirpath) as files:
+            for file in files:
+                if file.name.startswith('.') or not file.is_file():
+                    continue
+                stat = file.stat()
+                key = self.key_of(file.name)
+                entry = self.entries.get(key)
+                if entry is None:
+                    entry = self.entries[key] = CaptureEntry(key, stat.st_mtime)
+                entry.created_at = min(entry.created_at, stat.st_mtime)
+                entry.files[file.name] = stat.st_size
+
+    def __free_bytes(self):
+        stat = os.statvfs(self.dirpath)
+        free = stat.f_bavail * stat.f_frsize
+        # Reserve file is ours to release, don't count it as used
+        if os.path.exists(self.__reserve_path()):
+            free += os.path.getsize(self.__reserve_path())
+        return free
+
+    def __evict(self):
+        with self.lock:
+            used = sum(entry.size for entry in self.entries.values())
+            free = self.__free_bytes()
+            if used <= self.quota and free >= self.reserve:
+                return
+            for entry in sorted(self.entries.values(), key=lambda entry: entry.created_at):
+                if used <= self.quota and free >= self.reserve:
+                    break
+                if not entry.evictable:
+                    continue
+                for filename in entry.files:
+                    try:
+                        os.remove(os.path.join(self.dirpath, filename))
+                    except FileNotFoundError:
+                        pass
+                used -= entry.size
+                free += entry.size
+                del self.entries[entry.key]
+                self.evicted.inc()
+                self.logger.info(f"Evicted uploaded accident {entry.key} ({entry.size / 1024:.0f} KB).")
+            self.__save_index()
+        if used > self.quota or free < self.reserve:
+            self.logger.warning(f"Captures are still over budget with nothing left to evict | Used= {used} Free= {free}")
+
+    def __make_reserve(self):
+        path = self.__reserve_path()
+        if os.path.exists(path) and os.path.getsize(path) == self.reserve:
+            return
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                os.posix_fallocate(fd, 0, self.reserve)
+            except (AttributeError, OSError):
+                # Write it out where blocks can't be allocated upfront
+                os.ftruncate(fd, 0)
+                zeros = b'\0' * (1024 * 1024)
+                for offset in range(0, self.reserve, len(zeros)):
+                    os.write(fd, zeros[:self.reserve - offset])
+        finally:
+            os.close(fd)
+
+
+# Shared by the whole system
+captures = CapturesManager(utils.captures_dir_path(), CapturesConstants.QUOTA_BYTES, CapturesConstants.RESERVE_BYTES)
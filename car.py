@@ -1,9 +1,16 @@
 
-from time import sleep
+import signal
+import asyncio
+from time import sleep, perf_counter_ns
 from json import dumps as to_json
-from threading import Thread, Event
+from threading import Event
 
 from logger import Logger
+from tracing import tracer
+from metrics import registry
+from blackbox import recorder
+from scheduler import Scheduler
+from supervisor import Heartbeat
 from crash_reporter import CarKeys
 from constants import IS_TESTING, IOPins
 
@@ -46,77 +53,110 @@ class CrashDetectorCallback:
 
 class CrashDetector:
 
-    def __init__(self, callback: CrashDetectorCallback, power_signal: Event, detection_signal: Event) -> None:
+    def __init__(self, callback: CrashDetectorCallback, power_signal: Event, detection_signal: Event, scheduler: Scheduler) -> None:
         self.logger = Logger("Car:CrashDetector")
         # Callback & Signals
         self.callback = callback
         self.power_signal = power_signal
         self.detection_signal = detection_signal
+        self.scheduler = scheduler
+        self.resumed = None  # asyncio.Event mirroring detection_signal on the loop
+        self.heartbeat = Heartbeat()
+        self.poll_interval = 0.1  # Secs, relaxed by the power manager while parked
+        # Metrics
+        self.detection_latency = registry.histogram('crash_detection_seconds', 'Max delay between the crash edge and its detection.')
 
     def start(self):
         if not self.power_signal.is_set():
             self.power_signal.set()
             self.detection_signal.set()
-            Thread(name="CrashDetector", target=self.__crash_detector_job).start()
+            self.scheduler.spawn("CrashDetector", self.__crash_detector_job)
 
     def stop(self):
         if self.power_signal.is_set():
             self.power_signal.clear()
+            self.scheduler.cancel("CrashDetector")
+
+    def restart(self):
+        # Re-armed too, a detector left suspended is as stuck as one that stopped polling
+        self.resume()
+        # Replaces the running task (if any)
+        self.scheduler.spawn("CrashDetector", self.__crash_detector_job)
+
+    @property
+    def detecting(self):
+        return self.power_signal.is_set() and self.detection_signal.is_set()
 
     def suspend(self):
         if self.detection_signal.is_set():
             self.detection_signal.clear()
+            self.scheduler.call(self.__sync_resumed)
             self.logger.info("Service suspended.")
 
     def resume(self):
         if not self.detection_signal.is_set():
             self.detection_signal.set()
+            self.scheduler.call(self.__sync_resumed)
             self.logger.info("Service resumed.")
 
-    def __crash_detector_job(self):
+    def __sync_resumed(self):
+        if self.resumed is None:
+            return
+        if self.detection_signal.is_set():
+            self.resumed.set()
+        else:
+            self.resumed.clear()
+
+    async def __crash_detector_job(self):
+        self.resumed = asyncio.Event()
+        self.__sync_resumed()
         # Setup gpio (if needed)
         gpio.setmode(gpio.BCM)
         gpio.setwarnings(False)
         gpio.setup(IOPins.PIN_CRASHING_BUTTON, gpio.IN, gpio.PUD_DOWN)
         prev_state = gpio.LOW
+        last_poll = perf_counter_ns()
         # Start detection
         self.logger.success("CrashDetection service started running.")
-        while self.detection_signal.wait():
-            # Check if crashing button was pressed
-            state = gpio.input(IOPins.PIN_CRASHING_BUTTON)
-            if IS_TESTING:
-                # HACK START
-                prev_state = gpio.LOW
-                self.logger.info("Simulating state LOW.")
-                sleep(5)
-                state = gpio.HIGH
-                self.logger.info("Simulating state HIGH.")
-                # HACK END
-            if prev_state != state:
-                if prev_state == gpio.LOW and state == gpio.HIGH:
-                    # Crashhhhhhhhhhhhh ~(@-^-@)~
-                    self.suspend()  # Suspend thread.
-                    self.logger.info("Crash detected. Notifying system...")
-                    self.callback.on_accident_happened()  # Notify callback.
-                # Update previous state
-                prev_state = state
-            # Stop detection if power signal is not set
-            if not self.power_signal.is_set():
-                self.logger.info("Stopping service...")
-                self.suspend()
-                break
-            sleep(0.1)
-        gpio.cleanup(assert_exists=False)
-        self.logger.info("CrashDetection service stopped running.")
+        try:
+            while self.power_signal.is_set():
+                # Sleep while suspended instead of polling
+                if not self.resumed.is_set():
+                    await self.resumed.wait()
+                    last_poll = perf_counter_ns()
+                    continue
+                self.heartbeat.beat()
+                # Check if crashing button was pressed
+                state = gpio.input(IOPins.PIN_CRASHING_BUTTON)
+                polled_at = perf_counter_ns()
+                if prev_state != state:
+                    recorder.record_detector(1.0 if state == gpio.HIGH else 0.0, self.power_signal.is_set(), self.detection_signal.is_set())
+                    if prev_state == gpio.LOW and state == gpio.HIGH:
+                        # Crashhhhhhhhhhhhh ~(@-^-@)~
+                        # Edge happened somewhere since the previous poll
+                        tracer.record("detect", last_poll, polled_at)
+                        self.detection_latency.observe((polled_at - last_poll) / 1e9)
+                        self.suspend()  # Suspend detection.
+                        self.logger.info("Crash detected. Notifying system...")
+                        # Handling the accident blocks for secs, keep it off the loop
+                        self.scheduler.spawn("AccidentHandler", self.scheduler.to_thread, self.callback.on_accident_happened)
+                    # Update previous state
+                    prev_state = state
+                last_poll = polled_at
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            gpio.cleanup(assert_exists=False)
+            self.logger.info("CrashDetection service stopped running.")
 
 
 class Car:
 
-    def __init__(self, info: CarInfo, callback: CrashDetectorCallback) -> None:
+    def __init__(self, info: CarInfo, callback: CrashDetectorCallback, scheduler: Scheduler) -> None:
         self.logger = Logger("Car")
 
         self.info = info
         self.callback = callback
+        self.scheduler = scheduler
 
         # CrashDetector signals
         self.power_signal = Event()
@@ -139,7 +179,7 @@ class Car:
         # Setup CrashDetector
         self.power_signal.clear()
         self.detection_signal.clear()
-        self.crash_detector = CrashDetector(self.callback, self.power_signal, self.detection_signal)
+        self.crash_detector = CrashDetector(self.callback, self.power_signal, self.detection_signal, self.scheduler)
 
         self.logger.success("Car is ready.")
 
@@ -266,29 +306,29 @@ class Car:
 
 
 class InterruptionService:
+    """ Calls back when the system is asked to stop (Ctrl+C or SIGTERM). """
 
     class Callback:
 
         def on_interrupt(self):
             pass
 
-    def __init__(self, callback: Callback) -> None:
+    def __init__(self, callback: Callback, scheduler: Scheduler) -> None:
         self.switcher = Event()
         self.callback = callback
+        self.scheduler = scheduler
 
     def start(self):
         if not self.switcher.is_set():
             self.switcher.set()
-            Thread(name="InterruptionService", target=self.__service_job()).start()
+            # Signals are handled by the loop, no thread has to wait for them
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                self.scheduler.add_signal_handler(signum, self.__on_signal)
 
-    def __service_job(self):
-        while self.switcher.is_set():
-            try:
-                sleep(0.05)
-            except KeyboardInterrupt:
-                self.callback.on_interrupt()
-                self.switcher.clear()
-                break
+    def __on_signal(self):
+        if self.switcher.is_set():
+            self.switcher.clear()
+            self.callback.on_interrupt()
 
 
 class TestCallback(CrashDetectorCallback):
@@ -299,6 +339,8 @@ class TestCallback(CrashDetectorCallback):
 
 
 if __name__ == '__main__':
-    car = Car(CarInfo.get_default(), TestCallback())
+    scheduler = Scheduler()
+    car = Car(CarInfo.get_default(), TestCallback(), scheduler)
     car.setup()
     car.start()
+    scheduler.run()
@@ -9,20 +9,159 @@ GPS_UART_BAUDRATE = 9600
 GSM_UART_PORT = '/dev/ttyAMA1'
 GSM_UART_BAUDRATE = 115200
 
+# Reporter backend: 'firebase' or 'local' (offline stand-in)
+REPORTER_BACKEND = 'firebase'
+
 def set_test_mode(enable: bool = False):
+    """ Switches to the emulated hardware (pc_toolkit).
+
+    Modules read IS_TESTING once they're imported, so call it before importing them.
+    """
+    global IS_TESTING
     IS_TESTING = enable
 
 class IOPins:
     PIN_CRASHING_BUTTON = 17 # BCM numbering mode
+    PIN_IGNITION = None  # Optional ignition sense input (HIGH while on), None if not wired
 
 class FirebaseConstants:
 
     # FCM
     TOKEN_REFERENCE = "tokens"
+    TOKENS_TTL = 600  # Secs between background refreshes
+    TOKENS_HARD_LIMIT = 86400  # Secs before the alert path kicks a refresh itself
+    TOKENS_FETCH_TIMEOUT = 5.0  # Secs the alert path waits for tokens when none are cached
+    MULTICAST_BATCH_SIZE = 500  # Max tokens FCM accepts per multicast
+    MESSAGE_MAX_BYTES = 4096  # Max bytes of the data (keys & values) FCM accepts per message
+    SEND_POOL_SIZE = 8
+    SEND_MAX_ATTEMPTS = 3
+    SEND_RETRY_DELAY = 0.5  # Secs
 
     # Storage
     STORAGE_BUCKET_URL = "aas-for-sl.appspot.com"
+    UPLOAD_MAX_RATE = None  # Bytes per sec, cap it on slow links to leave room for alerts
+    UPLOAD_TARGET_CHUNK_SECS = 2.0
 
     # Firebase app
+    HTTP_TIMEOUT = 10  # Secs of database requests
     DATABASE_URL = "https://aas-for-sl-default-rtdb.firebaseio.com/"
     CREDENTIALS_FILE_PATH = "data/aas-for-sl-firebase-adminsdk-dznrq-b0280663c2.json"
+
+
+class MetricsConstants:
+    EXPORT_HOST = '127.0.0.1'
+    EXPORT_PORT = 9101  # Prometheus text at http://host:port/metrics
+    SNAPSHOT_INTERVAL = 60  # Secs
+
+
+class BlackBoxConstants:
+    EXPORT_BEFORE = 120  # Secs of history exported before the crash
+    EXPORT_AFTER = 15  # Secs exported after the crash
+    FSYNC_INTERVAL = 5  # Secs
+
+
+class SupervisorConstants:
+    CHECK_INTERVAL = 1.0  # Secs between heartbeat checks
+    WATCHDOG_PATH = '/dev/watchdog'  # None to run without the hardware watchdog
+    RESTART_BASE_DELAY = 2.0  # Secs, doubled on every failed restart
+    RESTART_MAX_DELAY = 60.0
+    DETECTOR_TIMEOUT = 2.0  # Secs without a beat before a component is stalled
+    DETECTOR_MAX_SUSPENDED = 120.0  # Secs an accident may keep the detector suspended before it's re-armed
+    CAMERA_TIMEOUT = 5.0
+    GPS_TIMEOUT = 10.0
+
+
+class PowerConstants:
+    CHECK_INTERVAL = 1.0  # Secs between power state evaluations
+    DRIVING_SPEED = 5.0  # km/h, anything slower is standing still
+    FIX_MAX_AGE = 30  # Secs before the last GPS speed is no longer trusted
+    IDLE_AFTER = 60  # Secs standing still before going idle
+    PARKED_AFTER = 600  # Secs standing still before parking
+    IGNITION_OFF_GRACE = 30  # Secs with the ignition off before parking
+    WAKE_LATENCY_BUDGET = 2.0  # Secs from a wake trigger to full capture
+    MOTION_THRESHOLD = 12.0  # Mean abs pixel difference that wakes a parked unit
+    # Camera (resolution, framerate) per power state
+    CAMERA_PROFILES = {
+        'driving': ((640, 480), 15),
+        'idle': ((640, 480), 10),
+        'parked': ((320, 240), 2),
+    }
+    # Secs between crash detector polls per power state
+    DETECTOR_POLL_INTERVALS = {
+        'driving': 0.1,
+        'idle': 0.1,
+        'parked': 0.25,
+    }
+
+
+class GeoIndexConstants:
+    CELL_SIZE = 0.05  # Degrees (about 5.5 km) per grid cell
+    NEAREST_COUNT = 3  # Facilities sent with every alert
+    MAX_DISTANCE = 100000  # Meters, farther facilities aren't worth sending
+    STREET_MAX_DISTANCE = 200  # Meters off the road before there's no street
+
+
+class MemoryConstants:
+    BUDGET_FRACTION = 0.5  # Of the memory available at startup the buffers may take
+    BUDGET_LIMIT = None  # Bytes, caps the budget (None to take the whole fraction)
+    FALLBACK_AVAILABLE = 512 * 1024 * 1024  # Bytes assumed available if it can't be read
+    TELEMETRY_SHARE = 0.02  # Of the budget for the GPS/telemetry rings
+    ENCODE_SHARE = 0.15  # Of the budget for encode scratch space, the rest is for the video rings
+    # Capture resolutions, best first
+    RESOLUTIONS = ((1280, 720), (960, 540), (640, 480), (480, 360), (320, 240))
+    MAX_DURATION = 10  # Secs of pre-roll (& post-roll) when memory allows
+    PREFERRED_DURATION = 5  # Secs kept before trading resolution for duration
+    MIN_DURATION = 2
+    QUEUED_VIDEOS = 1  # Accidents whose video waits for the one being saved, later ones are reported without video
+    ENCODE_THREAD_FRAMES = 24  # Frames an encoder thread keeps around (lookahead & references)
+    TELEMETRY_RECORD_SIZE = 96  # Bytes a buffered telemetry record takes in memory
+    CHECK_INTERVAL = 5.0  # Secs between memory pressure checks
+    LOW_WATERMARK = 48 * 1024 * 1024  # Bytes available below which buffers shrink
+    HIGH_WATERMARK = 128 * 1024 * 1024  # Bytes that must stay available after buffers grow back
+
+
+class KeyframeConstants:
+    COUNT = 4  # Keyframes picked per accident
+    BUDGET = 0.2  # Secs picking & encoding them may take
+    WINDOW = 2.0  # Secs around the crash keyframes are picked from
+    CANDIDATES = 24  # Frames of the window that are scored
+    SCORING_WIDTH = 160  # Pixels, frames are scored on copies this wide
+    SHARPNESS_WEIGHT = 0.6  # Of the score, the rest is motion energy
+    MIN_GAP = 0.25  # Secs between picked keyframes
+    JPEG_WIDTH = 320
+    JPEG_QUALITY = 70
+    THUMBNAIL_WIDTH = 96  # Pixels of the thumbnail sent inline with the alert
+    THUMBNAIL_QUALITIES = (60, 45, 30, 20)  # Tried in order until the thumbnail fits the alert
+
+
+class RedactionConstants:
+    ENABLED = False  # Blur faces & plates before videos leave the unit
+    CASCADES = ('haarcascade_frontalface_default.xml', 'haarcascade_russian_plate_number.xml')
+    # Searched after the ones bundled with OpenCV
+    CASCADES_DIRS = ('/usr/share/opencv4/haarcascades', '/usr/share/opencv/haarcascades', 'data/haarcascades')
+    DETECTION_WIDTH = 320  # Pixels, frames are scanned on copies this wide
+    DETECT_EVERY = 5  # Frames between detections, boxes of the frames in between are interpolated
+    MATCH_IOU = 0.3  # Overlap for boxes of two detections to be the same object
+    PADDING = 0.15  # Of the box size added around boxes (covers motion between detections)
+    MIN_SIZE = 16  # Pixels of the smallest box detected on the scanned copies
+    WORKERS = None  # Detector processes (None for all cores but one)
+    TIMEOUT = 60  # Secs detection of a clip may take
+    KEYFRAMES_TIMEOUT = 2.0  # Secs detection of the keyframes may take (they hold the alert back)
+    FAIL_CLOSED = True  # Blur whole frames if detection fails
+
+
+class OutboxConstants:
+    OPEN_TIMEOUT = 5.0  # Secs an accident waits for the outbox to open while booting
+
+
+class CapturesConstants:
+    QUOTA_BYTES = 8 * 1024 * 1024 * 1024  # Half of a 16 GB card
+    RESERVE_BYTES = 128 * 1024 * 1024  # Kept free for the next accident
+
+
+class TranscodeConstants:
+    CODECS = ('h264_v4l2m2m', 'libx264')  # Tried in order, the Pi's hardware encoder first
+    TARGET_UPLOAD_SECS = 60  # Upload time videos are sized for
+    ASSUMED_UPLINK_RATE = 32 * 1024  # Bytes per sec until the uplink is measured
+    MIN_DURATION = 4.0  # Secs kept around the crash when trimming
+    TIMEOUT = 120  # Secs
@@ -1,15 +1,34 @@
+import os
 import utils
-import firebase_admin
 from logger import Logger
-from firebase_admin import (
-    db,
-    storage,
-    messaging,
-    credentials,
-)
-from constants import FirebaseConstants
-
-from json import dumps as to_json
+from constants import REPORTER_BACKEND, FirebaseConstants, BlackBoxConstants
+from outbox import AccidentOutbox, OutboxEntry
+from tracing import tracer
+from metrics import registry
+from transcoder import Transcoder
+from uploader import ThroughputEstimator
+from reporter_backend import ReporterBackend
+from blackbox import BlackBoxRecorder, RecordType
+from captures import captures
+from package import PackageBuilder, PackageReader, PartNames, ContentTypes, PACKAGE_VERSION
+
+from time import sleep, perf_counter_ns, time as current_time
+from json import dumps as to_json, loads as from_json
+from concurrent.futures import ThreadPoolExecutor
+
+
+def create_backend(name: str) -> ReporterBackend:
+    """ Creates the reporter backend by its name ('firebase' or 'local').
+
+    Backends are imported lazily so the local one runs without firebase_admin installed.
+    """
+    if name == 'firebase':
+        from firebase_backend import FirebaseBackend
+        return FirebaseBackend()
+    if name == 'local':
+        from local_backend import LocalBackend
+        return LocalBackend()
+    raise ValueError(f"Unknown reporter backend '{name}'.")
 
 
 class CarKeys:
@@ -32,175 +51,387 @@ class AccidentKeys:
     LATITUDE = 'lat'
     LONGITUDE = 'lng'
     VIDEO = 'video'
+    PACKAGE = 'package'
+    PACKAGE_REF = 'package_ref'
+    VIDEO_RANGE = 'video_range'  # Http byte range of the video part in the package
     TIMESTAMP = 'timestamp'
+    STAGE = 'stage'
+    FACILITIES = 'facilities'
+    STREET = 'street'
+    VIDEO_QUALITY = 'video_quality'
+    THUMBNAIL = 'thumbnail'
 
 
 class Accident:
 
-    def __init__(self, lat, lng, timestamp, video_filename) -> None:
+    def __init__(self, lat, lng, timestamp, video_filename, facilities=None, street=None, video_quality=None, thumbnail=None) -> None:
         self.lat = lat
         self.lng = lng
         self.timestamp = timestamp
         self.video_filename = video_filename
+        self.facilities = facilities if facilities is not None else []  # Nearest emergency facilities
+        self.street = street  # Street the accident happened on (if known)
+        self.video_quality = video_quality  # Frames coverage of the video (if saved)
+        self.thumbnail = thumbnail  # Base64 JPEG of the best keyframe (if it fits the alert)
 
     def as_dict(self, car):
+        # FCM data only carries strings, nested values are sent as json
         return {
             AccidentKeys.LATITUDE: f"{self.lat}",
             AccidentKeys.LONGITUDE: f"{self.lng}",
             AccidentKeys.TIMESTAMP: f"{self.timestamp}",
             AccidentKeys.VIDEO: self.video_filename,
+            AccidentKeys.FACILITIES: to_json(self.facilities, separators=(',', ':')),
+            AccidentKeys.STREET: to_json(self.street, separators=(',', ':')) if self.street is not None else "",
+            AccidentKeys.VIDEO_QUALITY: to_json(self.video_quality, separators=(',', ':')) if self.video_quality is not None else "",
+            AccidentKeys.THUMBNAIL: self.thumbnail or "",
             CarKeys.CAR_ID: car.chassis_id,
             CarKeys.CAR_MODEL: car.model,
             CarKeys.CAR_OWNER: car.owner,
             CarKeys.EMERGENCY: car.emergency_contacts
         }
 
+    def alert_room(self, car):
+        """ Returns bytes left for the thumbnail in the alert (FCM caps the data of a message). """
+        payload = self.as_dict(car)
+        payload[AccidentKeys.STAGE] = ReportingStages.ALERT
+        used = sum(len(key.encode()) + len(str(value).encode()) for key, value in payload.items())
+        return FirebaseConstants.MESSAGE_MAX_BYTES - used
+
     def as_json(self, car):
         return to_json(self.as_dict(car), indent=2)
 
+    @staticmethod
+    def metadata_of(payload: dict[str, str]):
+        """ Types back the values of an accident payload (FCM only carries strings).
+
+        Returns:
+            dict: Metadata of the accident package.
+        """
+        def typed(key, cls):
+            try:
+                return cls(payload.get(key, ""))
+            except ValueError:
+                return None
+
+        def decoded(key, default):
+            try:
+                return from_json(payload.get(key) or "") or default
+            except ValueError:
+                return default
+
+        emergency = payload.get(CarKeys.EMERGENCY, "") or ""
+        return {
+            'version': PACKAGE_VERSION,
+            AccidentKeys.TIMESTAMP: typed(AccidentKeys.TIMESTAMP, int),
+            AccidentKeys.LATITUDE: typed(AccidentKeys.LATITUDE, float),
+            AccidentKeys.LONGITUDE: typed(AccidentKeys.LONGITUDE, float),
+            AccidentKeys.VIDEO: payload.get(AccidentKeys.VIDEO, "") or None,
+            AccidentKeys.FACILITIES: decoded(AccidentKeys.FACILITIES, []),
+            AccidentKeys.STREET: decoded(AccidentKeys.STREET, None),
+            AccidentKeys.VIDEO_QUALITY: decoded(AccidentKeys.VIDEO_QUALITY, None),
+            'car': {
+                CarKeys.CAR_ID: payload.get(CarKeys.CAR_ID),
+                CarKeys.CAR_MODEL: payload.get(CarKeys.CAR_MODEL),
+                CarKeys.CAR_OWNER: payload.get(CarKeys.CAR_OWNER),
+                CarKeys.EMERGENCY: [contact.strip() for contact in emergency.split(',') if contact.strip()],
+            },
+        }
+
+
+class ReportingStages:
+    ALERT = 'alert'
+    UPLOAD = 'upload'
+    VIDEO_READY = 'video_ready'
+
 
-class AccidentReporter:
+class AccidentReporter(AccidentOutbox.Callback):
 
-    def __init__(self) -> None:
+    def __init__(self, backend: ReporterBackend = None) -> None:
         self.setup_done = False
         self.logger = Logger("AccidentReporter")
+        self.backend = backend
+        # Created on setup, once the storage measuring the uplink is
+        self.transcoder = None
+        self.outbox = AccidentOutbox(utils.outbox_file_path(), self)
+        self.stages_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ReportingStage")
+        # Videos still being redacted & encoded: filename -> future
+        self.video_jobs = {}
+        # Black box the packages export the window of their accident from (if it's recording)
+        self.recorder = None
+        self.export_after = BlackBoxConstants.EXPORT_AFTER
 
     def setup(self):
-        self.logger.info("Initializing AccidentReporter...")
-        cred = credentials.Certificate(FirebaseConstants.CREDENTIALS_FILE_PATH)
-        firebase_admin.initialize_app(cred, {
-            'databaseURL': FirebaseConstants.DATABASE_URL,
-            'storageBucket': FirebaseConstants.STORAGE_BUCKET_URL
-        })
+        # Backend (& its sdk) is imported here so it doesn't delay arming the crash detector
+        if self.backend is None:
+            self.backend = create_backend(REPORTER_BACKEND)
+        self.logger.info(f"Initializing AccidentReporter on {type(self.backend).__name__}...")
+        self.backend.setup()
 
         self.logger.info("Initializing Storage...")
-        self.storage = FirebaseStorage()
+        self.storage = self.backend.create_storage()
 
-        self.logger.info("Initializing FCM...")
-        self.fcm = FirebaseCloudMessaging()
+        self.logger.info("Initializing Messaging...")
+        self.messaging = self.backend.create_messaging()
+
+        # Size videos by the uplink throughput the storage measures
+        uploader = getattr(self.storage, 'uploader', None)
+        self.transcoder = Transcoder(uploader.estimator if uploader is not None else ThroughputEstimator())
 
         self.logger.success("AccidentReporter is ready.")
 
-    def report_accident(self, accident_payload: dict[str, str]):
-        self.logger.info("Preparing to report an accident.")
+    def open_outbox(self):
+        # Accidents are queued while the backend is down or still starting, only draining waits for it
+        self.logger.info("Opening accidents outbox...")
+        self.outbox.open()
+
+    def start(self):
+        self.messaging.start()
+        # Drain accidents left over from previous runs too
+        self.outbox.start()
+
+    def stop(self):
+        self.outbox.stop()
+        self.messaging.stop()
+
+    def submit_accident(self, accident_payload: dict[str, str], video_job=None):
+        """ Queues the accident in the outbox to be reported in background.
+
+        Args:
+            video_job (concurrent.futures.Future): Resolves to the payload fields of the video once
+                it's captured & saved (None if it couldn't be), the upload waits for it while the
+                alert goes out.
+
+        Returns:
+            bool: True if the accident was recorded in the outbox, False otherwise.
+        """
         # Check payload first
         if accident_payload is None or len(accident_payload) == 0:
             self.logger.error("Accident is either None or Empty. Aborted reporting.")
             return False
 
-        # Obtain video filename and path from payload
-        filename = accident_payload.get(AccidentKeys.VIDEO, "")
-        filepath = utils.get_capture_file_path(filename)
+        # Alert is sent even without a video
+        filename = accident_payload.get(AccidentKeys.VIDEO, "") or ""
+        if not utils.isempty(filename) and video_job is not None:
+            self.video_jobs[filename] = video_job
+        elif utils.isempty(filename) or not utils.capture_file_exists(filename):
+            self.logger.warning("Can't find video file associated with this accident. Reporting it without video.")
+            filename = ""
 
-        # Check filename and path
-        if utils.isempty(filename) or not utils.capture_file_exists(filename):
-            self.logger.error("Can't find video file associated with this accident.")
-            return False
+        entry_id = self.outbox.enqueue(accident_payload, filename)
+        # Kept in captures until it's reported, even if it ends up dead in the outbox
+        captures.protect(accident_payload.get(AccidentKeys.TIMESTAMP, ""))
+        self.logger.info(f"Accident was queued for reporting as #{entry_id}.")
+        return True
 
-        self.logger.info("Reporting accident...")
-        # Upload video to storage
-        self.logger.info(f"Preparing to upload file '{filepath}' ...")
-        uploaded = self.storage.upload_file(filepath, filename)
-        if not uploaded:
+    def report_accident(self, accident_payload: dict[str, str]):
+        """ Reports the accident right away on the calling thread without going through the outbox. """
+        if accident_payload is None or len(accident_payload) == 0:
+            self.logger.error("Accident is either None or Empty. Aborted reporting.")
             return False
+        filename = accident_payload.get(AccidentKeys.VIDEO, "") or ""
+        entry = OutboxEntry(None, current_time(), accident_payload, filename, 0, set())
+        return self.run_pipeline(entry)
 
-        # Send push notification to client app
-        sent = self.fcm.send_notification(accident_payload)
-
-        return uploaded and sent
+    def on_drain_entry(self, entry: OutboxEntry) -> bool:
+        self.logger.info(f"Reporting queued accident #{entry.id} (attempt {entry.attempts + 1})...")
+        return self.run_pipeline(entry)
 
+    def run_pipeline(self, entry: OutboxEntry) -> bool:
+        """ Reports the accident in stages, skipping the ones done in previous attempts.
 
-class FirebaseStorage:
-
-    def __init__(self) -> None:
-        self.logger = Logger("Storage")
-        self.bucket = storage.bucket()
-
-    def upload_file(self, filepath: str, filename: str):
+        The alert goes out immediately while the video uploads concurrently,
+        then a follow-up tells clients the video is ready to be fetched.
         """
-        Uploads the video in filepath to firebase storage.
+        latencies = {}
+        has_video = not utils.isempty(entry.video) and (entry.video in self.video_jobs or utils.capture_file_exists(entry.video))
+        if not utils.isempty(entry.video) and not has_video:
+            self.logger.error(f"Video file '{entry.video}' of accident #{entry.id} is gone. Reporting it without video.")
+
+        # Alert & upload run side by side
+        alert_job = self.stages_pool.submit(self.__run_stage, entry, ReportingStages.ALERT, self.__send_alert, latencies)
+        upload_job = self.stages_pool.submit(self.__run_stage, entry, ReportingStages.UPLOAD, self.__upload_package, latencies) if has_video else None
+        alerted = alert_job.result()
+        uploaded = upload_job.result() if has_video else False
+
+        # Follow up once the video is in storage
+        video_ready = uploaded and self.__run_stage(entry, ReportingStages.VIDEO_READY, self.__send_video_ready, latencies)
+
+        self.__log_latencies(entry, latencies)
+        accident_id = self.__accident_id(entry)
+        if accident_id is not None:
+            tracer.close(accident_id)
+        self.__dump_trace(entry)
+        if has_video:
+            # Index the package & trace, uploaded accidents become evictable
+            key = captures.key_of(entry.video)
+            captures.track(key)
+            if uploaded:
+                captures.mark_uploaded(key)
+        reported = alerted and (video_ready or not has_video)
+        if reported and accident_id is not None:
+            captures.protect(f"{accident_id}", False)
+        return reported
 
-        [Note]: This method while executing is sure about given filepath and filename existence
-        as it's only called (and should only be called) from 'firebase.report_accident' which does checks on path and filename.
-
-        Args:
-            filepath (str): Path to the video file (Relative path).\n
-            filename (str): Name of the video file.
-        """
-        # Upload the file
+    @staticmethod
+    def __accident_id(entry: OutboxEntry):
         try:
-            self.logger.info("Uploading video of the accident...")
-            remote_path = filename
-            blob_file = self.bucket.blob(remote_path)
-            blob_file.upload_from_filename(filepath)
-            self.logger.success("Video uploaded successfully.")
-            return True
+            return int(entry.payload.get(AccidentKeys.TIMESTAMP, ""))
+        except ValueError:
+            return None
+
+    def __dump_trace(self, entry: OutboxEntry):
+        accident_id = self.__accident_id(entry)
+        if accident_id is None or not utils.captures_dir_exists():
+            return
+        try:
+            tracer.dump_chrome_trace(accident_id, utils.get_trace_file_path(accident_id))
         except Exception as e:
-            # self.logger.error(e.args[0])
-            self.logger.error(f"Can't upload video to remote storage. Reason: {e}")
-            return False
-
-
-class FirebaseCloudMessaging:
+            self.logger.warning(f"Can't dump trace of accident #{entry.id}. Reason: {e}")
 
-    def __init__(self) -> None:
-        self.logger = Logger("FCM")
-        # FCM runtime
-        self.tokens = {}
-        self.last_eta = ""
-
-    def refresh_tokens(self):
-        try:
-            self.logger.info("Refreshing token...")
-            ref = db.reference(FirebaseConstants.TOKEN_REFERENCE)
-
-            # Check if token was refreshed at least once
-            rcvd_data = ref.get(True)
-            tokens_map = dict(rcvd_data[0])
-            new_eta = rcvd_data[1]
-            # Update token if either eta or token changed
-            if self.last_eta != new_eta or len(self.tokens) != len(tokens_map):
-                self.tokens = tokens_map
-                self.last_eta = new_eta
-                self.logger.info(f"Tokens refreshed successfully.")
+    def __run_stage(self, entry: OutboxEntry, stage: str, job, latencies: dict):
+        if entry.done(stage):
             return True
+        started_at = perf_counter_ns()
+        try:
+            # Spans recorded down the stage (notify, token refresh...) belong to the accident
+            with tracer.bind(self.__accident_id(entry)):
+                done = bool(job(entry))
         except Exception as e:
-            # self.logger.error(e.args[0])
-            self.logger.error(f"Can't refresh tokens.")
+            self.logger.error(f"Stage '{stage}' of accident #{entry.id} failed. Reason: {e}")
+            done = False
+        ended_at = perf_counter_ns()
+        latencies[stage] = (ended_at - started_at) / 1e9
+        tracer.record(stage, started_at, ended_at, self.__accident_id(entry))
+        registry.histogram('reporting_stage_seconds', 'Duration of reporting stages.', {'stage': stage}).observe(latencies[stage])
+        if done:
+            self.outbox.mark_completed(entry, stage)
+        return done
+
+    def __send_alert(self, entry: OutboxEntry):
+        payload = dict(entry.payload)
+        payload[AccidentKeys.STAGE] = ReportingStages.ALERT
+        payload[AccidentKeys.VIDEO] = ""
+        report = self.__count_outcomes(self.messaging.send_notification(payload))
+        if report:
+            # Stamped as the alert is out, not once the other stages are done
+            self.__log_time_to_alert(entry, current_time())
+        return report
+
+    def __upload_package(self, entry: OutboxEntry):
+        if not self.__await_video(entry):
             return False
+        package_filename = utils.get_package_filename(entry.video)
+        filepath = utils.get_capture_file_path(package_filename)
+        # Package is built once so an interrupted upload resumes the same bytes
+        if not os.path.exists(filepath):
+            self.__build_package(entry, filepath)
+        self.logger.info(f"Preparing to upload package '{filepath}' ...")
+        return self.storage.upload_file(filepath, package_filename)
+
+    def __await_video(self, entry: OutboxEntry):
+        """ Waits for the video of the entry to be captured & saved if it still is in the works.
+
+        Returns:
+            bool: Whether the video file is there.
+        """
+        job = self.video_jobs.get(entry.video)
+        if job is not None:
+            with tracer.span("await_video", self.__accident_id(entry)):
+                try:
+                    # Alert went out before the post-roll, what's known of the video joins the payload now
+                    fields = job.result()
+                    if fields:
+                        self.outbox.update_payload(entry, fields)
+                except Exception as e:
+                    self.logger.error(f"Can't save video of accident #{entry.id}. Reason: {e}")
+            self.video_jobs.pop(entry.video, None)
+        # Next attempt reports it without video if it couldn't be saved
+        return utils.capture_file_exists(entry.video)
+
+    def __build_package(self, entry: OutboxEntry, filepath: str):
+        accident_id = self.__accident_id(entry)
+        blackbox_path = self.__export_blackbox(entry) if accident_id is not None else None
+        # Original stays in captures, a smaller copy may be packaged instead
+        with tracer.span("transcode", accident_id):
+            video_path = utils.get_capture_file_path(self.transcoder.prepare(entry.video))
+        with tracer.span("package", accident_id):
+            builder = PackageBuilder().add_json(PartNames.METADATA, Accident.metadata_of(entry.payload))
+            # Small parts first so clients can range-fetch them without the video
+            if accident_id is not None:
+                for rank, keyframe_path in enumerate(utils.get_keyframe_file_paths(accident_id)):
+                    builder.add_file(PartNames.preview(rank), ContentTypes.JPEG, keyframe_path)
+            if blackbox_path is not None and os.path.exists(blackbox_path):
+                track = [[timestamp, *values[:3]] for timestamp, kind, values in BlackBoxRecorder.read_export(blackbox_path) if kind == RecordType.GPS_FIX]
+                builder.add_json(PartNames.GPS_TRACK, track)
+                builder.add_file(PartNames.SENSORS, ContentTypes.BLACKBOX, blackbox_path)
+            if accident_id is not None:
+                builder.add_json(PartNames.TRACE, tracer.chrome_trace(accident_id))
+            builder.add_file(PartNames.VIDEO, ContentTypes.MP4, video_path)
+            index = builder.write(filepath)
+        self.logger.info(f"Built package of accident #{entry.id} with parts: {list(index.parts.values())}")
+
+    def __export_blackbox(self, entry: OutboxEntry):
+        """ Exports the black box window of the accident once it's recorded whole (kept across retries).
+
+        Returns:
+            str: Path of the export (it may be missing if it couldn't be exported).
+        """
+        accident_id = self.__accident_id(entry)
+        filepath = utils.get_blackbox_file_path(accident_id)
+        if self.recorder is None or os.path.exists(filepath):
+            return filepath
+        crash_time = accident_id / 1000
+        # Records after the crash keep coming in until the window ends
+        remaining = crash_time + self.export_after - current_time()
+        if remaining > 0:
+            with tracer.span("blackbox_wait", accident_id):
+                sleep(remaining)
+        try:
+            with tracer.span("blackbox_export", accident_id):
+                count = self.recorder.export(crash_time - BlackBoxConstants.EXPORT_BEFORE, crash_time + self.export_after, filepath)
+            self.logger.info(f"Exported {count} black box record(s) of accident #{entry.id}.")
+        except Exception as e:
+            self.logger.warning(f"Can't export black box of accident #{entry.id}. Reason: {e}")
+        return filepath
+
+    def __send_video_ready(self, entry: OutboxEntry):
+        # Only the package is uploaded, clients range-fetch the video out of it
+        package_filename = utils.get_package_filename(entry.video)
+        payload = {
+            AccidentKeys.STAGE: ReportingStages.VIDEO_READY,
+            AccidentKeys.TIMESTAMP: entry.payload.get(AccidentKeys.TIMESTAMP, ""),
+            CarKeys.CAR_ID: entry.payload.get(CarKeys.CAR_ID, ""),
+            AccidentKeys.PACKAGE: package_filename,
+            AccidentKeys.PACKAGE_REF: self.storage.reference_of(package_filename),
+            AccidentKeys.VIDEO_RANGE: self.__video_range_of(package_filename),
+        }
+        return self.__count_outcomes(self.messaging.send_notification(payload))
 
-    def send_notification(self, payload):
-        # Check if payload is empty
-        if utils.isempty(payload):
-            self.logger.error("Can't send notification to device. Payload is empty.")
-            return False
-
-        # Refresh token
-        refreshed = self.refresh_tokens()
-
-        # Check tokens after being refreshed
-        if not refreshed or len(self.tokens) == 0:
-            return False
+    def __video_range_of(self, package_filename: str):
+        try:
+            return PackageReader(utils.get_capture_file_path(package_filename)).index[PartNames.VIDEO].range
+        except Exception as e:
+            # Clients can still read it from the index of the package
+            self.logger.warning(f"Can't read video range of package '{package_filename}'. Reason: {e}")
+            return ""
 
-        # Send msg to each token
-        sent_msgs_count = 0
-        for client_uid in self.tokens:
-            target_token = self.tokens.get(client_uid, '')
-            if utils.isempty(target_token):
-                continue
-            try:
-                self.logger.info(f"Sending signal to client '{client_uid}'")
-                # Create the message
-                accident_msg = messaging.Message(
-                    data=payload,
-                    token=target_token
-                )
-                # Send it
-                response: str = messaging.send(accident_msg)
-                id_idx = response.find(':') + 1
-                self.logger.success(f"Notified client '{client_uid}'.")
-                sent_msgs_count += 1
-            except Exception as e:
-                self.logger.warning(f"Couldn't notify client '{client_uid}'. Reason: '{e.args[0]}'")
-
-        return sent_msgs_count > 0
+    @staticmethod
+    def __count_outcomes(report):
+        for outcome, clients in (('sent', report.sent), ('failed', report.failed), ('unregistered', report.unregistered)):
+            registry.counter('notify_results_total', 'Notifications sent per client by outcome.', {'outcome': outcome}).inc(len(clients))
+        return report
+
+    def __log_time_to_alert(self, entry: OutboxEntry, alerted_at: float):
+        accident_id = self.__accident_id(entry)
+        if accident_id is None:
+            return
+        time_to_alert = alerted_at - accident_id / 1000
+        registry.histogram('time_to_alert_seconds', 'Secs from crashes to their alerts being sent.').observe(time_to_alert)
+        self.logger.info(f"Time to alert: {time_to_alert * 1000:.0f} ms since crash.")
+
+    def __log_latencies(self, entry: OutboxEntry, latencies: dict):
+        if len(latencies) == 0:
+            return
+        stages = " | ".join(f"{stage}= {secs * 1000:.0f} ms" for stage, secs in latencies.items())
+        self.logger.info(f"Stage latencies of accident #{entry.id}: {stages}")
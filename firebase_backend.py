@@ -0,0 +1,224 @@
+import utils
+import firebase_admin
+from logger import Logger
+from firebase_admin import (
+    db,
+    storage,
+    messaging,
+    credentials,
+)
+from firebase_admin.exceptions import UnavailableError, InternalError, DeadlineExceededError
+from constants import FirebaseConstants
+from uploader import ResumableUploader
+from token_registry import TokenRegistry
+from tracing import tracer
+from reporter_backend import ReporterBackend, NotificationReport
+from package import ContentTypes
+
+from time import sleep, monotonic
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Errors worth retrying the same token for
+TRANSIENT_FCM_ERRORS = (UnavailableError, InternalError, DeadlineExceededError, messaging.QuotaExceededError)
+
+
+class FirebaseBackend(ReporterBackend):
+
+    def setup(self):
+        cred = credentials.Certificate(FirebaseConstants.CREDENTIALS_FILE_PATH)
+        firebase_admin.initialize_app(cred, {
+            'databaseURL': FirebaseConstants.DATABASE_URL,
+            'storageBucket': FirebaseConstants.STORAGE_BUCKET_URL,
+            # Database requests default to a couple of minutes, tokens are fetched in background anyway
+            'httpTimeout': FirebaseConstants.HTTP_TIMEOUT
+        })
+
+    def create_storage(self):
+        return FirebaseStorage()
+
+    def create_messaging(self):
+        return FirebaseCloudMessaging()
+
+
+class FirebaseStorage:
+
+    def __init__(self) -> None:
+        self.logger = Logger("Storage")
+        self.bucket = storage.bucket()
+        self.uploader = ResumableUploader(
+            utils.uploads_file_path(),
+            max_rate=FirebaseConstants.UPLOAD_MAX_RATE,
+            target_chunk_secs=FirebaseConstants.UPLOAD_TARGET_CHUNK_SECS
+        )
+
+    def upload_file(self, filepath: str, filename: str):
+        """
+        Uploads the video in filepath to firebase storage over a resumable session.
+
+        [Note]: This method while executing is sure about given filepath and filename existence
+        as it's only called (and should only be called) from 'firebase.report_accident' which does checks on path and filename.
+
+        Args:
+            filepath (str): Path to the video file (Relative path).\n
+            filename (str): Name of the video file.
+        """
+        # Upload the file
+        try:
+            self.logger.info("Uploading video of the accident...")
+            remote_path = filename
+            blob_file = self.bucket.blob(remote_path)
+            content_type = ContentTypes.PACKAGE if filename.endswith('.aapk') else ContentTypes.MP4
+            uploaded = self.uploader.upload(
+                filepath,
+                remote_path,
+                lambda size: blob_file.create_resumable_upload_session(content_type=content_type, size=size)
+            )
+            if uploaded:
+                self.logger.success("Video uploaded successfully.")
+            return uploaded
+        except Exception as e:
+            # self.logger.error(e.args[0])
+            self.logger.error(f"Can't upload video to remote storage. Reason: {e}")
+            return False
+
+    def reference_of(self, remote_path: str):
+        return f"gs://{self.bucket.name}/{remote_path}"
+
+
+class FirebaseCloudMessaging:
+
+    def __init__(self) -> None:
+        self.logger = Logger("FCM")
+        # FCM runtime
+        self.registry = TokenRegistry(
+            utils.tokens_file_path(),
+            fetcher=self.fetch_tokens,
+            ttl=FirebaseConstants.TOKENS_TTL,
+            hard_limit=FirebaseConstants.TOKENS_HARD_LIMIT,
+            fetch_timeout=FirebaseConstants.TOKENS_FETCH_TIMEOUT
+        )
+        self.registry.load()
+        self.tokens = {}
+
+    def start(self):
+        self.registry.start()
+
+    def stop(self):
+        self.registry.stop()
+
+    def fetch_tokens(self):
+        ref = db.reference(FirebaseConstants.TOKEN_REFERENCE)
+        rcvd_data = ref.get(True)
+        return dict(rcvd_data[0] or {}), rcvd_data[1]
+
+    def refresh_tokens(self):
+        # Use cached tokens, registry only hits the network when they're too old
+        self.tokens = self.registry.get_tokens()
+        return True
+
+    def send_notification(self, payload):
+        # Check if payload is empty
+        if utils.isempty(payload):
+            self.logger.error("Can't send notification to device. Payload is empty.")
+            return NotificationReport()
+
+        # Refresh token
+        refreshed = self.refresh_tokens()
+
+        # Check tokens after being refreshed
+        if not refreshed or len(self.tokens) == 0:
+            return NotificationReport()
+
+        # Skip clients with empty tokens
+        targets = {uid: token for uid, token in self.tokens.items() if not utils.isempty(token)}
+        report = NotificationReport()
+        started_at = monotonic()
+
+        # Fan out to all clients at once then retry the transient failures only
+        pending = targets
+        for attempt in range(FirebaseConstants.SEND_MAX_ATTEMPTS):
+            if attempt > 0:
+                sleep(FirebaseConstants.SEND_RETRY_DELAY * attempt)
+            with tracer.span(f"notify_attempt_{attempt + 1}"):
+                results = self.__send_batch(payload, pending)
+            retries = {}
+            for client_uid, result in results.items():
+                if not isinstance(result, Exception):
+                    report.sent[client_uid] = result
+                elif isinstance(result, (messaging.UnregisteredError, messaging.SenderIdMismatchError)):
+                    report.unregistered[client_uid] = result
+                elif isinstance(result, TRANSIENT_FCM_ERRORS):
+                    retries[client_uid] = pending[client_uid]
+                    report.failed[client_uid] = result
+                else:
+                    report.failed[client_uid] = result
+            # A retry settles the client, it isn't failed anymore whether it was sent or unregistered
+            for client_uid in (*report.sent, *report.unregistered):
+                report.failed.pop(client_uid, None)
+            if len(retries) == 0:
+                break
+            pending = retries
+
+        # Drop tokens of uninstalled apps so they aren't tried again
+        self.prune_tokens(report.unregistered.keys())
+
+        report.elapsed = monotonic() - started_at
+        for client_uid in report.sent:
+            self.logger.success("Notified client '%s'.", client_uid)
+        for client_uid, error in report.failed.items():
+            self.logger.warning("Couldn't notify client '%s'. Reason: '%s'", client_uid, error)
+        self.logger.info(f"Notification fan-out done. {report}")
+        return report
+
+    def prune_tokens(self, client_uids):
+        for client_uid in list(client_uids):
+            self.tokens.pop(client_uid, None)
+            self.registry.remove(client_uid)
+            try:
+                db.reference(FirebaseConstants.TOKEN_REFERENCE).child(client_uid).delete()
+                self.logger.info("Pruned unregistered token of client '%s'.", client_uid)
+            except Exception as e:
+                self.logger.warning("Couldn't prune token of client '%s'. Reason: '%s'", client_uid, e)
+
+    def __send_batch(self, payload, targets: dict):
+        """ Sends the payload to every target at once.
+
+        Uses FCM multicast when the SDK supports it and falls back to a bounded thread pool.
+
+        Returns:
+            dict: Message id (or the raised exception) of every client uid.
+        """
+        results = {}
+        client_uids = list(targets)
+        send_multicast = getattr(messaging, 'send_each_for_multicast', None) or getattr(messaging, 'send_multicast', None)
+        if send_multicast is not None:
+            batch_size = FirebaseConstants.MULTICAST_BATCH_SIZE
+            for idx in range(0, len(client_uids), batch_size):
+                batch_uids = client_uids[idx:idx + batch_size]
+                message = messaging.MulticastMessage(data=payload, tokens=[targets[uid] for uid in batch_uids])
+                try:
+                    with tracer.span("notify_batch"):
+                        batch = send_multicast(message)
+                    for client_uid, response in zip(batch_uids, batch.responses):
+                        results[client_uid] = response.message_id if response.success else response.exception
+                except Exception as e:
+                    for client_uid in batch_uids:
+                        results[client_uid] = e
+            return results
+
+        # Pool threads record their spans for the accident of the caller
+        accident = tracer.bound_accident()
+
+        def send_one(client_uid):
+            try:
+                with tracer.bind(accident), tracer.span(f"notify:{client_uid}"):
+                    return messaging.send(messaging.Message(data=payload, token=targets[client_uid]))
+            except Exception as e:
+                return e
+
+        workers = max(1, min(FirebaseConstants.SEND_POOL_SIZE, len(client_uids)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="FCM") as pool:
+            for client_uid, result in zip(client_uids, pool.map(send_one, client_uids)):
+                results[client_uid] = result
+        return results
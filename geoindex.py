@@ -0,0 +1,373 @@
+import os
+import csv
+import mmap
+import math
+import struct
+from threading import Lock
+from time import perf_counter_ns
+
+import utils
+from logger import Logger
+from metrics import registry
+from constants import GeoIndexConstants
+
+# Header: magic, version, reserved, origin lat & lng, cell size (degrees), rows, cols,
+# facilities count, road segments count, strings size
+HEADER = struct.Struct('<4sHHdddIIIII')
+# Facility: lat, lng, kind, name & phone (offsets in the strings table)
+FACILITY = struct.Struct('<ffB3xII')
+# Road segment: lat & lng of both ends, name (offset in the strings table)
+SEGMENT = struct.Struct('<ffffI')
+# Strings are stored once, prefixed by their length
+STRING_LENGTH = struct.Struct('<H')
+GEOINDEX_MAGIC = b'AAGI'
+GEOINDEX_VERSION = 1
+EARTH_RADIUS = 6371008.8  # Meters
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+class FacilityKinds:
+    HOSPITAL = 1
+    POLICE = 2
+    FIRE = 3
+    AMBULANCE = 4
+
+    NAMES = {HOSPITAL: 'hospital', POLICE: 'police', FIRE: 'fire', AMBULANCE: 'ambulance'}
+
+    @staticmethod
+    def of(name: str):
+        for kind, kind_name in FacilityKinds.NAMES.items():
+            if kind_name == name.strip().lower():
+                return kind
+        raise ValueError(f"Unknown facility kind '{name}'.")
+
+
+def distance(lat1: float, lng1: float, lat2: float, lng2: float):
+    """ Returns the great-circle distance between two points in meters. """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def segment_distance(lat: float, lng: float, lat1: float, lng1: float, lat2: float, lng2: float):
+    """ Returns the distance between a point and a road segment in meters (flat earth around the point). """
+    scale = math.cos(math.radians(lat))
+    # Meters relative to the point
+    x1, y1 = (lng1 - lng) * scale * METERS_PER_DEGREE, (lat1 - lat) * METERS_PER_DEGREE
+    x2, y2 = (lng2 - lng) * scale * METERS_PER_DEGREE, (lat2 - lat) * METERS_PER_DEGREE
+    dx, dy = x2 - x1, y2 - y1
+    length = dx * dx + dy * dy
+    t = 0.0 if length == 0 else max(0.0, min(1.0, -(x1 * dx + y1 * dy) / length))
+    return math.hypot(x1 + t * dx, y1 + t * dy)
+
+
+class GeoIndexBuilder:
+    """
+    Builds the geo index file from facilities & roads.
+
+    Facilities CSV rows are `kind,name,lat,lng,phone`, roads CSV rows are
+    `name,lat1,lng1,lat2,lng2[,lat3,lng3...]` (a polyline, split into segments).
+    """
+
+    def __init__(self, cell_size=GeoIndexConstants.CELL_SIZE) -> None:
+        self.cell_size = cell_size
+        self.facilities = []  # (lat, lng, kind, name, phone)
+        self.segments = []  # (lat1, lng1, lat2, lng2, name)
+
+    def add_facility(self, kind: int, name: str, lat: float, lng: float, phone=''):
+        self.facilities.append((lat, lng, kind, name, phone))
+        return self
+
+    def add_road(self, name: str, points: list):
+        for (lat1, lng1), (lat2, lng2) in zip(points, points[1:]):
+            self.segments.append((lat1, lng1, lat2, lng2, name))
+        return self
+
+    def load_facilities(self, filepath: str):
+        with open(filepath, 'r', newline='') as file:
+            for row in csv.reader(file):
+                if len(row) < 4 or row[0].startswith('#'):
+                    continue
+                self.add_facility(FacilityKinds.of(row[0]), row[1].strip(), float(row[2]), float(row[3]), row[4].strip() if len(row) > 4 else '')
+        return self
+
+    def load_roads(self, filepath: str):
+        with open(filepath, 'r', newline='') as file:
+            for row in csv.reader(file):
+                if len(row) < 5 or row[0].startswith('#'):
+                    continue
+                coords = [float(value) for value in row[1:]]
+                self.add_road(row[0].strip(), list(zip(coords[0::2], coords[1::2])))
+        return self
+
+    def write(self, filepath: str):
+        """ Writes the index to the file (atomically).
+
+        Returns:
+            int: Size of the file in bytes.
+        """
+        points = [(lat, lng) for lat, lng, *_ in self.facilities]
+        points += [point for lat1, lng1, lat2, lng2, _ in self.segments for point in ((lat1, lng1), (lat2, lng2))]
+        if len(points) == 0:
+            raise ValueError("Nothing to index.")
+        origin_lat = math.floor(min(lat for lat, _ in points) / self.cell_size) * self.cell_size
+        origin_lng = math.floor(min(lng for _, lng in points) / self.cell_size) * self.cell_size
+        rows = int((max(lat for lat, _ in points) - origin_lat) // self.cell_size) + 1
+        cols = int((max(lng for _, lng in points) - origin_lng) // self.cell_size) + 1
+
+        def cell_of(lat, lng):
+            row = min(rows - 1, int((lat - origin_lat) // self.cell_size))
+            col = min(cols - 1, int((lng - origin_lng) // self.cell_size))
+            return row * cols + col
+
+        strings = bytearray()
+        offsets = {}
+
+        def string(text: str):
+            if text not in offsets:
+                data = text.encode()[:0xFFFF]
+                offsets[text] = len(strings)
+                strings.extend(STRING_LENGTH.pack(len(data)) + data)
+            return offsets[text]
+
+        # Facilities are grouped by their cell
+        facility_cells = [[] for _ in range(rows * cols)]
+        for lat, lng, kind, name, phone in self.facilities:
+            facility_cells[cell_of(lat, lng)].append(FACILITY.pack(lat, lng, kind, string(name), string(phone)))
+        # Segments are listed in every cell their bounding box covers
+        segment_cells = [[] for _ in range(rows * cols)]
+        for lat1, lng1, lat2, lng2, name in self.segments:
+            record = SEGMENT.pack(lat1, lng1, lat2, lng2, string(name))
+            first, last = cell_of(min(lat1, lat2), min(lng1, lng2)), cell_of(max(lat1, lat2), max(lng1, lng2))
+            for row in range(first // cols, last // cols + 1):
+                for col in range(first % cols, last % cols + 1):
+                    segment_cells[row * cols + col].append(record)
+
+        def table(cells):
+            starts = [0]
+            for records in cells:
+                starts.append(starts[-1] + len(records))
+            return struct.pack(f'<{len(starts)}I', *starts), b''.join(b''.join(records) for records in cells), starts[-1]
+
+        facility_table, facility_records, facilities_count = table(facility_cells)
+        segment_table, segment_records, segments_count = table(segment_cells)
+        header = HEADER.pack(GEOINDEX_MAGIC, GEOINDEX_VERSION, 0, origin_lat, origin_lng, self.cell_size, rows, cols, facilities_count, segments_count, len(strings))
+        tmp_path = f"{filepath}.tmp"
+        with open(tmp_path, 'wb') as file:
+            for section in (header, facility_table, facility_records, segment_table, segment_records, strings):
+                file.write(section)
+        os.replace(tmp_path, filepath)
+        return os.path.getsize(filepath)
+
+
+class GeoIndex:
+    """
+    Offline lookup of the emergency facilities & the street around a location.
+
+    The index is a uniform lat/lng grid memory-mapped from a file built by `GeoIndexBuilder`,
+    so opening it reads the header only and a lookup touches a few cells. The nearest
+    facilities are searched ring by ring around the cell of the location until no
+    unsearched cell can be closer than the ones found.
+    """
+
+    def __init__(self, filepath: str) -> None:
+        self.filepath = filepath
+        self.logger = Logger("GeoIndex")
+        self.lock = Lock()
+        self.file = None
+        self.mm = None
+        # Metrics
+        self.lookup_latency = registry.histogram('geo_lookup_seconds', 'Duration of nearest facilities & street lookups.')
+
+    @property
+    def opened(self):
+        return self.mm is not None
+
+    def open(self):
+        with self.lock:
+            if self.mm is not None:
+                return
+            if not os.path.exists(self.filepath):
+                self.logger.warning(f"Geo index '{self.filepath}' is missing. Accidents are reported without nearby facilities.")
+                return
+            self.file = open(self.filepath, 'rb')
+            mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, _, self.origin_lat, self.origin_lng, self.cell_size, self.rows, self.cols, facilities_count, segments_count, strings_size = HEADER.unpack_from(mm)
+            if magic != GEOINDEX_MAGIC or version > GEOINDEX_VERSION:
+                mm.close()
+                self.__close()
+                raise ValueError(f"'{self.filepath}' isn't a supported geo index.")
+            # Sections follow the header back to back
+            cells = self.rows * self.cols + 1
+            view = memoryview(mm)
+            offset = HEADER.size
+            self.facility_starts = view[offset:offset + cells * 4].cast('I')
+            offset += cells * 4
+            self.facilities_offset = offset
+            offset += facilities_count * FACILITY.size
+            self.segment_starts = view[offset:offset + cells * 4].cast('I')
+            offset += cells * 4
+            self.segments_offset = offset
+            offset += segments_count * SEGMENT.size
+            self.strings_offset = offset
+            # Lookups start once everything is in place
+            self.mm = mm
+            self.logger.success(f"Opened geo index | Grid= {self.rows}x{self.cols} Facilities= {facilities_count} Segments= {segments_count}")
+
+    def close(self):
+        with self.lock:
+            self.__close()
+
+    def nearest(self, lat: float, lng: float, count=GeoIndexConstants.NEAREST_COUNT, max_distance=GeoIndexConstants.MAX_DISTANCE):
+        """ Returns up to count facilities nearest to the location (closest first), within max_distance meters.
+
+        Returns:
+            list: Facilities as dicts (kind, name, phone, lat, lng, distance).
+        """
+        if not self.opened:
+            return []
+        row, col = self.__cell_of(lat, lng)
+        # Distance covered by every ring of cells (lng degrees shrink away from the equator)
+        ring_extent = self.cell_size * METERS_PER_DEGREE * min(1.0, math.cos(math.radians(min(89.0, abs(lat) + self.cell_size))))
+        max_ring = max(row, self.rows - 1 - row, col, self.cols - 1 - col)
+        found = []
+        ring = 0
+        while ring <= max_ring:
+            for cell in self.__ring(row, col, ring):
+                for index in range(self.facility_starts[cell], self.facility_starts[cell + 1]):
+                    f_lat, f_lng, kind, name, phone = FACILITY.unpack_from(self.mm, self.facilities_offset + index * FACILITY.size)
+                    meters = distance(lat, lng, f_lat, f_lng)
+                    if meters <= max_distance:
+                        found.append((meters, f_lat, f_lng, kind, name, phone))
+            found.sort(key=lambda facility: facility[0])
+            del found[count:]
+            # Cells of the next ring are at least ring_extent * ring away
+            if ring * ring_extent > max_distance or (len(found) == count and found[-1][0] <= ring * ring_extent):
+                break
+            ring += 1
+        return [{
+            'kind': FacilityKinds.NAMES.get(kind, 'unknown'),
+            'name': self.__string(name),
+            'phone': self.__string(phone),
+            'lat': round(f_lat, 6),
+            'lng': round(f_lng, 6),
+            'distance': round(meters),
+        } for meters, f_lat, f_lng, kind, name, phone in found]
+
+    def street(self, lat: float, lng: float, max_distance=GeoIndexConstants.STREET_MAX_DISTANCE):
+        """ Returns the street nearest to the location within max_distance meters (None if none).
+
+        Returns:
+            dict: Street (name, distance).
+        """
+        if not self.opened:
+            return None
+        row, col = self.__cell_of(lat, lng)
+        rings = max(1, math.ceil(max_distance / (self.cell_size * METERS_PER_DEGREE * max(0.01, math.cos(math.radians(lat))))))
+        best = None
+        for ring in range(rings + 1):
+            for cell in self.__ring(row, col, ring):
+                for index in range(self.segment_starts[cell], self.segment_starts[cell + 1]):
+                    lat1, lng1, lat2, lng2, name = SEGMENT.unpack_from(self.mm, self.segments_offset + index * SEGMENT.size)
+                    meters = segment_distance(lat, lng, lat1, lng1, lat2, lng2)
+                    if meters <= max_distance and (best is None or meters < best[0]):
+                        best = (meters, name)
+        if best is None:
+            return None
+        return {'name': self.__string(best[1]), 'distance': round(best[0])}
+
+    def lookup(self, lat: float, lng: float):
+        """ Looks up what responders need to know about the location.
+
+        Returns:
+            tuple: Nearest facilities (list) & street (dict or None).
+        """
+        started_at = perf_counter_ns()
+        try:
+            return self.nearest(lat, lng), self.street(lat, lng)
+        except Exception as e:
+            self.logger.error(f"Can't look up location ({lat}, {lng}). Reason: {e}")
+            return [], None
+        finally:
+            self.lookup_latency.observe((perf_counter_ns() - started_at) / 1e9)
+
+    # Internals
+
+    def __cell_of(self, lat: float, lng: float):
+        # Locations off the grid are searched from its nearest edge cell
+        row = min(self.rows - 1, max(0, int((lat - self.origin_lat) // self.cell_size)))
+        col = min(self.cols - 1, max(0, int((lng - self.origin_lng) // self.cell_size)))
+        return row, col
+
+    def __ring(self, row: int, col: int, ring: int):
+        """ Yields the cells at ring cells away from (row, col) that are on the grid. """
+        if ring == 0:
+            yield row * self.cols + col
+            return
+        for r in range(row - ring, row + ring + 1):
+            if r < 0 or r >= self.rows:
+                continue
+            if r == row - ring or r == row + ring:
+                cols = range(col - ring, col + ring + 1)
+            else:
+                cols = (col - ring, col + ring)
+            for c in cols:
+                if 0 <= c < self.cols:
+                    yield r * self.cols + c
+
+    def __string(self, offset: int):
+        start = self.strings_offset + offset
+        length, = STRING_LENGTH.unpack_from(self.mm, start)
+        return self.mm[start + STRING_LENGTH.size:start + STRING_LENGTH.size + length].decode()
+
+    def __close(self):
+        if self.mm is not None:
+            # Views into the map must go before it's closed
+            self.facility_starts.release()
+            self.segment_starts.release()
+            self.mm.close()
+            self.mm = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# Shared by the whole system
+geoindex = GeoIndex(utils.geoindex_file_path())
+
+
+if __name__ == '__main__':
+    import sys
+    import random
+    import tempfile
+
+    if len(sys.argv) >= 4 and sys.argv[1] == 'build':
+        # python geoindex.py build facilities.csv roads.csv [data/geoindex.bin]
+        builder = GeoIndexBuilder().load_facilities(sys.argv[2]).load_roads(sys.argv[3])
+        target = sys.argv[4] if len(sys.argv) > 4 else utils.geoindex_file_path()
+        size = builder.write(target)
+        print(f"Indexed {len(builder.facilities)} facilities & {len(builder.segments)} road segments to '{target}' ({size / 1024:.0f} KB)")
+        sys.exit(0)
+
+    # Lookup latency over a synthetic country-sized index
+    rng = random.Random(7)
+    builder = GeoIndexBuilder()
+    for index in range(20000):
+        builder.add_facility(rng.choice(list(FacilityKinds.NAMES)), f"Facility {index}", rng.uniform(22, 31.5), rng.uniform(25, 35), f"+20{index:09d}")
+    for index in range(50000):
+        lat, lng = rng.uniform(22, 31.5), rng.uniform(25, 35)
+        builder.add_road(f"Street {index}", [(lat, lng), (lat + rng.uniform(-0.01, 0.01), lng + rng.uniform(-0.01, 0.01))])
+    filepath = os.path.join(tempfile.mkdtemp(), 'geoindex.bin')
+    print(f"Built {builder.write(filepath) / 1024:.0f} KB index")
+    index = GeoIndex(filepath)
+    index.open()
+    timings = []
+    for _ in range(1000):
+        started_at = perf_counter_ns()
+        facilities, street = index.lookup(rng.uniform(22, 31.5), rng.uniform(25, 35))
+        timings.append((perf_counter_ns() - started_at) / 1e6)
+    print(f"Lookup: p50 {utils.percentile(timings, 50):.2f} ms | p99 {utils.percentile(timings, 99):.2f} ms | max {max(timings):.2f} ms")
+    print(facilities, street)
+    index.close()
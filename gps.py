@@ -1,18 +1,32 @@
-import serial
-from time import sleep
+import asyncio
+from time import time as current_time
 from logger import Logger
-from threading import Thread, Event
+from metrics import registry
+from blackbox import recorder
+from threading import Event
+from scheduler import Scheduler
+from supervisor import Heartbeat
 from constants import GPS_UART_PORT, GPS_UART_BAUDRATE
 
 
 class GPS:
 
-    def __init__(self) -> None:
+    def __init__(self, scheduler: Scheduler) -> None:
         self.DEFAULT_LOC = (30.0346762, 31.4295489)
         self.switcher = Event()
         self.serial = None
+        self.scheduler = scheduler
+        self.buffer = bytearray()
+        self.readable = None
+        self.heartbeat = Heartbeat()
         self.logger = Logger("GPS")
         self.last_known_location = self.DEFAULT_LOC
+        self.last_fix_at = 0.0
+        self.last_speed = 0.0  # km/h
+        # Metrics
+        self.fixes_parsed = registry.counter('gps_fixes_total', 'NMEA fixes parsed.')
+        registry.gauge('gps_fix_age_seconds', 'Secs since the last fix (-1 if none yet).').set_function(
+            lambda: current_time() - self.last_fix_at if self.last_fix_at > 0 else -1)
 
     def setup(self):
         self.open_serial_port()
@@ -20,6 +34,8 @@ class GPS:
 
     def open_serial_port(self):
         try:
+            # Imported here so it doesn't slow down arming the crash detector
+            import serial
             self.serial = serial.Serial(port=GPS_UART_PORT, baudrate=GPS_UART_BAUDRATE, timeout=1)
             self.logger.success("Opened GPS serial port")
         except Exception as e:
@@ -27,12 +43,17 @@ class GPS:
 
     def start(self):
         if not self.switcher.is_set():
-            self.switcher.clear()
-            Thread(name="GPS", target=self.__gps_worker_job).start()
+            self.switcher.set()
+            self.scheduler.spawn("GPS", self.__gps_worker_job)
 
     def stop(self):
         if self.switcher.is_set():
             self.switcher.clear()
+            self.scheduler.cancel("GPS")
+
+    def restart(self):
+        # Replaces the running task, its reader is removed before the port is reopened
+        self.scheduler.spawn("GPS", self.__reopen_job)
 
     @property
     def serial_open(self):
@@ -43,35 +64,77 @@ class GPS:
         """
         return (self.serial is not None) and not self.serial.closed
 
-    def __gps_worker_job(self):
-        self.logger.info("GPS service started.")
-        while self.switcher.is_set():
-            # Open serial port if not opened
-            if not self.serial_open:
-                self.open_serial_port()
-                # sleep(1)
-            # Get location updates
+    def parse_nmea(self, line: str):
+        if line.startswith('$GPGGA'):
+            # Split line into NMEA parts
+            nema = line.split(',')
+            # Obtain lat & lng from NMEA
+            lat = float(nema[2][:2]) + float(nema[2][2:]) / 60
+            lng = float(nema[4][:3]) + float(nema[4][3:]) / 60
+            # Update last known location
+            self.last_known_location = (lat, lng)
+            self.last_fix_at = current_time()
+            self.fixes_parsed.inc()
+            recorder.record_gps(lat, lng, self.last_speed)
+            # Log
+            self.logger.debug("New location update: Lat= %s | Lng= %s", lat, lng)
+        elif line.startswith('$GPRMC'):
+            nema = line.split(',')
+            # Speed over ground is in knots
+            if nema[2] == 'A' and nema[7] != '':
+                self.last_speed = float(nema[7]) * 1.852
+
+    def __on_readable(self):
+        try:
+            data = self.serial.read(self.serial.in_waiting or 1)
+        except Exception as e:
+            self.logger.warning("Can't read GPS serial port. Reason: %s", e)
+            if not self.readable.done():
+                self.readable.set_result(False)
+            return
+        self.heartbeat.beat()
+        self.buffer.extend(data)
+        while b'\n' in self.buffer:
+            line, _, rest = self.buffer.partition(b'\n')
+            self.buffer = bytearray(rest)
             try:
-                line = self.serial.readline().decode().strip()
-                if line.startswith('$GPGGA'):
-                    # Split line into NMEA parts
-                    nema = line.split(',')
-                    # Obtain lat & lng from NMEA
-                    lat = float(nema[2][:2]) + float(nema[2][2:]) / 60
-                    lng = float(nema[4][:3]) + float(nema[4][3:]) / 60
-                    # Update last known location
-                    self.last_known_location[0] = lat
-                    self.last_known_location[1] = lng
-                    # Log
-                    self.logger.info(f"New location update: Lat= {self.last_known_location[0]} | Lng= {self.last_known_location[1]}")
-                    # Wait a sec to warmup
-                    sleep(1)
-            except Exception as e:
-                #self.logger.warning(e)
-                sleep(2)
-        self.logger.info("GPS service stopped.")
+                self.parse_nmea(line.decode(errors='replace').strip())
+            except (ValueError, IndexError):
+                # Sentence without a fix
+                pass
+
+    async def __reopen_job(self):
+        if self.serial_open:
+            self.serial.close()
+        await self.__gps_worker_job()
+
+    async def __gps_worker_job(self):
+        self.logger.info("GPS service started.")
+        loop = asyncio.get_running_loop()
+        try:
+            while self.switcher.is_set():
+                # Open serial port if not opened
+                if not self.serial_open:
+                    self.open_serial_port()
+                    if not self.serial_open:
+                        await asyncio.sleep(2)
+                        continue
+                # Sentences are parsed as they arrive, until the port fails
+                self.buffer = bytearray()
+                self.readable = loop.create_future()
+                loop.add_reader(self.serial.fileno(), self.__on_readable)
+                try:
+                    await self.readable
+                finally:
+                    loop.remove_reader(self.serial.fileno())
+                self.serial.close()
+                await asyncio.sleep(2)
+        finally:
+            self.logger.info("GPS service stopped.")
 
 if __name__ =='__main__':
-    gps = GPS()
+    scheduler = Scheduler()
+    gps = GPS(scheduler)
     gps.setup()
-    gps.start()
\ No newline at end of file
+    gps.start()
+    scheduler.run()
\ No newline at end of file
@@ -0,0 +1,261 @@
+import os
+import tty
+import asyncio
+import termios
+from threading import Thread, Event
+from time import time as current_time, monotonic, strftime, localtime
+
+from logger import Logger
+from tracing import tracer
+from utils import isempty
+from constants import GSM_UART_PORT, GSM_UART_BAUDRATE
+
+CTRL_Z = b'\x1a'
+SMS_MAX_CHARS = 160  # Of a single SMS in the GSM 7-bit alphabet
+GSM_EXTENDED_CHARS = '^{}\\[~]|'  # Take two characters of the SMS (escaped)
+BAUDRATES = {
+    9600: termios.B9600,
+    19200: termios.B19200,
+    38400: termios.B38400,
+    57600: termios.B57600,
+    115200: termios.B115200,
+}
+
+
+class ModemError(Exception):
+
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class ModemState:
+    """ Cached state of the modem so nothing has to be queried at crash time. """
+
+    def __init__(self) -> None:
+        self.ready = False
+        self.text_mode = False
+        self.registered = False
+        self.signal_quality = 99  # 99 = unknown
+        self.updated_at = 0.0
+
+    def __repr__(self) -> str:
+        return f'ModemState[ready= {self.ready}, registered= {self.registered}, csq= {self.signal_quality}]'
+
+
+class GSMModem:
+    """
+    Async AT-command driver of the GSM modem used to send SMS alerts.
+
+    The modem runs on the given event loop (or a loop thread of its own). It's configured once at setup and
+    its registration & signal are refreshed in background with one concatenated
+    command, so an alert only costs the AT+CMGS round-trips.
+    """
+
+    def __init__(self, port=GSM_UART_PORT, baudrate=GSM_UART_BAUDRATE, refresh_interval=30.0, loop=None) -> None:
+        self.port = port
+        self.baudrate = baudrate
+        self.refresh_interval = refresh_interval
+        self.logger = Logger("GSM")
+        self.state = ModemState()
+        # Runtime
+        self.fd = None
+        self.loop = loop
+        self.own_loop = loop is None
+        self.lines = None
+        self.command_lock = None
+        self.buffer = bytearray()
+        self.switcher = Event()
+        self.loop_ready_signal = Event()
+
+    def setup(self, timeout=10.0):
+        if self.own_loop:
+            Thread(name="GSM", target=self.__loop_job, daemon=True).start()
+            self.loop_ready_signal.wait()
+        asyncio.run_coroutine_threadsafe(self.__open(), self.loop).result(timeout)
+        self.logger.success(f"GSM modem is ready. {self.state}")
+
+    def start(self):
+        if not self.switcher.is_set():
+            self.switcher.set()
+            asyncio.run_coroutine_threadsafe(self.__refresh_state_job(), self.loop)
+
+    def stop(self):
+        if self.switcher.is_set():
+            self.switcher.clear()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.__close)
+            if self.own_loop:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def send_alert(self, contacts, text: str):
+        """ Sends the SMS to every contact in background.
+
+        Returns:
+            concurrent.futures.Future: Resolves to a dict of contact -> sent or not.
+        """
+        numbers = [number.strip() for number in contacts if not isempty(number)]
+        return asyncio.run_coroutine_threadsafe(self.__send_alert(numbers, text), self.loop)
+
+    async def __send_alert(self, numbers, text: str):
+        started_at = monotonic()
+        results = {}
+        # The modem takes one SMS at a time, send them back to back
+        for number in numbers:
+            try:
+                with tracer.span(f"sms:{number}"):
+                    await self.send_sms(number, text)
+                results[number] = True
+                self.logger.success("SMS alert sent to '%s' after %.0f ms.", number, (monotonic() - started_at) * 1000)
+            except Exception as e:
+                results[number] = False
+                self.logger.error(f"Couldn't send SMS alert to '{number}'. Reason: {e}")
+        return results
+
+    async def send_sms(self, number: str, text: str, timeout=30.0):
+        async with self.command_lock:
+            # Checked under the lock so no other command switches the mode in between
+            if not self.state.text_mode:
+                await self.__command('AT+CMGF=1', 2.0)
+                self.state.text_mode = True
+            self.__drain_lines()
+            await self.__write(f'AT+CMGS="{number}"\r'.encode())
+            await self.__expect_prompt(timeout=5.0)
+            await self.__write(text.encode('ascii', 'replace') + CTRL_Z)
+            return await self.__read_response(timeout)
+
+    async def command(self, cmd: str, timeout=2.0):
+        """ Sends an AT command and returns its response lines (without the final OK). """
+        async with self.command_lock:
+            return await self.__command(cmd, timeout)
+
+    async def __command(self, cmd: str, timeout: float):
+        # Caller holds the command lock
+        self.__drain_lines()
+        await self.__write(f'{cmd}\r'.encode())
+        return await self.__read_response(timeout)
+
+    async def refresh_state(self):
+        # Query registration and signal in a single round-trip
+        for line in await self.command('AT+CREG?;+CSQ'):
+            if line.startswith('+CREG:'):
+                stat = line.split(',')[-1].strip()
+                self.state.registered = stat in ('1', '5')  # Home or roaming
+            elif line.startswith('+CSQ:'):
+                self.state.signal_quality = int(line[5:].split(',')[0])
+        self.state.updated_at = current_time()
+
+    async def __open(self):
+        self.lines = asyncio.Queue()
+        self.command_lock = asyncio.Lock()
+        self.fd = os.open(self.port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        # Raw 8N1 at the configured baudrate
+        tty.setraw(self.fd)
+        attrs = termios.tcgetattr(self.fd)
+        speed = BAUDRATES.get(self.baudrate, termios.B115200)
+        attrs[4] = attrs[5] = speed
+        termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+        self.loop.add_reader(self.fd, self.__on_readable)
+        # Configure once: no echo, text mode, GSM charset
+        for cmd in ('ATE0', 'AT+CMGF=1', 'AT+CSCS="GSM"'):
+            await self.command(cmd)
+        self.state.text_mode = True
+        await self.refresh_state()
+        self.state.ready = True
+
+    def __close(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+            self.state.ready = False
+
+    async def __write(self, data: bytes):
+        view = memoryview(data)
+        while len(view) > 0:
+            try:
+                written = os.write(self.fd, view)
+                view = view[written:]
+            except BlockingIOError:
+                # Wait for the uart to drain instead of spinning
+                writable = self.loop.create_future()
+                self.loop.add_writer(self.fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self.loop.remove_writer(self.fd)
+
+    def __on_readable(self):
+        try:
+            self.buffer.extend(os.read(self.fd, 1024))
+        except BlockingIOError:
+            return
+        # SMS prompt comes without line ending
+        if self.buffer.endswith(b'> '):
+            del self.buffer[-2:]
+            self.lines.put_nowait('>')
+        while b'\n' in self.buffer:
+            line, _, rest = self.buffer.partition(b'\n')
+            self.buffer = bytearray(rest)
+            line = line.decode(errors='replace').strip()
+            if not isempty(line):
+                self.lines.put_nowait(line)
+
+    def __drain_lines(self):
+        while not self.lines.empty():
+            self.lines.get_nowait()
+
+    async def __expect_prompt(self, timeout: float):
+        while True:
+            line = await asyncio.wait_for(self.lines.get(), timeout)
+            if line == '>':
+                return
+            if line == 'ERROR' or line.startswith('+CMS ERROR'):
+                raise ModemError(line)
+
+    async def __read_response(self, timeout: float):
+        response = []
+        while True:
+            line = await asyncio.wait_for(self.lines.get(), timeout)
+            if line == 'OK':
+                return response
+            if line == 'ERROR' or line.startswith('+CME ERROR') or line.startswith('+CMS ERROR'):
+                raise ModemError(line)
+            response.append(line)
+
+    async def __refresh_state_job(self):
+        while self.switcher.is_set():
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh_state()
+            except Exception as e:
+                self.logger.warning("Can't refresh modem state. Reason: %s", e)
+
+    def __loop_job(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop_ready_signal.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+
+def sms_length(text: str) -> int:
+    """ Returns characters the text takes in a GSM 7-bit SMS. """
+    return sum(2 if char in GSM_EXTENDED_CHARS else 1 for char in text)
+
+
+def build_alert_text(car, location, timestamp: int) -> str:
+    """ Builds the SMS text of the accident (timestamp in millis).
+
+    It fits a single SMS, the location goes first so only the car details get cut.
+    """
+    lat, lng = location[0], location[1]
+    happened_at = strftime('%Y-%m-%d %H:%M:%S', localtime(timestamp / 1000))
+    text = f"AASSL ALERT at {happened_at}: https://maps.google.com/?q={lat:.6f},{lng:.6f}"
+    details = f" Car {car.model} ({car.chassis_id}) of {car.owner}"
+    room = SMS_MAX_CHARS - sms_length(text)
+    if sms_length(details) > room:
+        # Drop characters off the end until it fits with the ellipsis
+        while details and sms_length(details) > room - 3:
+            details = details[:-1]
+        details = f"{details}..." if room >= 3 else ""
+    return text + details
@@ -0,0 +1,195 @@
+import os
+import base64
+from time import perf_counter
+
+import utils
+from logger import Logger
+from metrics import registry
+from constants import KeyframeConstants
+
+# OpenCV & numpy are loaded with the first extraction, not to delay arming
+cv = None
+np = None
+
+
+def load_libraries():
+    global cv, np
+    if cv is None:
+        import cv2
+        import numpy
+        cv, np = cv2, numpy
+
+
+def downscale(frame, width: int):
+    height, frame_width = frame.shape[:2]
+    if frame_width <= width:
+        return frame
+    return cv.resize(frame, (width, max(1, height * width // frame_width)), interpolation=cv.INTER_AREA)
+
+
+class Keyframe:
+
+    def __init__(self, frame, seq: int, at: float, sharpness: float, motion: float, score: float) -> None:
+        self.frame = frame
+        self.seq = seq
+        self.at = at  # Capture time (monotonic secs)
+        self.sharpness = sharpness
+        self.motion = motion
+        self.score = score
+        self.jpeg = None
+
+    def __repr__(self) -> str:
+        return f'Keyframe[seq= {self.seq}, score= {self.score:.2f}, sharpness= {self.sharpness:.0f}, motion= {self.motion:.1f}, jpeg= {len(self.jpeg or b"")} B]'
+
+
+class KeyframeExtractor:
+    """
+    Picks the most informative frames around a crash for instant previews.
+
+    Up to `CANDIDATES` frames of the `WINDOW` secs around the crash are scored at once on
+    downscaled grayscale copies: sharpness is the variance of their Laplacian (blurry frames
+    score low) and motion energy is their mean abs difference from the previous candidate.
+    The best `COUNT` frames at least `MIN_GAP` secs apart are encoded as small JPEGs. Scoring
+    stops early once half of the budget is spent, encoding once all of it is (keeping one).
+    Picked frames can be redacted before they're encoded, that time isn't taken from the budget.
+    """
+
+    def __init__(self, count=KeyframeConstants.COUNT, budget=KeyframeConstants.BUDGET) -> None:
+        self.count = count
+        self.budget = budget
+        self.logger = Logger("Keyframes")
+        # Metrics
+        self.latency = registry.histogram('keyframes_seconds', 'Duration of picking & encoding the keyframes of an accident.')
+
+    def extract(self, video_buffer, crash_at: float, redact=None, count=None):
+        """ Picks & encodes the keyframes of the video buffer around crash_at (monotonic secs).
+
+        Args:
+            redact (callable): Blurs a list of frames in place, the picked ones are redacted
+                on copies before being encoded (it has a budget of its own).
+            count (int): Keyframes to pick, defaults to the count of the extractor.
+
+        Returns:
+            list: Keyframes, best first.
+        """
+        started_at = perf_counter()
+        load_libraries()
+        entries = [entry for entry in video_buffer.entries if abs(entry[2] - crash_at) <= KeyframeConstants.WINDOW]
+        if len(entries) == 0:
+            return []
+        # Spread the candidates evenly over the window
+        step = -(-len(entries) // KeyframeConstants.CANDIDATES)
+        candidates = []
+        for frame, seq, at in entries[::step]:
+            gray = cv.cvtColor(downscale(frame, KeyframeConstants.SCORING_WIDTH), cv.COLOR_BGR2GRAY)
+            candidates.append((frame, seq, at, gray))
+            if perf_counter() - started_at > self.budget / 2:
+                break
+        keyframes = self.__score(candidates)
+        # Encode the best ones
+        keyframes.sort(key=lambda keyframe: keyframe.score, reverse=True)
+        count = count if count is not None else self.count
+        picked = []
+        for keyframe in keyframes:
+            if len(picked) >= count:
+                break
+            if all(abs(keyframe.at - other.at) >= KeyframeConstants.MIN_GAP for other in picked):
+                picked.append(keyframe)
+        if redact is not None and picked:
+            redact_started_at = perf_counter()
+            # The video keeps its frames, it's redacted as a whole later
+            for keyframe in picked:
+                keyframe.frame = keyframe.frame.copy()
+            redact([keyframe.frame for keyframe in picked])
+            started_at += perf_counter() - redact_started_at
+        encoded = []
+        for keyframe in picked:
+            if encoded and perf_counter() - started_at > self.budget:
+                break
+            keyframe.jpeg = self.encode(keyframe.frame, KeyframeConstants.JPEG_WIDTH, KeyframeConstants.JPEG_QUALITY)
+            encoded.append(keyframe)
+        picked = encoded
+        elapsed = perf_counter() - started_at
+        self.latency.observe(elapsed)
+        if elapsed > self.budget:
+            self.logger.warning(f"Picked {len(picked)} keyframe(s) of {len(candidates)} candidate(s) in {elapsed * 1000:.0f} ms, over the {self.budget * 1000:.0f} ms budget.")
+        else:
+            self.logger.info(f"Picked {len(picked)} keyframe(s) of {len(candidates)} candidate(s) in {elapsed * 1000:.0f} ms.")
+        return picked
+
+    @staticmethod
+    def __score(candidates: list):
+        stack = np.stack([gray for _, _, _, gray in candidates]).astype(np.float32)
+        # 4-neighbour Laplacian of every candidate at once
+        laplacian = 4 * stack[:, 1:-1, 1:-1] - stack[:, :-2, 1:-1] - stack[:, 2:, 1:-1] - stack[:, 1:-1, :-2] - stack[:, 1:-1, 2:]
+        sharpness = laplacian.reshape(len(candidates), -1).var(axis=1)
+        motion = np.zeros(len(candidates), dtype=np.float32)
+        if len(candidates) > 1:
+            motion[1:] = np.abs(stack[1:] - stack[:-1]).reshape(len(candidates) - 1, -1).mean(axis=1)
+            motion[0] = motion[1]
+        weight = KeyframeConstants.SHARPNESS_WEIGHT
+        scores = weight * sharpness / max(float(sharpness.max()), 1e-6) + (1 - weight) * motion / max(float(motion.max()), 1e-6)
+        return [Keyframe(frame, seq, at, float(sharpness[idx]), float(motion[idx]), float(scores[idx]))
+                for idx, (frame, seq, at, _) in enumerate(candidates)]
+
+    @staticmethod
+    def encode(frame, width: int, quality: int):
+        """ Returns the frame downscaled to width as JPEG bytes. """
+        load_libraries()
+        done, jpeg = cv.imencode('.jpg', downscale(frame, width), [cv.IMWRITE_JPEG_QUALITY, quality])
+        if not done:
+            raise ValueError("Can't encode frame as JPEG.")
+        return jpeg.tobytes()
+
+    def thumbnail(self, keyframe: Keyframe, max_bytes: int):
+        """ Returns the keyframe as a base64 JPEG of max_bytes at most (None if it doesn't fit). """
+        try:
+            for quality in KeyframeConstants.THUMBNAIL_QUALITIES:
+                thumbnail = base64.b64encode(self.encode(keyframe.frame, KeyframeConstants.THUMBNAIL_WIDTH, quality)).decode('ascii')
+                if len(thumbnail) <= max_bytes:
+                    return thumbnail
+        except Exception as e:
+            self.logger.warning(f"Can't encode thumbnail. Reason: {e}")
+            return None
+        self.logger.warning(f"Thumbnail doesn't fit in {max_bytes} B of the alert, it's sent without one.")
+        return None
+
+    def save(self, keyframes: list, timestamp: int):
+        """ Writes the JPEGs of the keyframes of the accident to captures (best first).
+
+        Returns:
+            int: Count of saved keyframes.
+        """
+        for rank, keyframe in enumerate(keyframes):
+            filepath = utils.get_keyframe_file_path(timestamp, rank)
+            tmp_filepath = f"{filepath}.part"
+            with open(tmp_filepath, 'wb') as file:
+                file.write(keyframe.jpeg)
+            os.replace(tmp_filepath, filepath)
+        return len(keyframes)
+
+
+if __name__ == '__main__':
+    # Benchmark on a synthetic 5+5 secs clip at 640x480 (budget is for a Pi 4)
+    import math
+    from time import monotonic
+    from camera import VideoBuffer
+    load_libraries()
+    framerate = 15
+    video_buffer = VideoBuffer(framerate=framerate, max_frame_count=framerate * 10)
+    start = monotonic()
+    for idx in range(framerate * 10):
+        frame = np.full((480, 640, 3), 40 + idx % 50, dtype=np.uint8)
+        x = int(320 + 200 * math.sin(idx / 10))
+        cv.rectangle(frame, (x - 40, 200), (x + 40, 280), (255, 255, 255), -1)
+        if idx % 7:
+            # Every frame but each 7th is blurred
+            frame = cv.GaussianBlur(frame, (15, 15), 0)
+        video_buffer.push(frame, idx, start + idx / framerate)
+    extractor = KeyframeExtractor()
+    for _ in range(5):
+        keyframes = extractor.extract(video_buffer, start + 5.0)
+    for keyframe in keyframes:
+        print(keyframe)
+    thumbnail = extractor.thumbnail(keyframes[0], 2048)
+    print(f"Thumbnail: {len(thumbnail or '')} B")
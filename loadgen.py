@@ -0,0 +1,315 @@
+"""
+Fleet-scale load generator for the reporting backend.
+
+Thousands of virtual units report accidents through `AccidentReporter` (alert, package
+upload & video-ready follow-up) against a local backend stand-in, arriving by a given
+pattern, then backend throughput and tail latencies are reported.
+
+    python loadgen.py --units 2000 --pattern burst --concurrency 64 --video-size 262144
+"""
+import os
+import sys
+import json
+import math
+import random
+import logger
+import tempfile
+from queue import Queue
+from argparse import ArgumentParser
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, monotonic, time as current_time
+
+import utils
+from logger import Logger
+from transcoder import Transcoder
+from local_backend import LocalBackend, LocalBackendServer
+from crash_reporter import AccidentReporter, Accident, AccidentKeys, ReportingStages
+
+
+class ArrivalPatterns:
+    CONSTANT = 'constant'  # Evenly spaced at `rate` per sec
+    POISSON = 'poisson'  # Independent units, `rate` per sec on average
+    BURST = 'burst'  # Pile-up, every unit within `window` secs
+    RAMP = 'ramp'  # Rate rising linearly from 0 to twice `rate`
+
+    @staticmethod
+    def as_list():
+        return [
+            ArrivalPatterns.CONSTANT,
+            ArrivalPatterns.POISSON,
+            ArrivalPatterns.BURST,
+            ArrivalPatterns.RAMP
+        ]
+
+    @staticmethod
+    def schedule(pattern: str, units: int, rate: float, window=1.0, seed=None):
+        """ Returns the arrival offsets (secs from start, sorted) of the units. """
+        rng = random.Random(seed)
+        if pattern == ArrivalPatterns.CONSTANT:
+            return [index / rate for index in range(units)]
+        if pattern == ArrivalPatterns.POISSON:
+            offsets = []
+            at = 0.0
+            for _ in range(units):
+                offsets.append(at)
+                at += rng.expovariate(rate)
+            return offsets
+        if pattern == ArrivalPatterns.BURST:
+            return sorted(rng.uniform(0, window) for _ in range(units))
+        if pattern == ArrivalPatterns.RAMP:
+            # Arrivals by t are rate * t^2 / duration
+            duration = units / rate
+            return [math.sqrt(index * duration / rate) for index in range(units)]
+        raise ValueError(f"Unknown arrival pattern '{pattern}'.")
+
+
+class VirtualCar:
+    """ Car info of a virtual unit (what `Accident.as_dict` reads from a `Car`). """
+
+    def __init__(self, index: int) -> None:
+        self.chassis_id = f"VU-{index:06d}"
+        self.model = "Virtual"
+        self.owner = f"Unit {index}"
+        self.emergency_contacts = "+200000000001,+200000000002"
+
+
+class LoadGenerator:
+    """
+    Drives `units` virtual units against one backend.
+
+    Reports run on `concurrency` lanes, each an `AccidentReporter` with upload sessions
+    & token cache of its own, so units queue for a lane like requests queue for a
+    connection. Video files are hard links of one source file, each accident's files
+    (& its uploaded package) are removed once it's reported. With the backend served
+    in-process (no `url`) the units share the interpreter with it, point `url` to an
+    external one to load it alone.
+    """
+
+    def __init__(self, units: int, pattern=ArrivalPatterns.POISSON, rate=100.0, window=1.0, concurrency=64,
+                 video_size=256 * 1024, payload_size=0, clients=1, url=None, latency=0.0, bandwidth=None,
+                 error_rate=0.0, workdir=None, seed=None) -> None:
+        self.units = units
+        self.pattern = pattern
+        self.rate = rate
+        self.window = window
+        self.concurrency = concurrency
+        self.video_size = video_size
+        self.payload_size = payload_size
+        self.clients = clients
+        self.url = url
+        self.server_params = {'latency': latency, 'bandwidth': bandwidth, 'error_rate': error_rate}
+        self.workdir = workdir if workdir is not None else tempfile.mkdtemp(prefix="aassl-loadgen-")
+        self.seed = seed
+        self.logger = Logger("LoadGenerator")
+        # Runtime
+        self.server = None
+        self.lanes = Queue()
+        self.lock = Lock()
+        self.results = {}  # timestamp -> result of the unit reporting it
+
+    def run(self):
+        """ Runs the load until every unit reported (blocks the calling thread).
+
+        Returns:
+            dict: Report of the run.
+        """
+        previous_cwd = os.getcwd()
+        os.makedirs(os.path.join(self.workdir, 'data'), exist_ok=True)
+        # Captures & outbox paths are relative to the working dir
+        os.chdir(self.workdir)
+        try:
+            utils.create_captures_dir()
+            self.__start_backend()
+            self.__create_lanes()
+            source = os.path.join(self.workdir, 'source.mp4')
+            with open(source, 'wb') as file:
+                file.write(os.urandom(self.video_size))
+            offsets = ArrivalPatterns.schedule(self.pattern, self.units, self.rate, self.window, self.seed)
+            # Timestamps identify accidents (& their files), keep them unique per unit
+            first_timestamp = math.floor(current_time() * 1000)
+            self.logger.info(f"Reporting {self.units} unit(s) | Pattern= {self.pattern} Lanes= {self.concurrency} Video= {self.video_size / 1024:.0f} KB")
+            started_at = monotonic()
+            wall_started_at = current_time()
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="VirtualUnit") as executor:
+                for index, offset in enumerate(offsets):
+                    delay = started_at + offset - monotonic()
+                    if delay > 0:
+                        sleep(delay)
+                    executor.submit(self.__report_unit, index, first_timestamp + index, source, started_at + offset)
+            elapsed = monotonic() - started_at
+            return self.__build_report(elapsed, wall_started_at - started_at)
+        finally:
+            self.__stop()
+            os.chdir(previous_cwd)
+
+    def __start_backend(self):
+        if self.url is None:
+            tokens = {f"client-{index}": f"token-{index}" for index in range(self.clients)}
+            self.server = LocalBackendServer(os.path.join(self.workdir, 'bucket'), tokens=tokens, **self.server_params)
+            self.server.start()
+            self.url = self.server.url
+
+    def __create_lanes(self):
+        for lane in range(self.concurrency):
+            lane_dir = os.path.join(self.workdir, 'lanes', f"{lane}")
+            os.makedirs(lane_dir, exist_ok=True)
+            reporter = AccidentReporter(LocalBackend(url=self.url, bucket_dir=lane_dir))
+            reporter.setup()
+            # Videos are random bytes, upload them as they are
+            reporter.transcoder.available = False
+            self.lanes.put(reporter)
+
+    def __stop(self):
+        while not self.lanes.empty():
+            reporter = self.lanes.get()
+            reporter.stages_pool.shutdown(wait=False)
+            reporter.outbox.close()
+        if self.server is not None:
+            self.server.stop()
+
+    def __payload(self, index: int, timestamp: int, filename: str):
+        accident = Accident(lat=30.0346762 + index * 1e-5, lng=31.4295489 + index * 1e-5, timestamp=timestamp, video_filename=filename)
+        payload = accident.as_dict(VirtualCar(index))
+        if self.payload_size > 0:
+            # Pad the alert up to the wanted size
+            padding = self.payload_size - len(json.dumps(payload))
+            if padding > 0:
+                payload['padding'] = 'x' * padding
+        return payload
+
+    def __report_unit(self, index: int, timestamp: int, source: str, arrived_at: float):
+        filename = f"{timestamp}.mp4"
+        filepath = utils.get_capture_file_path(filename)
+        try:
+            os.link(source, filepath)
+        except OSError:
+            with open(source, 'rb') as src, open(filepath, 'wb') as dst:
+                dst.write(src.read())
+        reporter = self.lanes.get()
+        started_at = monotonic()
+        try:
+            reported = reporter.report_accident(self.__payload(index, timestamp, filename))
+        except Exception as e:
+            self.logger.error(f"Unit #{index} failed to report. Reason: {e}")
+            reported = False
+        finally:
+            self.lanes.put(reporter)
+        ended_at = monotonic()
+        package_path = utils.get_capture_file_path(utils.get_package_filename(filename))
+        uploaded = os.path.getsize(package_path) if reported and os.path.exists(package_path) else 0
+        with self.lock:
+            self.results[f"{timestamp}"] = {'arrived_at': arrived_at, 'started_at': started_at, 'ended_at': ended_at, 'reported': reported, 'uploaded': uploaded}
+        # Keep the disk usage flat (the in-process bucket too)
+        paths = [utils.get_capture_file_path(name) for name in (filename, Transcoder.transcoded_filename(filename), utils.get_package_filename(filename))]
+        if self.server is not None:
+            paths.append(os.path.join(self.server.bucket_dir, utils.get_package_filename(filename)))
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        try:
+            os.remove(utils.get_trace_file_path(timestamp))
+        except FileNotFoundError:
+            pass
+
+    def __build_report(self, elapsed: float, wall_offset: float):
+        def stats(values):
+            if len(values) == 0:
+                return None
+            return {'p50': utils.percentile(values, 50), 'p95': utils.percentile(values, 95), 'p99': utils.percentile(values, 99), 'max': max(values)}
+
+        with self.lock:
+            results = dict(self.results)
+        alerts = {}
+        notifications = 0
+        uploaded = sum(result['uploaded'] for result in results.values())
+        if self.server is not None:
+            with self.server.lock:
+                messages = list(self.server.notifications)
+            notifications = len(messages)
+            for message in messages:
+                data = message.get('data', {})
+                if data.get(AccidentKeys.STAGE) == ReportingStages.ALERT:
+                    alerts.setdefault(data.get(AccidentKeys.TIMESTAMP), message['received_at'])
+        # Server stamps are wall time, results are monotonic
+        alert_latencies = [alerts[timestamp] - wall_offset - result['arrived_at'] for timestamp, result in results.items() if timestamp in alerts]
+        reported = sum(1 for result in results.values() if result['reported'])
+        return {
+            'units': self.units,
+            'pattern': self.pattern,
+            'concurrency': self.concurrency,
+            'video_size': self.video_size,
+            'workdir': self.workdir,
+            'elapsed': elapsed,
+            'reported': reported,
+            'failed': len(results) - reported,
+            'throughput': {
+                'reports_per_sec': reported / elapsed if elapsed > 0 else 0.0,
+                'notifications_per_sec': notifications / elapsed if elapsed > 0 else 0.0,
+                'upload_bytes_per_sec': uploaded / elapsed if elapsed > 0 else 0.0,
+            },
+            'latency': {
+                'queued': stats([result['started_at'] - result['arrived_at'] for result in results.values()]),
+                'alert': stats(alert_latencies),
+                'pipeline': stats([result['ended_at'] - result['started_at'] for result in results.values()]),
+                'end_to_end': stats([result['ended_at'] - result['arrived_at'] for result in results.values()]),
+            },
+        }
+
+
+def format_report(report: dict):
+    """ Returns the report as a few human readable lines. """
+    def stats(value):
+        if value is None:
+            return "-"
+        return " / ".join(f"{key} {value[key] * 1000:.0f} ms" for key in ('p50', 'p95', 'p99', 'max'))
+
+    throughput, latency = report['throughput'], report['latency']
+    return "\n".join([
+        f"{report['units']} unit(s) | {report['pattern']} | {report['concurrency']} lane(s) | {report['video_size'] / 1024:.0f} KB videos | {report['elapsed']:.1f} secs | Workdir= {report['workdir']}",
+        f"  Reported {report['reported']} | failed {report['failed']}",
+        f"  Throughput: {throughput['reports_per_sec']:.1f} reports/s | {throughput['notifications_per_sec']:.1f} notifications/s | {throughput['upload_bytes_per_sec'] / (1024 * 1024):.2f} MB/s uploaded",
+        f"  Queued: {stats(latency['queued'])}",
+        f"  Alert: {stats(latency['alert'])}",
+        f"  Pipeline: {stats(latency['pipeline'])}",
+        f"  End to end: {stats(latency['end_to_end'])}",
+    ])
+
+
+def main(args=None):
+    parser = ArgumentParser(description="Reports accidents of many virtual units against a local backend.")
+    parser.add_argument('--units', type=int, default=1000)
+    parser.add_argument('--pattern', choices=ArrivalPatterns.as_list(), default=ArrivalPatterns.POISSON)
+    parser.add_argument('--rate', type=float, default=100.0, help="Arrivals per sec (constant, poisson & ramp)")
+    parser.add_argument('--window', type=float, default=1.0, help="Secs all units arrive within (burst)")
+    parser.add_argument('--concurrency', type=int, default=64, help="Reports in flight at once")
+    parser.add_argument('--video-size', type=int, default=256 * 1024, help="Bytes")
+    parser.add_argument('--payload-size', type=int, default=0, help="Bytes the alert payload is padded to")
+    parser.add_argument('--clients', type=int, default=1, help="Tokens every alert fans out to")
+    parser.add_argument('--url', help="Backend to load instead of an in-process one")
+    parser.add_argument('--latency', type=float, default=0.0, help="Secs added to every request")
+    parser.add_argument('--bandwidth', type=int, help="Bytes per sec of every request body")
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--report', help="Writes the JSON report to this file")
+    parser.add_argument('--verbose', action='store_true', help="Logs every report")
+    params = parser.parse_args(args)
+    if not params.verbose:
+        logger.set_level(logger.ERROR)
+    generator = LoadGenerator(
+        params.units, params.pattern, params.rate, params.window, params.concurrency,
+        params.video_size, params.payload_size, params.clients, params.url,
+        params.latency, params.bandwidth, params.error_rate, seed=params.seed
+    )
+    report = generator.run()
+    if params.report:
+        with open(params.report, 'w') as file:
+            json.dump(report, file, indent=2)
+    print(format_report(report))
+    return 0 if report['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,300 @@
+import os
+import json
+import random
+import secrets
+from time import sleep, monotonic, time as current_time
+from threading import Thread, Lock
+from urllib.request import Request, urlopen
+from urllib.parse import urlparse, parse_qs, quote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import utils
+from logger import Logger
+from uploader import ResumableUploader
+from token_registry import TokenRegistry
+from tracing import tracer
+from reporter_backend import ReporterBackend, NotificationReport
+
+
+class LocalHTTPServer(ThreadingHTTPServer):
+    # Pile-ups open many connections at once, the default backlog (5) resets them
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class LocalBackendServer:
+    """
+    In-process HTTP stand-in of the reporting backend.
+
+    POST /upload?name=<remote path>&size=<bytes> opens a resumable upload session and
+    returns its url in `Location`, PUT <session url> with `Content-Range` stores a chunk
+    and answers 308 with the received `Range` until the last byte arrives. Uploaded
+    files end up in `bucket_dir`. GET /tokens returns the client tokens and
+    POST /notify records a message sent to a list of tokens
+    (stamped with the wall time it was `received_at`).
+
+    Every request is delayed by `latency` secs, bodies are read at `bandwidth` bytes per
+    sec and `error_rate` of the requests fail with 503 to emulate a cellular link.
+    """
+
+    def __init__(self, bucket_dir: str, host='127.0.0.1', port=0, latency=0.0, bandwidth=None, error_rate=0.0, tokens=None) -> None:
+        self.bucket_dir = bucket_dir
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.tokens = dict(tokens) if tokens is not None else {'local-client': 'local-token'}
+        self.logger = Logger("LocalBackendServer")
+        # Runtime
+        self.lock = Lock()
+        self.sessions = {}
+        self.notifications = []
+        self.server = LocalHTTPServer((host, port), self.__handler_class())
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        os.makedirs(self.bucket_dir, exist_ok=True)
+        Thread(name="LocalBackendServer", target=self.server.serve_forever, daemon=True).start()
+        self.logger.success(f"Serving local bucket '{self.bucket_dir}' at {self.url}")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def create_session(self, remote_path: str, size: int):
+        """ Opens an upload session directly (same as POST /upload). """
+        session_id = secrets.token_hex(8)
+        with self.lock:
+            self.sessions[session_id] = {'remote_path': remote_path, 'size': size, 'received': 0}
+        open(self.part_path(session_id), 'wb').close()
+        return f"{self.url}/session/{session_id}"
+
+    def part_path(self, session_id: str):
+        return os.path.join(self.bucket_dir, f".{session_id}.part")
+
+    def __handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if not self.__emulate_link(0):
+                    return
+                if urlparse(self.path).path != '/tokens':
+                    return self.__respond(404)
+                with server.lock:
+                    tokens = dict(server.tokens)
+                self.__respond_json({'tokens': tokens, 'etag': str(hash(frozenset(tokens.items())))})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length', 0))
+                if not self.__emulate_link(length):
+                    return
+                body = self.rfile.read(length) if length > 0 else b''
+                if url.path == '/notify':
+                    message = json.loads(body)
+                    message['received_at'] = current_time()
+                    with server.lock:
+                        known = set(server.tokens.values())
+                        server.notifications.append(message)
+                    # Tokens that aren't registered anymore are reported back like FCM does
+                    results = {token: ('sent' if token in known else 'unregistered') for token in message.get('tokens', [])}
+                    return self.__respond_json({'results': results})
+                if url.path == '/upload':
+                    query = parse_qs(url.query)
+                    size = int(query.get('size', ['0'])[0])
+                    session_url = server.create_session(query.get('name', [''])[0], size)
+                    self.send_response(200)
+                    self.send_header('Location', session_url)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.__respond(404)
+
+            def do_PUT(self):
+                session_id = urlparse(self.path).path.rsplit('/', 1)[-1]
+                length = int(self.headers.get('Content-Length', 0))
+                if not self.__emulate_link(length):
+                    return
+                body = self.rfile.read(length) if length > 0 else b''
+                with server.lock:
+                    session = server.sessions.get(session_id)
+                if session is None:
+                    return self.__respond(404)
+                content_range = self.headers.get('Content-Range', '')
+                if length > 0:
+                    start = int(content_range.split(' ')[1].split('-')[0])
+                    if start != session['received']:
+                        return self.__respond_incomplete(session)
+                    with open(server.part_path(session_id), 'ab') as part:
+                        part.write(body)
+                    session['received'] += length
+                if session['received'] < session['size']:
+                    return self.__respond_incomplete(session)
+                # Upload is complete, move it into the bucket
+                target = os.path.join(server.bucket_dir, session['remote_path'])
+                os.makedirs(os.path.dirname(target) or server.bucket_dir, exist_ok=True)
+                os.replace(server.part_path(session_id), target)
+                with server.lock:
+                    server.sessions.pop(session_id, None)
+                self.__respond(200)
+
+            def __emulate_link(self, length: int):
+                """ Delays the request like the emulated link would. Returns False if it failed. """
+                delay = server.latency
+                if server.bandwidth:
+                    delay += length / server.bandwidth
+                if delay > 0:
+                    sleep(delay)
+                if random.random() < server.error_rate:
+                    # Drain the body so the client sees the error not a reset
+                    if length > 0:
+                        self.rfile.read(length)
+                    self.__respond(503)
+                    return False
+                return True
+
+            def __respond(self, code: int):
+                self.send_response(code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def __respond_json(self, data: dict):
+                body = json.dumps(data).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def __respond_incomplete(self, session: dict):
+                self.send_response(308)
+                if session['received'] > 0:
+                    self.send_header('Range', f"bytes=0-{session['received'] - 1}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        return Handler
+
+
+class LocalBackend(ReporterBackend):
+    """ Offline backend that reports to a `LocalBackendServer` (started in-process if no url is given). """
+
+    def __init__(self, url=None, bucket_dir=None, latency=0.0, bandwidth=None, error_rate=0.0, tokens=None) -> None:
+        self.url = url
+        self.bucket_dir = bucket_dir if bucket_dir is not None else os.path.join(utils.data_dir_path(), 'local_bucket')
+        self.server = None
+        self.server_params = {'latency': latency, 'bandwidth': bandwidth, 'error_rate': error_rate, 'tokens': tokens}
+
+    def setup(self):
+        if self.url is None:
+            self.server = LocalBackendServer(self.bucket_dir, **self.server_params)
+            self.server.start()
+            self.url = self.server.url
+
+    def create_storage(self):
+        return LocalStorage(self.url, os.path.join(self.bucket_dir, '.uploads.json'))
+
+    def create_messaging(self):
+        return LocalMessaging(self.url, os.path.join(self.bucket_dir, '.tokens.json'))
+
+
+class LocalStorage:
+
+    def __init__(self, url: str, sessions_filepath: str, max_rate=None) -> None:
+        self.url = url
+        self.logger = Logger("LocalStorage")
+        self.uploader = ResumableUploader(sessions_filepath, max_rate=max_rate)
+
+    def create_session(self, remote_path: str, size: int):
+        request = Request(f"{self.url}/upload?name={quote(remote_path)}&size={size}", data=b'', method='POST')
+        with urlopen(request, timeout=30) as response:
+            return response.headers['Location']
+
+    def upload_file(self, filepath: str, remote_path: str):
+        try:
+            uploaded = self.uploader.upload(filepath, remote_path, lambda size: self.create_session(remote_path, size))
+            if uploaded:
+                self.logger.success(f"Uploaded '{remote_path}' to local bucket.")
+            return uploaded
+        except Exception as e:
+            self.logger.error(f"Can't upload '{remote_path}' to local bucket. Reason: {e}")
+            return False
+
+    def reference_of(self, remote_path: str):
+        return f"{self.url}/bucket/{remote_path}"
+
+
+class LocalMessaging:
+
+    def __init__(self, url: str, tokens_filepath: str) -> None:
+        self.url = url
+        self.logger = Logger("LocalMessaging")
+        self.registry = TokenRegistry(tokens_filepath, fetcher=self.fetch_tokens)
+        self.registry.load()
+
+    def start(self):
+        self.registry.start()
+
+    def stop(self):
+        self.registry.stop()
+
+    def fetch_tokens(self):
+        with urlopen(f"{self.url}/tokens", timeout=10) as response:
+            data = json.loads(response.read())
+        return data['tokens'], data['etag']
+
+    def send_notification(self, payload):
+        report = NotificationReport()
+        if utils.isempty(payload):
+            self.logger.error("Can't send notification. Payload is empty.")
+            return report
+        targets = {uid: token for uid, token in self.registry.get_tokens().items() if not utils.isempty(token)}
+        if len(targets) == 0:
+            return report
+        started_at = monotonic()
+        body = json.dumps({'data': payload, 'tokens': list(targets.values())}).encode()
+        request = Request(f"{self.url}/notify", data=body, method='POST', headers={'Content-Type': 'application/json'})
+        try:
+            with tracer.span("notify"), urlopen(request, timeout=10) as response:
+                results = json.loads(response.read())['results']
+            for client_uid, token in targets.items():
+                if results.get(token) == 'sent':
+                    report.sent[client_uid] = token
+                else:
+                    report.unregistered[client_uid] = results.get(token)
+                    self.registry.remove(client_uid)
+        except Exception as e:
+            for client_uid in targets:
+                report.failed[client_uid] = e
+        report.elapsed = monotonic() - started_at
+        self.logger.info(f"Notification fan-out done. {report}")
+        return report
+
+
+if __name__ == '__main__':
+    from crash_reporter import AccidentReporter, AccidentKeys
+
+    # Crash-to-alert latency over an emulated 3G link, fully offline
+    if not utils.captures_dir_exists():
+        utils.create_captures_dir()
+    timestamp = int(current_time() * 1000)
+    filename = f"{timestamp}.mp4"
+    with open(utils.get_capture_file_path(filename), 'wb') as file:
+        file.write(os.urandom(2 * 1024 * 1024))
+    reporter = AccidentReporter(LocalBackend(latency=0.15, bandwidth=256 * 1024, error_rate=0.05))
+    reporter.setup()
+    reporter.report_accident({
+        AccidentKeys.LATITUDE: "30.0346762",
+        AccidentKeys.LONGITUDE: "31.4295489",
+        AccidentKeys.TIMESTAMP: f"{timestamp}",
+        AccidentKeys.VIDEO: filename,
+    })
+    reporter.backend.server.stop()
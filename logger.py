@@ -1,41 +1,238 @@
+import os
+import sys
+import atexit
+from collections import deque
+from threading import Event, Thread
+from time import time as current_time, strftime, localtime
+
 LOGGING_ENABLED = True
 
+# Levels
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+# Messages below this level are dropped before anything is formatted
+LOG_LEVEL = INFO
+
+# Size rotated log file, opened by the system once it boots (tools & imports log to console only)
+LOG_FILE_PATH = './data/logs/aassl.log'
+LOG_FILE_MAX_BYTES = 1024 * 1024
+LOG_FILE_BACKUPS = 3
+
+# Secs the writer waits between batches
+FLUSH_INTERVAL = 0.1
+
+# Same message (by tag & template) is logged at most this many times per window, errors always are
+RATE_LIMIT_BURST = 5
+RATE_LIMIT_WINDOW = 1.0  # Secs
+
+
 class TextColor:
     RED = '\033[1;31;40m'
     GREEN = '\033[1;32;40m'
     YELLOW = '\033[1;33;40m'
     BLUE = '\033[1;34;40m'
     WHITE = '\033[1;37;40m'
-    
+
 class BackgroundColor:
     pass
 
+
+def set_level(level: int):
+    global LOG_LEVEL
+    LOG_LEVEL = level
+
+
+class RotatingFile:
+
+    def __init__(self, filepath: str, max_bytes: int, backups: int) -> None:
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = None
+        self.size = 0
+
+    def write(self, text: str):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.filepath) or '.', exist_ok=True)
+            self.file = open(self.filepath, 'a')
+            self.size = self.file.tell()
+        if self.size + len(text) > self.max_bytes and self.size > 0:
+            self.__rotate()
+        self.file.write(text)
+        self.file.flush()
+        self.size += len(text)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __rotate(self):
+        self.file.close()
+        for idx in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.filepath}.{idx}"):
+                os.replace(f"{self.filepath}.{idx}", f"{self.filepath}.{idx + 1}")
+        if self.backups > 0:
+            os.replace(self.filepath, f"{self.filepath}.1")
+        self.file = open(self.filepath, 'w')
+        self.size = 0
+
+
+class LogWriter:
+    """
+    Background writer all loggers hand their records to.
+
+    Records are appended to a deque (thread safe without locking) and formatted,
+    rate limited and written in batches by the writer thread, off the hot paths.
+    """
+
+    def __init__(self) -> None:
+        self.records = deque()
+        self.wakeup_signal = Event()
+        self.started = False
+        self.file = None
+        # Rate limiting: key -> [window start, count, suppressed]
+        self.windows = {}
+        self.last_sweep = 0.0
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        Thread(name="LogWriter", target=self.__writer_job, daemon=True).start()
+        atexit.register(self.close)
+
+    def open_file(self, filepath=LOG_FILE_PATH):
+        """ Writes records to the size rotated log file at filepath too (created with the first record). """
+        if self.file is not None or filepath is None:
+            return
+        # Rotation must not follow the working dir around
+        self.file = RotatingFile(os.path.abspath(filepath), LOG_FILE_MAX_BYTES, LOG_FILE_BACKUPS)
+
+    def close_file(self):
+        """ Writes the pending records then goes back to logging to console only. """
+        self.flush()
+        file, self.file = self.file, None
+        if file is not None:
+            file.close()
+
+    def flush(self, expire_windows=False):
+        console = []
+        lines = []
+        while True:
+            try:
+                record = self.records.popleft()
+            except IndexError:
+                break
+            self.__format(record, console, lines)
+        now = current_time()
+        if expire_windows or now - self.last_sweep > RATE_LIMIT_WINDOW:
+            self.last_sweep = now
+            self.__sweep_windows(now, expire_windows, console, lines)
+        if len(console) > 0:
+            sys.stdout.write(''.join(console))
+            sys.stdout.flush()
+        if len(lines) > 0 and self.file is not None:
+            try:
+                self.file.write(''.join(lines))
+            except OSError:
+                # Keep logging to console if the file can't be written
+                self.file = None
+
+    def close(self):
+        """ Writes the pending records and the counts of the suppressed ones. """
+        self.flush(expire_windows=True)
+
+    def __format(self, record, console: list, lines: list):
+        timestamp, level, tag, color, msg, args = record
+        if level < ERROR:
+            key = (tag, msg if isinstance(msg, str) else None)
+            window = self.windows.get(key)
+            if window is None or timestamp - window[0] > RATE_LIMIT_WINDOW:
+                if window is not None:
+                    self.__emit_suppressed(timestamp, key, window, console, lines)
+                window = [timestamp, 0, 0]
+                self.windows[key] = window
+            window[1] += 1
+            if window[1] > RATE_LIMIT_BURST:
+                window[2] += 1
+                return
+        try:
+            text = msg % args if args else f"{msg}"
+        except Exception:
+            text = f"{msg} {args}"
+        self.__emit(timestamp, level, tag, color, text, console, lines)
+
+    def __sweep_windows(self, now: float, expire_all: bool, console: list, lines: list):
+        """ Forgets the windows that ended, reporting what they suppressed. """
+        for key, window in list(self.windows.items()):
+            if expire_all or now - window[0] > RATE_LIMIT_WINDOW:
+                del self.windows[key]
+                self.__emit_suppressed(now, key, window, console, lines)
+
+    def __emit_suppressed(self, timestamp, key, window, console: list, lines: list):
+        if window[2] > 0:
+            tag, msg = key
+            self.__emit(timestamp, WARNING, tag, TextColor.BLUE, f"(suppressed {window[2]} more of '{msg}' in {RATE_LIMIT_WINDOW} secs)", console, lines)
+
+    def __emit(self, timestamp, level, tag, color, text, console: list, lines: list):
+        if color is None:
+            console.append(f"[{tag}]: {text}\n")
+        else:
+            console.append(f"{color}[{tag}]: {text}{TextColor.WHITE}\n")
+        clock = strftime('%Y-%m-%d %H:%M:%S', localtime(timestamp))
+        lines.append(f"{clock}.{int(timestamp * 1000) % 1000:03d} {LEVEL_NAMES.get(level, level)} [{tag}]: {text}\n")
+
+    def __writer_job(self):
+        while True:
+            self.wakeup_signal.wait(FLUSH_INTERVAL)
+            self.wakeup_signal.clear()
+            self.flush()
+
+
+writer = LogWriter()
+
+
 class Logger:
-    
+    """ Tagged logger. Messages may use %-style args which are only formatted if the message is logged. """
+
     def __init__(self, tag) -> None:
         self.tag = tag
-        
+        writer.start()
+
+    def __submit(self, level, color, msg, args):
+        writer.records.append((current_time(), level, self.tag, color, msg, args))
+        if level >= ERROR:
+            writer.wakeup_signal.set()
+
     def log(self, msg, text_color = TextColor.WHITE):
-        if LOGGING_ENABLED:
-            print(f"{text_color}[{self.tag}]: {msg}{TextColor.WHITE}")
-
-    
-    def success(self, msg):
-        if LOGGING_ENABLED:
-            print(f"{TextColor.GREEN}[{self.tag}]: {msg}{TextColor.WHITE}")
-    
-    def error(self, msg):
-        if LOGGING_ENABLED:
-            print(f"{TextColor.RED}[{self.tag}]: {msg}{TextColor.WHITE}")
-        
-    def info(self, msg):
-        if LOGGING_ENABLED:
-            print(f"{TextColor.YELLOW}[{self.tag}]: {msg}{TextColor.WHITE}")
-        
-    def warning(self, msg):
-        if LOGGING_ENABLED:
-            print(f"{TextColor.BLUE}[{self.tag}]: {msg}{TextColor.BLUE}")
-        
-    def normal(self, msg):
-        if LOGGING_ENABLED:
-            print(f"[{self.tag}]: {msg}")
\ No newline at end of file
+        if LOGGING_ENABLED and LOG_LEVEL <= INFO:
+            self.__submit(INFO, text_color, msg, ())
+
+    def debug(self, msg, *args):
+        if LOGGING_ENABLED and LOG_LEVEL <= DEBUG:
+            self.__submit(DEBUG, None, msg, args)
+
+    def success(self, msg, *args):
+        if LOGGING_ENABLED and LOG_LEVEL <= INFO:
+            self.__submit(INFO, TextColor.GREEN, msg, args)
+
+    def error(self, msg, *args):
+        if LOGGING_ENABLED and LOG_LEVEL <= ERROR:
+            self.__submit(ERROR, TextColor.RED, msg, args)
+
+    def info(self, msg, *args):
+        if LOGGING_ENABLED and LOG_LEVEL <= INFO:
+            self.__submit(INFO, TextColor.YELLOW, msg, args)
+
+    def warning(self, msg, *args):
+        if LOGGING_ENABLED and LOG_LEVEL <= WARNING:
+            self.__submit(WARNING, TextColor.BLUE, msg, args)
+
+    def normal(self, msg, *args):
+        if LOGGING_ENABLED and LOG_LEVEL <= INFO:
+            self.__submit(INFO, None, msg, args)
@@ -0,0 +1,205 @@
+import os
+import asyncio
+
+from logger import Logger
+from metrics import registry
+from scheduler import Scheduler
+from blackbox import recorder, read_available_memory
+from constants import MemoryConstants
+
+
+def frame_size(resolution):
+    """ Returns bytes of a captured BGR frame (the camera pads width to 32 & height to 16). """
+    width, height = resolution
+    return (-(-width // 32) * 32) * (-(-height // 16) * 16) * 3
+
+
+def video_size(resolution, framerate: int, duration: int):
+    """ Returns bytes the video rings take at their peak.
+
+    The video of an accident (pre-roll & post-roll) is held while it's saved and the ring
+    refills meanwhile, that's three times the frames of the duration. Every accident
+    queued behind it holds its pre-roll on top of that.
+    """
+    return (3 + MemoryConstants.QUEUED_VIDEOS) * framerate * duration * frame_size(resolution)
+
+
+class MemoryPlan:
+
+    def __init__(self, budget: int, resolution, framerate: int, duration: int, encode_threads: int, telemetry_records: int) -> None:
+        self.budget = budget
+        self.resolution = resolution
+        self.framerate = framerate
+        self.duration = duration
+        self.encode_threads = encode_threads
+        self.telemetry_records = telemetry_records
+
+    @property
+    def video_size(self):
+        return video_size(self.resolution, self.framerate, self.duration)
+
+    def __repr__(self) -> str:
+        return f"MemoryPlan[Resl[{self.resolution}] Dur[{self.duration} secs] Video[{self.video_size / 1048576:.0f} MB] EncodeThreads[{self.encode_threads}] TelemetryRecords[{self.telemetry_records}]]"
+
+
+class MemoryBudget:
+    """
+    Splits a memory budget among the video rings, the telemetry rings and the encode scratch space.
+
+    The video rings get what's left after the telemetry & encode shares. The best resolution
+    that still keeps `PREFERRED_DURATION` secs is picked (a lower one if none does), then the
+    duration is stretched up to `MAX_DURATION`. Plans smaller than the picked one make up the
+    ladder the buffers are shrunk along under memory pressure.
+    """
+
+    def __init__(self, budget: int, framerate: int, resolutions=MemoryConstants.RESOLUTIONS) -> None:
+        self.budget = budget
+        self.framerate = framerate
+        self.resolutions = resolutions
+        self.telemetry = int(budget * MemoryConstants.TELEMETRY_SHARE)
+        self.scratch = int(budget * MemoryConstants.ENCODE_SHARE)
+        self.video = budget - self.telemetry - self.scratch
+
+    @staticmethod
+    def of_available(available=None, framerate=15):
+        """ Returns the budget of the memory available now (or of the given bytes). """
+        if not available:
+            available = read_available_memory() or MemoryConstants.FALLBACK_AVAILABLE
+        budget = int(available * MemoryConstants.BUDGET_FRACTION)
+        if MemoryConstants.BUDGET_LIMIT is not None:
+            budget = min(budget, MemoryConstants.BUDGET_LIMIT)
+        return MemoryBudget(budget, framerate)
+
+    def max_duration(self, resolution):
+        """ Returns secs of video the rings can hold at resolution. """
+        return min(MemoryConstants.MAX_DURATION, self.video // video_size(resolution, self.framerate, 1))
+
+    def best(self):
+        """ Returns (resolution, duration) of the best plan that fits. """
+        fitting = [(resolution, self.max_duration(resolution)) for resolution in self.resolutions]
+        fitting = [(resolution, duration) for resolution, duration in fitting if duration >= MemoryConstants.MIN_DURATION]
+        for resolution, duration in fitting:
+            if duration >= MemoryConstants.PREFERRED_DURATION:
+                return resolution, duration
+        if fitting:
+            return fitting[0]
+        # Nothing fits, the smallest plan is all that can be done
+        return self.resolutions[-1], MemoryConstants.MIN_DURATION
+
+    def ladder(self):
+        """ Returns plans from the best one down to the smallest, each smaller than the one before. """
+        resolution, duration = self.best()
+        # Shorten the duration first (it's done in place), then lower the resolution
+        candidates = [(resolution, duration), (resolution, min(duration, MemoryConstants.PREFERRED_DURATION))]
+        lower = self.resolutions[self.resolutions.index(resolution) + 1:]
+        candidates.extend((lower_resolution, MemoryConstants.PREFERRED_DURATION) for lower_resolution in lower)
+        smallest = lower[-1] if lower else resolution
+        candidates.extend((smallest, secs) for secs in range(MemoryConstants.PREFERRED_DURATION - 1, MemoryConstants.MIN_DURATION - 1, -1))
+        ladder = []
+        for resolution, duration in candidates:
+            if not ladder or video_size(resolution, self.framerate, duration) < ladder[-1].video_size:
+                ladder.append(self.plan(resolution, duration))
+        return ladder
+
+    def plan(self, resolution, duration: int):
+        # Encoders keep frames (YUV 4:2:0) per thread
+        thread_size = MemoryConstants.ENCODE_THREAD_FRAMES * frame_size(resolution) // 2
+        encode_threads = max(1, min(os.cpu_count() or 1, self.scratch // thread_size))
+        telemetry_records = max(1024, min(recorder.records_per_segment, self.telemetry // MemoryConstants.TELEMETRY_RECORD_SIZE))
+        return MemoryPlan(self.budget, resolution, self.framerate, duration, encode_threads, telemetry_records)
+
+
+class MemoryManager:
+    """
+    Sizes the buffers from the memory available at startup then watches memory pressure.
+
+    Once available memory drops under `LOW_WATERMARK` the buffers are shrunk one step down
+    the ladder of the budget, they grow back a step at a time when the bigger plan leaves
+    `HIGH_WATERMARK` available. The callback applies the plan.
+    """
+
+    class Callback:
+
+        def on_memory_plan_changed(self, plan: MemoryPlan, previous: MemoryPlan):
+            """ Resizes the buffers to the plan (called off the event loop). """
+            pass
+
+    def __init__(self, scheduler: Scheduler, callback: Callback, budget: MemoryBudget = None, interval=MemoryConstants.CHECK_INTERVAL) -> None:
+        self.scheduler = scheduler
+        self.callback = callback
+        self.budget = budget or MemoryBudget.of_available()
+        self.interval = interval
+        self.logger = Logger("Memory")
+        # Runtime
+        self.ladder = self.budget.ladder()
+        self.step = 0
+        self.running = False
+        # Metrics
+        registry.gauge('memory_budget_bytes', 'Memory budget of the buffers.').set(self.budget.budget)
+        registry.gauge('memory_available_bytes', 'Memory available on the system.').set_function(read_available_memory)
+        registry.gauge('memory_video_bytes', 'Peak bytes of the video rings at the current plan.').set_function(lambda: self.plan.video_size)
+        registry.gauge('memory_plan_step', 'Steps the buffers are shrunk down the ladder (0 is the best plan).').set_function(lambda: self.step)
+        self.pressure_events = registry.counter('memory_pressure_total', 'Times the buffers were shrunk under memory pressure.')
+        self.logger.info(f"Budget= {self.budget.budget / 1048576:.0f} MB | {self.plan}")
+
+    @property
+    def plan(self) -> MemoryPlan:
+        return self.ladder[self.step]
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.scheduler.spawn("MemoryManager", self.__memory_manager_job)
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.scheduler.cancel("MemoryManager")
+
+    def evaluate(self, available: int):
+        """ Returns the ladder step the buffers should be at with the available memory. """
+        if available <= 0:
+            # Unknown, keep the current plan
+            return self.step
+        if available < MemoryConstants.LOW_WATERMARK:
+            return min(self.step + 1, len(self.ladder) - 1)
+        if self.step > 0:
+            growth = self.ladder[self.step - 1].video_size - self.plan.video_size
+            if available - growth >= MemoryConstants.HIGH_WATERMARK:
+                return self.step - 1
+        return self.step
+
+    async def __memory_manager_job(self):
+        self.logger.success(f"Memory manager started | Ladder steps= {len(self.ladder)}")
+        while True:
+            try:
+                available = read_available_memory()
+                step = self.evaluate(available)
+                if step != self.step:
+                    await self.__change_plan(step, available)
+            except Exception as e:
+                self.logger.error("Can't check memory pressure. Reason: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def __change_plan(self, step: int, available: int):
+        previous = self.plan
+        shrinking = step > self.step
+        self.step = step
+        if shrinking:
+            self.pressure_events.inc()
+            self.logger.warning(f"Memory pressure ({available / 1048576:.0f} MB available). Shrinking buffers to {self.plan}")
+        else:
+            self.logger.info(f"Memory pressure is over ({available / 1048576:.0f} MB available). Growing buffers to {self.plan}")
+        # Resizing the buffers may wait for an accident being captured
+        await self.scheduler.to_thread(self.callback.on_memory_plan_changed, self.plan, previous)
+
+
+if __name__ == '__main__':
+    # Plans picked for common boards
+    for name, available in (('Pi Zero (512 MB)', 350), ('Pi 3 (1 GB)', 800), ('Pi 4 (4 GB)', 3500)):
+        budget = MemoryBudget.of_available(available * 1048576)
+        print(f"{name}: Budget= {budget.budget / 1048576:.0f} MB")
+        for plan in budget.ladder():
+            print(f"    {plan}")
@@ -0,0 +1,217 @@
+import os
+import json
+from bisect import bisect_left
+from threading import Event, Lock, Thread
+from time import time as current_time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from logger import Logger
+
+# Latency buckets in secs (from 1 ms to 2 mins)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Counter:
+
+    __slots__ = ('name', 'labels', 'value')
+    kind = 'counter'
+
+    def __init__(self, name: str, labels: tuple) -> None:
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Gauge:
+
+    __slots__ = ('name', 'labels', 'value', 'function')
+    kind = 'gauge'
+
+    def __init__(self, name: str, labels: tuple) -> None:
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """ Evaluates the gauge lazily on export instead of on every update. """
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def samples(self):
+        yield self.name, self.labels, self.get()
+
+
+class Histogram:
+
+    __slots__ = ('name', 'labels', 'bounds', 'counts', 'sum', 'count')
+    kind = 'histogram'
+
+    def __init__(self, name: str, labels: tuple, buckets=LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.labels = labels
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            yield f"{self.name}_bucket", self.labels + (('le', f"{bound}"),), cumulative
+        yield f"{self.name}_bucket", self.labels + (('le', '+Inf'),), self.count
+        yield f"{self.name}_sum", self.labels, self.sum
+        yield f"{self.name}_count", self.labels, self.count
+
+
+class MetricsRegistry:
+    """
+    In-process registry of counters, gauges and fixed-bucket histograms.
+
+    Metrics are created once and kept by their owners, updating one is a plain
+    attribute update (or a bisect for histograms) so they're cheap on per-frame paths.
+    """
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.metrics = {}
+        self.helps = {}
+
+    def __get_or_create(self, cls, name: str, help: str, labels: dict, **params):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = cls(name, key[1], **params)
+                self.metrics[key] = metric
+                self.helps.setdefault(name, (help, cls.kind))
+            return metric
+
+    def counter(self, name: str, help='', labels: dict = None) -> Counter:
+        return self.__get_or_create(Counter, name, help, labels)
+
+    def gauge(self, name: str, help='', labels: dict = None) -> Gauge:
+        return self.__get_or_create(Gauge, name, help, labels)
+
+    def histogram(self, name: str, help='', labels: dict = None, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.__get_or_create(Histogram, name, help, labels, buckets=buckets)
+
+    def render_prometheus(self):
+        """ Renders all metrics in the Prometheus text exposition format. """
+        with self.lock:
+            metrics = sorted(self.metrics.items(), key=lambda item: item[0])
+        lines = []
+        last_name = None
+        for (name, _), metric in metrics:
+            if name != last_name:
+                help, kind = self.helps[name]
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                last_name = name
+            for sample_name, labels, value in metric.samples():
+                rendered = ",".join(f'{key}="{val}"' for key, val in labels)
+                lines.append(f"{sample_name}{{{rendered}}} {value}" if rendered else f"{sample_name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        samples = {}
+        for metric in metrics:
+            for sample_name, labels, value in metric.samples():
+                rendered = ",".join(f"{key}={val}" for key, val in labels)
+                samples[f"{sample_name}{{{rendered}}}" if rendered else sample_name] = value
+        return {'timestamp': current_time(), 'metrics': samples}
+
+
+class MetricsExporter:
+    """ Serves metrics as Prometheus text on a local port and snapshots them periodically to a file. """
+
+    def __init__(self, registry: MetricsRegistry, snapshot_filepath: str, host='127.0.0.1', port=9101, snapshot_interval=60.0) -> None:
+        self.registry = registry
+        self.snapshot_filepath = snapshot_filepath
+        self.address = (host, port)
+        self.snapshot_interval = snapshot_interval
+        self.logger = Logger("Metrics")
+        self.server = None
+        self.switcher = Event()
+        self.wakeup_signal = Event()
+
+    def start(self):
+        if self.switcher.is_set():
+            return
+        self.switcher.set()
+        self.wakeup_signal.clear()
+        try:
+            self.server = ThreadingHTTPServer(self.address, self.__handler_class())
+            self.server.daemon_threads = True
+            Thread(name="MetricsServer", target=self.server.serve_forever, daemon=True).start()
+            host, port = self.server.server_address[:2]
+            self.logger.success(f"Serving metrics at http://{host}:{port}/metrics")
+        except OSError as e:
+            self.server = None
+            self.logger.warning(f"Can't serve metrics. Reason: {e}")
+        Thread(name="MetricsSnapshot", target=self.__snapshot_job, daemon=True).start()
+
+    def stop(self):
+        if not self.switcher.is_set():
+            return
+        self.switcher.clear()
+        self.wakeup_signal.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def write_snapshot(self):
+        tmp_path = f"{self.snapshot_filepath}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.registry.snapshot(), file)
+        os.replace(tmp_path, self.snapshot_filepath)
+
+    def __snapshot_job(self):
+        while self.switcher.is_set():
+            self.wakeup_signal.wait(self.snapshot_interval)
+            try:
+                self.write_snapshot()
+            except Exception as e:
+                self.logger.warning("Can't write metrics snapshot. Reason: %s", e)
+
+    def __handler_class(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                body = registry.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+# Shared by the whole system
+registry = MetricsRegistry()
@@ -0,0 +1,226 @@
+import json
+import random
+import sqlite3
+from time import time as current_time
+from threading import Event, Lock, Thread
+
+from logger import Logger
+
+
+class OutboxEntry:
+
+    def __init__(self, id: int, created_at: float, payload: dict, video: str, attempts: int, completed: set) -> None:
+        self.id = id
+        self.created_at = created_at
+        self.payload = payload
+        self.video = video
+        self.attempts = attempts
+        self.completed = completed
+
+    def done(self, stage: str):
+        return stage in self.completed
+
+    def __repr__(self) -> str:
+        return f'OutboxEntry[id= {self.id}, video= {self.video}, attempts= {self.attempts}, completed= {sorted(self.completed)}]'
+
+
+class AccidentOutbox:
+    """
+    Persistent queue of accidents waiting to be reported.
+
+    Entries live in an SQLite database (WAL journal) so an accident survives network
+    outages and reboots. A background drainer hands every due entry to the callback and
+    retries failed ones with exponential backoff and full jitter. Entries failing for
+    `max_attempts` times or older than `max_age` secs are moved to the dead state, they're
+    kept (with their last error) for inspection but never retried again.
+    """
+
+    class Callback:
+
+        def on_drain_entry(self, entry: OutboxEntry) -> bool:
+            pass
+
+    def __init__(self, filepath: str, callback: Callback, base_delay=2.0, max_delay=300.0, max_attempts=100, max_age=7 * 86400) -> None:
+        self.filepath = filepath
+        self.callback = callback
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.max_age = max_age
+        self.logger = Logger("Outbox")
+        # Runtime
+        self.conn = None
+        self.lock = Lock()
+        self.switcher = Event()
+        self.drainer_thread = None
+        self.wakeup_signal = Event()
+
+    def open(self):
+        if self.conn is not None:
+            return
+        self.conn = sqlite3.connect(self.filepath, check_same_thread=False, isolation_level=None)
+        # WAL keeps appends sequential and cheap while staying durable on power loss
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS accidents ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "created_at REAL NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "video TEXT NOT NULL, "
+            "completed TEXT NOT NULL DEFAULT '[]', "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_attempt_at REAL NOT NULL DEFAULT 0, "
+            "last_error TEXT, "
+            "dead INTEGER NOT NULL DEFAULT 0)"
+        )
+        # Outboxes created before the dead state
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(accidents)")]
+        if 'dead' not in columns:
+            self.conn.execute("ALTER TABLE accidents ADD COLUMN dead INTEGER NOT NULL DEFAULT 0")
+        self.logger.success(f"Opened outbox at '{self.filepath}' | Pending= {self.pending_count} Dead= {self.dead_count}")
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def start(self):
+        if not self.switcher.is_set():
+            self.switcher.set()
+            self.drainer_thread = Thread(name="OutboxDrainer", target=self.__drainer_job, daemon=True)
+            self.drainer_thread.start()
+
+    def stop(self):
+        if self.switcher.is_set():
+            self.switcher.clear()
+            self.wakeup_signal.set()
+
+    def join(self, timeout=None):
+        """ Waits for the drainer to finish the entry it's on once stopped.
+
+        Returns:
+            bool: Whether the drainer is done.
+        """
+        if self.drainer_thread is not None:
+            self.drainer_thread.join(timeout)
+            return not self.drainer_thread.is_alive()
+        return True
+
+    @property
+    def pending_count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM accidents WHERE dead = 0").fetchone()[0]
+
+    @property
+    def dead_count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM accidents WHERE dead = 1").fetchone()[0]
+
+    def enqueue(self, payload: dict, video: str) -> int:
+        """ Records an accident in the outbox and wakes up the drainer.
+
+        Only a single INSERT is done here so it's safe to call from the capture path.
+
+        Returns:
+            int: Id of the outbox entry.
+        """
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO accidents (created_at, payload, video) VALUES (?, ?, ?)",
+                (current_time(), json.dumps(payload), video)
+            )
+        self.wakeup_signal.set()
+        return cursor.lastrowid
+
+    def mark_completed(self, entry: OutboxEntry, stage: str):
+        """ Persists that a stage of the entry is done so it's never repeated on retry. """
+        with self.lock:
+            entry.completed.add(stage)
+            # Entries reported directly aren't stored in the outbox
+            if entry.id is None:
+                return
+            self.conn.execute(
+                "UPDATE accidents SET completed = ? WHERE id = ?",
+                (json.dumps(sorted(entry.completed)), entry.id)
+            )
+
+    def update_payload(self, entry: OutboxEntry, fields: dict):
+        """ Persists fields learnt after the entry was queued (e.g. quality of its video). """
+        with self.lock:
+            entry.payload.update(fields)
+            # Entries reported directly aren't stored in the outbox
+            if entry.id is None:
+                return
+            self.conn.execute(
+                "UPDATE accidents SET payload = ? WHERE id = ?",
+                (json.dumps(entry.payload), entry.id)
+            )
+
+    def backoff_delay(self, attempts: int):
+        # Exponential backoff with full jitter
+        ceiling = min(self.max_delay, self.base_delay * (2 ** min(attempts, 16)))
+        return random.uniform(0, ceiling)
+
+    def __due_entries(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, created_at, payload, video, attempts, completed FROM accidents "
+                "WHERE dead = 0 AND next_attempt_at <= ? ORDER BY id",
+                (current_time(),)
+            ).fetchall()
+        return [OutboxEntry(row[0], row[1], json.loads(row[2]), row[3], row[4], set(json.loads(row[5]))) for row in rows]
+
+    def __next_attempt_delay(self):
+        with self.lock:
+            row = self.conn.execute("SELECT MIN(next_attempt_at) FROM accidents WHERE dead = 0").fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - current_time())
+
+    def __on_entry_drained(self, entry: OutboxEntry):
+        with self.lock:
+            self.conn.execute("DELETE FROM accidents WHERE id = ?", (entry.id,))
+        self.logger.success(f"Accident #{entry.id} was reported after {entry.attempts + 1} attempt(s).")
+
+    def __on_entry_failed(self, entry: OutboxEntry, reason: str):
+        # Check whether the entry has to give up
+        attempts = entry.attempts + 1
+        age = current_time() - entry.created_at
+        if attempts >= self.max_attempts or age >= self.max_age:
+            with self.lock:
+                self.conn.execute(
+                    "UPDATE accidents SET attempts = ?, dead = 1, last_error = ? WHERE id = ?",
+                    (attempts, reason, entry.id)
+                )
+            self.logger.error(f"Accident #{entry.id} is dead after {attempts} attempt(s) in {age / 3600:.1f} hours. Last error: {reason}")
+            return
+        delay = self.backoff_delay(entry.attempts)
+        with self.lock:
+            self.conn.execute(
+                "UPDATE accidents SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (current_time() + delay, reason, entry.id)
+            )
+        self.logger.warning("Accident #%s couldn't be reported. Retrying in %.1f secs.", entry.id, delay)
+
+    def __drainer_job(self):
+        self.logger.info("Outbox drainer started.")
+        while self.switcher.is_set():
+            self.wakeup_signal.clear()
+            for entry in self.__due_entries():
+                if not self.switcher.is_set():
+                    break
+                try:
+                    drained = self.callback.on_drain_entry(entry)
+                    reason = "" if drained else "Reporting failed."
+                except Exception as e:
+                    drained = False
+                    reason = f"{type(e).__name__}: {e}"
+                if drained:
+                    self.__on_entry_drained(entry)
+                else:
+                    self.__on_entry_failed(entry, reason)
+            # Sleep until the next retry is due or a new accident is enqueued
+            self.wakeup_signal.wait(self.__next_attempt_delay())
+        self.logger.info("Outbox drainer stopped.")
@@ -0,0 +1,197 @@
+import os
+import json
+import shutil
+import struct
+
+# Preamble: magic, version, parts count, header size (preamble + index)
+PREAMBLE = struct.Struct('<4sHHI')
+# Index entry of a part: name, content type, offset, length
+PART = struct.Struct('<24s24sQQ')
+PACKAGE_MAGIC = b'AAPK'
+PACKAGE_VERSION = 1
+# Parts start on aligned offsets so range fetches map onto whole blocks
+PART_ALIGNMENT = 8
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+class PartNames:
+    METADATA = 'metadata'
+    PREVIEW = 'preview'
+    GPS_TRACK = 'gps_track'
+    SENSORS = 'sensors'
+    TRACE = 'trace'
+    VIDEO = 'video'
+
+    @staticmethod
+    def preview(rank: int):
+        """ Returns name of the preview part of the keyframe of rank ('preview' is the best one). """
+        return PartNames.PREVIEW if rank == 0 else f"{PartNames.PREVIEW}{rank}"
+
+
+class ContentTypes:
+    JSON = 'application/json'
+    JPEG = 'image/jpeg'
+    MP4 = 'video/mp4'
+    BLACKBOX = 'application/x-aassl-bbx'
+    PACKAGE = 'application/x-aassl-package'
+
+
+class PackagePart:
+
+    __slots__ = ('name', 'content_type', 'offset', 'length')
+
+    def __init__(self, name: str, content_type: str, offset: int, length: int) -> None:
+        self.name = name
+        self.content_type = content_type
+        self.offset = offset
+        self.length = length
+
+    @property
+    def range(self):
+        """ Returns the part as an inclusive http byte range ('bytes=first-last'). """
+        return f"bytes={self.offset}-{self.offset + self.length - 1}"
+
+    def __repr__(self) -> str:
+        return f'PackagePart[{self.name}: type= {self.content_type}, offset= {self.offset}, length= {self.length}]'
+
+
+class PackageIndex:
+    """
+    Header of an accident package.
+
+    A client reads the first `PREAMBLE.size` bytes to learn the header size, fetches
+    the header and then range-fetches only the parts it needs (metadata & preview first).
+    """
+
+    def __init__(self, parts: list) -> None:
+        self.parts = {part.name: part for part in parts}
+
+    def __contains__(self, name: str):
+        return name in self.parts
+
+    def __getitem__(self, name: str) -> PackagePart:
+        return self.parts[name]
+
+    @staticmethod
+    def header_size(data: bytes):
+        """ Returns the size of the header from the preamble bytes. """
+        magic, version, _, size = PREAMBLE.unpack_from(data)
+        if magic != PACKAGE_MAGIC:
+            raise ValueError("Not an accident package.")
+        if version > PACKAGE_VERSION:
+            raise ValueError(f"Unsupported accident package version {version}.")
+        return size
+
+    @staticmethod
+    def from_bytes(data: bytes):
+        """ Parses the index from the header bytes. """
+        PackageIndex.header_size(data)
+        _, _, count, _ = PREAMBLE.unpack_from(data)
+        parts = []
+        for idx in range(count):
+            name, content_type, offset, length = PART.unpack_from(data, PREAMBLE.size + idx * PART.size)
+            parts.append(PackagePart(name.rstrip(b'\0').decode(), content_type.rstrip(b'\0').decode(), offset, length))
+        return PackageIndex(parts)
+
+    def to_bytes(self):
+        header_size = PREAMBLE.size + len(self.parts) * PART.size
+        data = [PREAMBLE.pack(PACKAGE_MAGIC, PACKAGE_VERSION, len(self.parts), header_size)]
+        for part in self.parts.values():
+            data.append(PART.pack(part.name.encode(), part.content_type.encode(), part.offset, part.length))
+        return b''.join(data)
+
+
+class PackageBuilder:
+    """
+    Builds an accident package file.
+
+    Parts are laid out in the order they're added after the header, so small ones
+    (metadata, preview) should go first. File parts are streamed from disk.
+    """
+
+    def __init__(self) -> None:
+        self.parts = []  # (name, content type, bytes or filepath)
+
+    def add_bytes(self, name: str, content_type: str, data: bytes):
+        self.parts.append((name, content_type, bytes(data)))
+        return self
+
+    def add_json(self, name: str, data):
+        return self.add_bytes(name, ContentTypes.JSON, json.dumps(data, separators=(',', ':')).encode())
+
+    def add_file(self, name: str, content_type: str, filepath: str):
+        self.parts.append((name, content_type, filepath))
+        return self
+
+    def write(self, filepath: str):
+        """ Writes the package to filepath atomically.
+
+        Returns:
+            PackageIndex: Index of the written package.
+        """
+        # Layout is known upfront from the sizes of the parts
+        offset = PREAMBLE.size + len(self.parts) * PART.size
+        layout = []
+        for name, content_type, source in self.parts:
+            if len(name.encode()) > 24 or len(content_type.encode()) > 24:
+                raise ValueError(f"Part name or type is too long: '{name}' ({content_type})")
+            offset = -(-offset // PART_ALIGNMENT) * PART_ALIGNMENT
+            length = len(source) if isinstance(source, bytes) else os.path.getsize(source)
+            layout.append(PackagePart(name, content_type, offset, length))
+            offset += length
+        index = PackageIndex(layout)
+
+        tmp_path = f"{filepath}.tmp"
+        with open(tmp_path, 'wb') as output:
+            output.write(index.to_bytes())
+            for part, (_, _, source) in zip(layout, self.parts):
+                # Zero padding up to the aligned offset
+                output.write(b'\0' * (part.offset - output.tell()))
+                if isinstance(source, bytes):
+                    output.write(source)
+                else:
+                    with open(source, 'rb') as file:
+                        shutil.copyfileobj(file, output, COPY_CHUNK_SIZE)
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(tmp_path, filepath)
+        return index
+
+
+class PackageReader:
+
+    def __init__(self, filepath: str) -> None:
+        self.filepath = filepath
+        with open(filepath, 'rb') as file:
+            preamble = file.read(PREAMBLE.size)
+            header_size = PackageIndex.header_size(preamble)
+            self.index = PackageIndex.from_bytes(preamble + file.read(header_size - PREAMBLE.size))
+
+    def read_part(self, name: str):
+        part = self.index[name]
+        with open(self.filepath, 'rb') as file:
+            file.seek(part.offset)
+            return file.read(part.length)
+
+    def read_json(self, name: str):
+        return json.loads(self.read_part(name))
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    # Round trip a package with a streamed file part
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        video_path = os.path.join(tmp_dir, 'clip.mp4')
+        with open(video_path, 'wb') as file:
+            file.write(os.urandom(3 * 1024 * 1024 + 7))
+        package_path = os.path.join(tmp_dir, 'accident.aapk')
+        index = (PackageBuilder()
+                 .add_json(PartNames.METADATA, {'timestamp': 1, 'lat': 30.0346762, 'lng': 31.4295489})
+                 .add_file(PartNames.VIDEO, ContentTypes.MP4, video_path)
+                 .write(package_path))
+        print(list(index.parts.values()))
+        reader = PackageReader(package_path)
+        print(reader.read_json(PartNames.METADATA))
+        with open(video_path, 'rb') as file:
+            print("Video intact:", reader.read_part(PartNames.VIDEO) == file.read())
@@ -1,8 +1,10 @@
+import os
 import cv2 as cv
 import numpy as np
-from time import sleep
+from time import sleep, monotonic, time as current_time
 from logger import Logger
-from threading import Event, Thread
+from blackbox import recorder
+from threading import Event, Thread, Timer
 
 
 class CameraError(Exception):
@@ -24,12 +26,56 @@ class RGBArray:
         self.closed = True
 
 
+class SyntheticCapture:
+    """ Stand-in of cv.VideoCapture that renders a moving block over a gradient at the camera profile.
+
+    Frames are paced at `framerate * speed` per sec (speed > 1 runs the camera clock faster than real time).
+    """
+
+    def __init__(self, camera: 'PCCamera', speed=1.0) -> None:
+        self.camera = camera
+        self.speed = speed
+        self.index = 0
+        self.background = None
+        self.next_frame_at = monotonic()
+
+    def read(self):
+        width, height = self.camera.resolution
+        if self.background is None or self.background.shape[:2] != (height, width):
+            gradient = np.linspace(0, 255, width, dtype=np.uint8)
+            self.background = np.repeat(np.tile(gradient, (height, 1))[:, :, None], 3, axis=2)
+        # Pace frames like the sensor would
+        self.next_frame_at += 1.0 / (self.camera.framerate * self.speed)
+        delay = self.next_frame_at - monotonic()
+        if delay > 0:
+            sleep(delay)
+        else:
+            self.next_frame_at = monotonic()
+        # Every frame is a new array like the ones picamera hands out
+        frame = self.background.copy()
+        size = max(8, height // 6)
+        x = (self.index * max(1, width // 64)) % max(1, width - size)
+        frame[height // 2 - size // 2:height // 2 + size // 2, x:x + size] = (0, 0, 255)
+        self.index += 1
+        return True, frame
+
+    def release(self):
+        pass
+
+
 class PCCamera:
 
+    # Frames are rendered instead of read from a webcam when set (speed factor of the camera clock)
+    synthetic_speed = None
+
     def __init__(self) -> None:
         self.cap = None
         self.running_signal = Event()
         self.logger = Logger("PCCamera")
+        # Set like on PiCamera
+        self.vflip = False
+        self.framerate = 15
+        self.resolution = (640, 480)
 
     @property
     def running(self):
@@ -39,7 +85,10 @@ class PCCamera:
         if not self.running:
             # Start camera
             self.logger.info("Opening Camera instance...")
-            self.cap = cv.VideoCapture(cam_index)
+            if PCCamera.synthetic_speed is not None:
+                self.cap = SyntheticCapture(self, PCCamera.synthetic_speed)
+            else:
+                self.cap = cv.VideoCapture(cam_index)
             self.running_signal.set()
             self.logger.success("Opened Camera instance.")
 
@@ -66,15 +115,24 @@ class PCCamera:
 
 class GPS:
 
-    def __init__(self) -> None:
+    def __init__(self, scheduler=None) -> None:
         self.DEFAULT_LOC = (30.0346762, 31.4295489)
         self.switcher = Event()
         self.logger = Logger("GPS")
         self.last_known_location = self.DEFAULT_LOC
+        self.last_fix_at = 0.0  # No fix until one is fed, so the car stands still
+        self.last_speed = 0.0
 
     def setup(self):
         self.logger.success("GPS is ready.")
 
+    def feed(self, lat: float, lng: float, speed: float):
+        """ Takes a fix like the GPS module would parse it (speed in km/h). """
+        self.last_speed = speed
+        self.last_known_location = (lat, lng)
+        self.last_fix_at = current_time()
+        recorder.record_gps(lat, lng, speed)
+
     def start(self):
         if not self.switcher.is_set():
             self.switcher.set()
@@ -98,10 +156,23 @@ class gpio:
     LOW = 'low'
     
     PUD_DOWN = 'pud_down'
+
+    # Levels of the emulated input pins (LOW unless set)
+    levels = {}
     
     @staticmethod
     def input(pin):
-        return gpio.LOW
+        return gpio.levels.get(pin, gpio.LOW)
+
+    @staticmethod
+    def set_input(pin, level):
+        gpio.levels[pin] = level
+
+    @staticmethod
+    def pulse(pin, hold=0.3):
+        """ Drives the input pin HIGH for hold secs (a pressed button). """
+        gpio.set_input(pin, gpio.HIGH)
+        Timer(hold, gpio.set_input, (pin, gpio.LOW)).start()
     
     @staticmethod
     def setmode(mode):
@@ -117,4 +188,62 @@ class gpio:
     
     @staticmethod
     def cleanup(assert_exists=True):
-        pass
\ No newline at end of file
+        pass
+
+class GSMModemSimulator:
+    """ Emulates an AT-command GSM modem on a pty so the GSM driver can be tested without hardware. """
+
+    def __init__(self, response_delay=0.05) -> None:
+        import pty
+        self.response_delay = response_delay
+        self.master, self.slave = pty.openpty()
+        self.port = os.ttyname(self.slave)
+        self.switcher = Event()
+        self.sent_messages = []
+        self.logger = Logger("GSMSimulator")
+
+    def start(self):
+        if not self.switcher.is_set():
+            self.switcher.set()
+            Thread(name="GSMSimulator", target=self.__modem_job, daemon=True).start()
+            self.logger.success(f"Emulating GSM modem at '{self.port}'.")
+
+    def stop(self):
+        self.switcher.clear()
+
+    def __reply(self, *lines):
+        sleep(self.response_delay)
+        os.write(self.master, b''.join(f"\r\n{line}\r\n".encode() for line in lines))
+
+    def __modem_job(self):
+        buffer = b''
+        sms_number = None
+        while self.switcher.is_set():
+            buffer += os.read(self.master, 1024)
+            # Waiting for SMS text terminated by Ctrl+Z
+            if sms_number is not None:
+                if b'\x1a' not in buffer:
+                    continue
+                text, _, buffer = buffer.partition(b'\x1a')
+                self.sent_messages.append((sms_number, text.decode()))
+                self.__reply(f"+CMGS: {len(self.sent_messages)}", "OK")
+                sms_number = None
+                continue
+            while b'\r' in buffer:
+                line, _, buffer = buffer.partition(b'\r')
+                line = line.decode().strip()
+                if not line.upper().startswith('AT'):
+                    continue
+                if line.startswith('AT+CMGS='):
+                    sms_number = line.split('=', 1)[1].strip('"')
+                    sleep(self.response_delay)
+                    os.write(self.master, b'\r\n> ')
+                    break
+                # Concatenated commands get one final OK
+                responses = []
+                for cmd in line[2:].split(';'):
+                    if cmd.startswith('+CREG?'):
+                        responses.append("+CREG: 0,1")
+                    elif cmd.startswith('+CSQ'):
+                        responses.append("+CSQ: 20,0")
+                self.__reply(*responses, "OK")
@@ -0,0 +1,172 @@
+import asyncio
+from time import monotonic, time as current_time, perf_counter_ns
+
+from logger import Logger
+from metrics import registry
+from blackbox import recorder
+from scheduler import Scheduler
+from constants import IS_TESTING, IOPins, PowerConstants
+
+if IS_TESTING:
+    from pc_toolkit import gpio
+else:
+    import RPi.GPIO as gpio
+
+
+class PowerState:
+    DRIVING = 'driving'
+    IDLE = 'idle'
+    PARKED = 'parked'
+
+    @staticmethod
+    def as_list():
+        return [
+            PowerState.DRIVING,
+            PowerState.IDLE,
+            PowerState.PARKED
+        ]
+
+
+# Event code of power state changes in the black box
+POWER_STATE_EVENT = 1
+
+
+class PowerManager:
+    """
+    Power state machine of the unit (driving / idle / parked).
+
+    The car is driving while it moves faster than `DRIVING_SPEED`, idle once it has stood
+    still for `IDLE_AFTER` secs and parked after `PARKED_AFTER` secs (or once the optional
+    ignition input has been off for `IGNITION_OFF_GRACE` secs). Every state has a capture
+    profile the callback applies. Motion seen by the camera or the ignition turning on
+    wakes the unit back to full capture right away, the time it takes is measured.
+    """
+
+    class Callback:
+
+        def on_power_state_changed(self, state: str, previous: str):
+            """ Applies the profile of the new state (called off the event loop). """
+            pass
+
+    def __init__(self, scheduler: Scheduler, gps, callback: Callback, ignition_pin=IOPins.PIN_IGNITION, interval=PowerConstants.CHECK_INTERVAL) -> None:
+        self.scheduler = scheduler
+        self.gps = gps
+        self.callback = callback
+        self.ignition_pin = ignition_pin
+        self.interval = interval
+        self.logger = Logger("Power")
+        # Runtime
+        self.state = PowerState.DRIVING
+        self.last_moving_at = monotonic()
+        self.ignition_off_since = None
+        self.ignition_was_on = None
+        self.wake_requested_at = None
+        self.running = False
+        self.transition_lock = None  # asyncio.Lock created on the loop, one transition is applied at a time
+        # Metrics
+        registry.gauge('power_state', 'Power state (0 driving, 1 idle, 2 parked).').set_function(lambda: PowerState.as_list().index(self.state))
+        self.wake_latency = registry.histogram('power_wake_seconds', 'Secs from a wake trigger until full capture is back.')
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        if self.ignition_pin is not None:
+            gpio.setmode(gpio.BCM)
+            gpio.setup(self.ignition_pin, gpio.IN, gpio.PUD_DOWN)
+        self.scheduler.spawn("PowerManager", self.__power_manager_job)
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.scheduler.cancel("PowerManager")
+
+    def wake(self):
+        """ Brings the unit back to full capture (motion or impact while parked). Safe to call from any thread. """
+        self.scheduler.call(self.__wake)
+
+    def __wake(self):
+        self.last_moving_at = monotonic()
+        if self.state != PowerState.DRIVING and self.wake_requested_at is None:
+            self.wake_requested_at = perf_counter_ns()
+            self.logger.info("Woken up while %s.", self.state)
+            # Don't wait for the next check
+            self.scheduler.spawn("PowerTransition", self.__transition, PowerState.DRIVING)
+
+    @property
+    def ignition_on(self):
+        """ Ignition state (None if there's no ignition input). """
+        if self.ignition_pin is None:
+            return None
+        try:
+            return gpio.input(self.ignition_pin) == gpio.HIGH
+        except RuntimeError:
+            # Pin was released by a gpio cleanup (detector restart), set it up again
+            gpio.setup(self.ignition_pin, gpio.IN, gpio.PUD_DOWN)
+            return gpio.input(self.ignition_pin) == gpio.HIGH
+
+    @property
+    def speed(self):
+        """ Speed in km/h, 0 if the last fix is too old to tell. """
+        if self.gps.last_fix_at <= 0 or current_time() - self.gps.last_fix_at > PowerConstants.FIX_MAX_AGE:
+            return 0.0
+        return self.gps.last_speed
+
+    def evaluate(self):
+        """ Returns the state the unit should be in now. """
+        now = monotonic()
+        ignition = self.ignition_on
+        if ignition is True and self.ignition_was_on is False:
+            # Turning the key wakes the unit right away
+            self.__wake()
+        self.ignition_was_on = ignition
+        if self.speed >= PowerConstants.DRIVING_SPEED:
+            self.last_moving_at = now
+        if ignition is False:
+            if self.ignition_off_since is None:
+                self.ignition_off_since = now
+        else:
+            self.ignition_off_since = None
+        # Ignition off overrides speed (GPS drifts while parked)
+        if self.ignition_off_since is not None and now - self.ignition_off_since >= PowerConstants.IGNITION_OFF_GRACE and now - self.last_moving_at >= PowerConstants.IGNITION_OFF_GRACE:
+            return PowerState.PARKED
+        standing = now - self.last_moving_at
+        if standing < PowerConstants.IDLE_AFTER:
+            return PowerState.DRIVING
+        if standing < PowerConstants.PARKED_AFTER or ignition is True:
+            return PowerState.IDLE
+        return PowerState.PARKED
+
+    async def __power_manager_job(self):
+        if self.transition_lock is None:
+            self.transition_lock = asyncio.Lock()
+        self.logger.success(f"Power manager started | Ignition input= {self.ignition_pin is not None}")
+        while True:
+            try:
+                state = self.evaluate()
+                if state != self.state:
+                    await self.__transition(state)
+            except Exception as e:
+                self.logger.error(f"Can't evaluate power state. Reason: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def __transition(self, state: str):
+        # A wake may come while the previous profile is still being applied, it's applied after it
+        async with self.transition_lock:
+            if state == self.state:
+                return
+            previous = self.state
+            self.state = state
+            self.logger.info("Power state changed: %s -> %s", previous, state)
+            recorder.record_event(POWER_STATE_EVENT, PowerState.as_list().index(state))
+            # Reconfiguring the camera blocks for a while
+            await self.scheduler.to_thread(self.callback.on_power_state_changed, state, previous)
+            if state == PowerState.DRIVING and self.wake_requested_at is not None:
+                elapsed = (perf_counter_ns() - self.wake_requested_at) / 1e9
+                self.wake_requested_at = None
+                self.wake_latency.observe(elapsed)
+                if elapsed > PowerConstants.WAKE_LATENCY_BUDGET:
+                    self.logger.warning(f"Back to full capture in {elapsed * 1000:.0f} ms, over the {PowerConstants.WAKE_LATENCY_BUDGET} secs budget.")
+                else:
+                    self.logger.info(f"Back to full capture in {elapsed * 1000:.0f} ms.")
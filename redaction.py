@@ -0,0 +1,344 @@
+import os
+import multiprocessing
+from threading import Thread, Lock
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from logger import Logger
+from metrics import registry
+from constants import RedactionConstants
+
+# OpenCV is loaded once redaction is opened, not to delay arming
+cv = None
+
+# Boxes are blurred by downscaling them this many times & back
+BLUR_DOWNSCALE = 12
+
+# Cascades of the detector process (loaded once per process)
+detector_cascades = None
+
+
+def load_libraries():
+    global cv
+    if cv is None:
+        import cv2
+        cv = cv2
+
+
+def find_cascades():
+    """ Returns paths of the detector cascades (bundled with OpenCV or installed on the system). """
+    load_libraries()
+    dirs = list(RedactionConstants.CASCADES_DIRS)
+    bundled = getattr(getattr(cv, 'data', None), 'haarcascades', None)
+    if bundled:
+        dirs.insert(0, bundled)
+    paths = []
+    for name in RedactionConstants.CASCADES:
+        path = next((os.path.join(dirpath, name) for dirpath in dirs if os.path.exists(os.path.join(dirpath, name))), None)
+        if path is None:
+            raise FileNotFoundError(f"Can't find detector cascade '{name}' in {dirs}")
+        paths.append(path)
+    return paths
+
+
+def init_detector(paths: list):
+    """ Loads the cascades in a detector process. """
+    global detector_cascades
+    load_libraries()
+    # Processes are the unit of parallelism, don't let OpenCV spawn threads on top
+    cv.setNumThreads(1)
+    detector_cascades = [cv.CascadeClassifier(path) for path in paths]
+    if any(cascade.empty() for cascade in detector_cascades):
+        raise ValueError(f"Can't load detector cascades {paths}")
+
+
+def detect_boxes(frames: list):
+    """ Detects the boxes to redact in downscaled grayscale frames (runs in a detector process).
+
+    Returns:
+        list: (frame index, [(x, y, w, h), ...]) of every frame.
+    """
+    results = []
+    for index, gray in frames:
+        boxes = []
+        for cascade in detector_cascades:
+            found = cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=4, minSize=(RedactionConstants.MIN_SIZE, RedactionConstants.MIN_SIZE))
+            boxes.extend(tuple(int(value) for value in box) for box in found)
+        results.append((index, boxes))
+    return results
+
+
+def terminate_workers(pool: ProcessPoolExecutor):
+    """ Shuts the pool down killing its processes, the ones busy with a job too (they can't be cancelled). """
+    terminate = getattr(pool, 'terminate_workers', None)
+    if terminate is not None:
+        terminate()
+        return
+    # Taken before shutdown drops them
+    processes = list((getattr(pool, '_processes', None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+
+
+def overlap(box, other):
+    """ Returns intersection over union of two (x, y, w, h) boxes. """
+    x0, y0 = max(box[0], other[0]), max(box[1], other[1])
+    x1, y1 = min(box[0] + box[2], other[0] + other[2]), min(box[1] + box[3], other[1] + other[3])
+    intersection = max(0, x1 - x0) * max(0, y1 - y0)
+    union = box[2] * box[3] + other[2] * other[3] - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def interpolate(before: list, after: list, ratio: float):
+    """ Returns boxes between two detections, ratio of the way from before to after.
+
+    Boxes of the same object (overlapping enough) move linearly, boxes seen by one
+    detection only are kept as they are so nothing is left unblurred in between.
+    """
+    boxes = []
+    unmatched = list(after)
+    for box in before:
+        match = max(unmatched, key=lambda other: overlap(box, other), default=None)
+        if match is not None and overlap(box, match) >= RedactionConstants.MATCH_IOU:
+            unmatched.remove(match)
+            boxes.append(tuple(round(start + (end - start) * ratio) for start, end in zip(box, match)))
+        else:
+            boxes.append(box)
+    boxes.extend(unmatched)
+    return boxes
+
+
+def blur(frame, box=None):
+    """ Blurs the box of the frame in place (the whole frame if there's no box). """
+    height, width = frame.shape[:2]
+    if box is None:
+        x0, y0, x1, y1 = 0, 0, width, height
+    else:
+        x, y, w, h = box
+        pad_x, pad_y = int(w * RedactionConstants.PADDING), int(h * RedactionConstants.PADDING)
+        x0, y0 = max(0, x - pad_x), max(0, y - pad_y)
+        x1, y1 = min(width, x + w + pad_x), min(height, y + h + pad_y)
+    if x1 <= x0 or y1 <= y0:
+        return
+    region = frame[y0:y1, x0:x1]
+    small = cv.resize(region, (max(1, (x1 - x0) // BLUR_DOWNSCALE), max(1, (y1 - y0) // BLUR_DOWNSCALE)), interpolation=cv.INTER_AREA)
+    frame[y0:y1, x0:x1] = cv.resize(small, (x1 - x0, y1 - y0), interpolation=cv.INTER_LINEAR)
+
+
+class RedactionReport:
+
+    def __init__(self, frames: int, detections: int, boxes: int, elapsed: float, failed: bool) -> None:
+        self.frames = frames
+        self.detections = detections  # Frames the detector ran on
+        self.boxes = boxes  # Boxes blurred over all frames
+        self.elapsed = elapsed
+        self.failed = failed  # Whole frames were blurred
+
+    @property
+    def frames_per_sec(self):
+        return self.frames / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __repr__(self) -> str:
+        return f'RedactionReport[frames= {self.frames}, detections= {self.detections}, boxes= {self.boxes}, elapsed= {self.elapsed * 1000:.0f} ms ({self.frames_per_sec:.1f} fps), failed= {self.failed}]'
+
+
+class Redactor:
+    """
+    Blurs faces & plates of video clips before they're encoded.
+
+    The detector runs on downscaled grayscale copies of every `DETECT_EVERY`-th frame (and the
+    last one) in a pool of processes, the boxes of the frames in between are interpolated.
+    Boxes are blurred on the full frames in place. If detection can't be done, whole frames
+    are blurred instead (unless `FAIL_CLOSED` is off) so raw footage never leaves the unit.
+    Detection running past its timeout or losing a worker kills the processes, new ones are
+    started in background.
+    """
+
+    def __init__(self, stride=RedactionConstants.DETECT_EVERY, workers=RedactionConstants.WORKERS) -> None:
+        self.stride = max(1, stride)
+        self.workers = workers or max(1, (os.cpu_count() or 1) - 1)
+        self.logger = Logger("Redactor")
+        self.pool = None
+        self.lock = Lock()
+        self.closed = False
+        # Metrics
+        self.latency = registry.histogram('redaction_seconds', 'Duration of redacting accident videos.')
+        self.frame_latency = registry.histogram('redaction_frame_seconds', 'Secs redacting took per frame of a video.')
+        self.boxes_count = registry.counter('redaction_boxes_total', 'Boxes blurred over all frames.')
+        self.failures = registry.counter('redaction_failures_total', 'Videos whose frames were blurred whole as detection failed.')
+        self.restarts = registry.counter('redaction_restarts_total', 'Times the detector processes were killed after a timeout or a dead worker.')
+
+    def open(self):
+        """ Starts the detector processes (they load the cascades once). """
+        self.closed = False
+        if self.pool is not None:
+            return
+        paths = find_cascades()
+        # Processes are started from a clean server rather than forked from the threads of the system
+        context = multiprocessing.get_context('forkserver')
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=init_detector, initargs=(paths,))
+        try:
+            # Warm the processes up so the first accident doesn't pay for it
+            for job in [pool.submit(detect_boxes, []) for _ in range(self.workers)]:
+                job.result(timeout=RedactionConstants.TIMEOUT)
+        except Exception:
+            terminate_workers(pool)
+            raise
+        with self.lock:
+            if self.pool is not None or self.closed:
+                # Opened or closed meanwhile
+                terminate_workers(pool)
+                return
+            self.pool = pool
+        self.logger.success(f"Redactor is ready | Workers= {self.workers} Detect every= {self.stride} frame(s)")
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def redact(self, video_buffer):
+        """ Blurs faces & plates of the frames of the video buffer in place.
+
+        Returns:
+            RedactionReport: Throughput & outcome of the redaction.
+        """
+        report = self.redact_frames(list(video_buffer))
+        self.latency.observe(report.elapsed)
+        if report.frames > 0:
+            self.frame_latency.observe(report.elapsed / report.frames)
+        if report.frames_per_sec < video_buffer.framerate:
+            self.logger.warning(f"Redaction is slower than capture: {report}")
+        else:
+            self.logger.info(f"Redacted video: {report}")
+        return report
+
+    def redact_frames(self, frames: list, stride=None, timeout=RedactionConstants.TIMEOUT):
+        """ Blurs faces & plates of the frames in place.
+
+        Args:
+            stride (int): Frames between detections (the redactor's by default), 1 for frames that aren't consecutive.\n
+            timeout (float): Secs detection may take before frames are blurred whole.
+
+        Returns:
+            RedactionReport: Throughput & outcome of the redaction.
+        """
+        started_at = perf_counter()
+        load_libraries()
+        stride = max(1, stride or self.stride)
+        detected = {}
+        failed = False
+        try:
+            detected = self.__detect(frames, stride, timeout)
+        except Exception as e:
+            failed = True
+            self.logger.error(f"Can't detect what to redact. Reason: {e}")
+        boxes_count = 0
+        if failed:
+            if RedactionConstants.FAIL_CLOSED:
+                self.failures.inc()
+                for frame in frames:
+                    blur(frame)
+        else:
+            for index, frame in enumerate(frames):
+                boxes = self.__boxes_of(index, detected, stride)
+                for box in boxes:
+                    blur(frame, box)
+                boxes_count += len(boxes)
+        self.boxes_count.inc(boxes_count)
+        return RedactionReport(len(frames), len(detected), boxes_count, perf_counter() - started_at, failed)
+
+    def __detect(self, frames: list, stride: int, timeout: float):
+        pool = self.pool
+        if pool is None:
+            raise RuntimeError("Redactor isn't open.")
+        if len(frames) == 0:
+            return {}
+        indices = list(range(0, len(frames), stride))
+        if indices[-1] != len(frames) - 1:
+            indices.append(len(frames) - 1)
+        # Scan downscaled copies, only they are sent to the detector processes
+        height, width = frames[0].shape[:2]
+        scale = min(1.0, RedactionConstants.DETECTION_WIDTH / width)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        copies = [(index, cv.cvtColor(cv.resize(frames[index], size, interpolation=cv.INTER_AREA), cv.COLOR_BGR2GRAY)) for index in indices]
+        # A couple of chunks per worker evens out slow frames
+        chunk_size = max(1, -(-len(copies) // (self.workers * 2)))
+        try:
+            jobs = [pool.submit(detect_boxes, copies[start:start + chunk_size]) for start in range(0, len(copies), chunk_size)]
+            done, pending = wait(jobs, timeout=timeout)
+            if pending:
+                # Chunks already running can't be cancelled, they'd hold the processes up for the next clips
+                self.__restart(pool, "a timeout")
+                raise TimeoutError(f"Detection took over {timeout} secs.")
+            results = [job.result() for job in done]
+        except BrokenProcessPool:
+            # A worker died (e.g. killed when out of memory), the pool takes no more jobs
+            self.__restart(pool, "a worker died")
+            raise
+        detected = {}
+        for result in results:
+            for index, boxes in result:
+                detected[index] = [tuple(round(value / scale) for value in box) for box in boxes]
+        return detected
+
+    def __restart(self, pool: ProcessPoolExecutor, reason: str):
+        with self.lock:
+            if self.pool is not pool:
+                # Restarted already
+                return
+            self.pool = None
+        terminate_workers(pool)
+        self.restarts.inc()
+        self.logger.warning(f"Killed the detector processes after {reason}. Starting new ones...")
+        Thread(name="RedactorRestart", target=self.__reopen, daemon=True).start()
+
+    def __reopen(self):
+        try:
+            if not self.closed:
+                self.open()
+        except Exception as e:
+            self.logger.error(f"Can't restart the detector processes. Reason: {e}")
+
+    @staticmethod
+    def __boxes_of(index: int, detected: dict, stride: int):
+        if index in detected:
+            return detected[index]
+        before = index - index % stride
+        after = min(before + stride, max(detected))
+        return interpolate(detected[before], detected[after], (index - before) / (after - before))
+
+
+if __name__ == '__main__':
+    # Benchmark on a synthetic 10 secs clip at 640x480 with a face sample (if OpenCV has one)
+    import numpy as np
+    from time import monotonic
+    from camera import VideoBuffer
+    load_libraries()
+    framerate = 15
+    sample = None
+    samples_dir = os.path.join(os.path.dirname(cv.__file__), 'data')
+    for name in ('lena.jpg', 'face.jpg'):
+        if os.path.exists(os.path.join(samples_dir, name)):
+            sample = cv.resize(cv.imread(os.path.join(samples_dir, name)), (160, 160))
+    video_buffer = VideoBuffer(framerate=framerate, max_frame_count=framerate * 10)
+    start = monotonic()
+    for idx in range(framerate * 10):
+        frame = np.random.randint(0, 60, (480, 640, 3), dtype=np.uint8)
+        if sample is not None:
+            x = 100 + idx * 2
+            frame[160:320, x:x + 160] = sample
+        video_buffer.push(frame, idx, start + idx / framerate)
+    for stride in (1, 5, 10):
+        # Frames are redacted in place, every run gets copies of the raw ones (clones share them)
+        clip = VideoBuffer(framerate=framerate, max_frame_count=framerate * 10)
+        for frame, seq, at in video_buffer.entries:
+            clip.push(frame.copy(), seq, at)
+        redactor = Redactor(stride=stride)
+        redactor.open()
+        print(f"Detect every {stride} frame(s): {redactor.redact(clip)}")
+        redactor.close()
@@ -0,0 +1,38 @@
+from abc import ABC, abstractmethod
+
+
+class ReporterBackend(ABC):
+    """
+    Remote side accidents are reported to.
+
+    A backend creates the storage that videos are uploaded to and the messaging that
+    alerts clients. Storage exposes `upload_file(filepath, remote_path) -> bool` and
+    `reference_of(remote_path) -> str`, messaging exposes `start()`, `stop()` and
+    `send_notification(payload) -> NotificationReport`.
+    """
+
+    def setup(self):
+        pass
+
+    @abstractmethod
+    def create_storage(self):
+        pass
+
+    @abstractmethod
+    def create_messaging(self):
+        pass
+
+
+class NotificationReport:
+
+    def __init__(self) -> None:
+        self.sent = {}
+        self.failed = {}
+        self.unregistered = {}
+        self.elapsed = 0.0
+
+    def __bool__(self):
+        return len(self.sent) > 0
+
+    def __repr__(self) -> str:
+        return f'NotificationReport[sent= {len(self.sent)}, failed= {len(self.failed)}, unregistered= {len(self.unregistered)}, elapsed= {self.elapsed * 1000:.0f} ms]'
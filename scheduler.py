@@ -0,0 +1,111 @@
+import asyncio
+from time import process_time
+from concurrent.futures import ThreadPoolExecutor
+
+from logger import Logger
+from metrics import registry
+
+
+class Scheduler:
+    """
+    Core event loop the system services run on.
+
+    I/O-bound services run as named asyncio tasks that wait on their I/O or timers
+    instead of polling in threads of their own, blocking or CPU-bound work is handed
+    to the executor with `to_thread`. Tasks can be spawned and cancelled from any thread.
+    The loop runs on the thread calling `run` (the main thread, so it gets the signals).
+    """
+
+    def __init__(self, max_workers=4) -> None:
+        self.logger = Logger("Scheduler")
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="SchedulerWorker")
+        self.loop.set_default_executor(self.executor)
+        self.tasks = {}
+        self.stop_signal = None
+        self.stop_requested = False
+        # Metrics
+        registry.gauge('process_cpu_seconds', 'CPU time used by the process (user + system).').set_function(process_time)
+        registry.gauge('scheduler_tasks', 'Tasks running on the scheduler.').set_function(lambda: len(self.tasks))
+
+    @property
+    def running(self):
+        return self.loop.is_running()
+
+    def run(self, main=None):
+        """ Runs the loop on the calling thread until `stop` is called.
+
+        Args:
+            main (coroutine function): Spawned first as the 'main' task (optional).
+        """
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.__main(main))
+        finally:
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+
+    def stop(self):
+        """ Cancels all tasks and makes `run` return. Safe to call from any thread. """
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.__request_stop)
+
+    def spawn(self, name: str, job, *args):
+        """ Runs the coroutine function as a task named name (replacing a running one with the same name). """
+        self.loop.call_soon_threadsafe(self.__create_task, name, job, args)
+
+    def cancel(self, name: str):
+        self.loop.call_soon_threadsafe(self.__cancel_task, name)
+
+    def call(self, callback, *args):
+        """ Calls the callback on the loop thread. """
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    async def to_thread(self, job, *args):
+        """ Runs the blocking job on the executor without blocking the loop. """
+        return await self.loop.run_in_executor(self.executor, job, *args)
+
+    def add_signal_handler(self, signum: int, callback):
+        self.loop.call_soon_threadsafe(self.loop.add_signal_handler, signum, callback)
+
+    async def __main(self, main):
+        self.stop_signal = asyncio.Event()
+        if self.stop_requested:
+            self.stop_signal.set()
+        if main is not None:
+            self.__create_task('main', main, ())
+        self.logger.success("Scheduler started running.")
+        await self.stop_signal.wait()
+        # Cancel whatever is still running (tasks scheduled by services directly too)
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.logger.info("Scheduler stopped running.")
+
+    def __request_stop(self):
+        self.stop_requested = True
+        if self.stop_signal is not None:
+            self.stop_signal.set()
+
+    def __create_task(self, name: str, job, args: tuple):
+        self.__cancel_task(name)
+        task = self.loop.create_task(self.__guard(name, job, args), name=name)
+        self.tasks[name] = task
+
+    def __cancel_task(self, name: str):
+        task = self.tasks.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+    async def __guard(self, name: str, job, args: tuple):
+        try:
+            await job(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.error(f"Task '{name}' failed. Reason: {e}")
+        finally:
+            if self.tasks.get(name) is asyncio.current_task():
+                del self.tasks[name]
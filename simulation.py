@@ -0,0 +1,439 @@
+"""
+Headless end-to-end simulation of the whole system on a PC.
+
+AASSL runs as is on the emulated hardware (pc_toolkit): a synthetic camera, a replayed
+GPS route, scripted presses of the crash button, the emulated GSM modem and the local
+reporter backend. Scenarios run at `speed` times real time (camera clock, GPS replay,
+scenario timeline & outbox backoff) and end with a throughput/latency/memory report.
+
+    python simulation.py [single_crash|repeated_crashes|network_outage|all] [--speed 10] [--report report.json]
+"""
+import os
+import sys
+import json
+import math
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+from threading import Thread, Event
+from time import sleep, monotonic, process_time, time as current_time
+
+import constants
+
+# Modules pick the emulated hardware once they're imported, so switch first
+constants.set_test_mode(True)
+
+import utils
+from logger import Logger, writer as log_writer
+from metrics import registry
+from blackbox import recorder
+from aassl import AASSL
+from local_backend import LocalBackend
+from pc_toolkit import PCCamera, gpio
+from crash_reporter import AccidentKeys, CarKeys, ReportingStages
+from constants import IOPins, MetricsConstants, MemoryConstants
+
+
+# Buffers are budgeted as on a 512 MB board whatever the host has (640x480 for 5 secs)
+MEMORY_BUDGET = 176 * 1024 * 1024
+
+# Secs the background writers get to finish once the system is stopped
+WRITERS_JOIN_TIMEOUT = 10.0
+
+
+class Scenario:
+
+    def __init__(self, name: str, duration: float, crashes=(), outages=(), route_speed=50.0, description='') -> None:
+        self.name = name
+        self.duration = duration  # Simulated secs
+        self.crashes = tuple(crashes)  # Simulated secs the crash button is pressed at
+        self.outages = tuple(outages)  # (start, end) simulated secs the network is down
+        self.route_speed = route_speed  # km/h
+        self.description = description
+
+    def timeline(self):
+        """ Returns the scripted events as sorted (simulated secs, kind) tuples. """
+        events = [(at, 'crash') for at in self.crashes]
+        for start, end in self.outages:
+            events.append((start, 'outage_start'))
+            events.append((end, 'outage_end'))
+        return sorted(events)
+
+    def __repr__(self) -> str:
+        return f'Scenario[{self.name}: duration= {self.duration} secs, crashes= {len(self.crashes)}, outages= {len(self.outages)}]'
+
+
+SCENARIOS = {
+    'single_crash': Scenario(
+        'single_crash', duration=30, crashes=(15,),
+        description="One crash while driving."),
+    'repeated_crashes': Scenario(
+        'repeated_crashes', duration=95, crashes=(15, 45, 75),
+        description="Crashes in a row, each after the previous one was handled."),
+    'network_outage': Scenario(
+        'network_outage', duration=120, crashes=(15,), outages=((10, 90),),
+        description="Crash while the network is down, reported once it's back."),
+}
+
+
+class GPSReplay:
+    """ Feeds a GPS route (simulated secs, lat, lng, km/h) to the emulated GPS at `speed` times real time. """
+
+    def __init__(self, gps, route: list, speed=1.0) -> None:
+        self.gps = gps
+        self.route = route
+        self.speed = speed
+        self.switcher = Event()
+        self.logger = Logger("GPSReplay")
+
+    @staticmethod
+    def synthetic_route(duration: float, speed_kmh: float, start=(30.0346762, 31.4295489)):
+        """ Returns a straight route heading north-east with a fix every simulated sec. """
+        step = speed_kmh / 3600 / 111.32 / math.sqrt(2)  # Degrees per sec on each axis
+        lat, lng = start
+        return [(t, lat + step * t, lng + step * t, speed_kmh) for t in range(int(duration) + 1)]
+
+    @staticmethod
+    def load_nmea(filepath: str):
+        """ Returns the route recorded in a NMEA log (its $GPRMC sentences). """
+        route = []
+        first = None
+        with open(filepath, 'r', errors='replace') as file:
+            for line in file:
+                fields = line.strip().split(',')
+                if not fields[0].endswith('RMC') or len(fields) < 8 or fields[2] != 'A':
+                    continue
+                try:
+                    at = int(fields[1][:2]) * 3600 + int(fields[1][2:4]) * 60 + float(fields[1][4:])
+                    lat = float(fields[3][:2]) + float(fields[3][2:]) / 60
+                    lng = float(fields[5][:3]) + float(fields[5][3:]) / 60
+                    speed = float(fields[7] or 0) * 1.852
+                except ValueError:
+                    continue
+                if fields[4] == 'S':
+                    lat = -lat
+                if fields[6] == 'W':
+                    lng = -lng
+                first = at if first is None else first
+                route.append((at - first, lat, lng, speed))
+        return route
+
+    def start(self):
+        if not self.switcher.is_set():
+            self.switcher.set()
+            Thread(name="GPSReplay", target=self.__replay_job, daemon=True).start()
+
+    def stop(self):
+        self.switcher.clear()
+
+    def __replay_job(self):
+        started_at = monotonic()
+        for at, lat, lng, speed in self.route:
+            delay = started_at + at / self.speed - monotonic()
+            if delay > 0:
+                sleep(delay)
+            if not self.switcher.is_set():
+                return
+            self.gps.feed(lat, lng, speed)
+        self.logger.info(f"Replayed {len(self.route)} fix(es).")
+
+
+class MemorySampler:
+    """ Samples the resident memory of the process every `interval` secs. """
+
+    def __init__(self, interval=0.25) -> None:
+        self.interval = interval
+        self.switcher = Event()
+        self.samples = []
+
+    def start(self):
+        if not self.switcher.is_set():
+            self.switcher.set()
+            self.samples.append(utils.process_rss())
+            Thread(name="MemorySampler", target=self.__sampler_job, daemon=True).start()
+
+    def stop(self):
+        if self.switcher.is_set():
+            self.switcher.clear()
+            self.samples.append(utils.process_rss())
+
+    def __sampler_job(self):
+        while self.switcher.is_set():
+            self.samples.append(utils.process_rss())
+            sleep(self.interval)
+
+
+class Simulation:
+    """
+    Runs one scenario against a full AASSL instance.
+
+    Everything the system writes (captures, outbox, black box, bucket...) goes to `workdir`.
+    Latencies in the report are wall-clock secs, the parts paced by the camera or the
+    timeline are shortened by `speed`.
+    """
+
+    def __init__(self, scenario: Scenario, speed=10.0, workdir=None, route=None, latency=0.05, bandwidth=None) -> None:
+        self.scenario = scenario
+        self.speed = speed
+        self.workdir = workdir if workdir is not None else tempfile.mkdtemp(prefix=f"aassl-{scenario.name}-")
+        self.route = route if route is not None else GPSReplay.synthetic_route(scenario.duration, scenario.route_speed)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.logger = Logger("Simulation")
+        # Runtime
+        self.aassl = None
+        self.backend = None
+        self.triggers = []  # Wall time of every crash button press
+        self.outages = []  # Wall time (start, end) of every outage
+        self.memory = MemorySampler()
+        self.report = None
+
+    def run(self):
+        """ Runs the scenario until it's done (blocks the calling thread, the main one preferably).
+
+        Returns:
+            dict: Report of the run.
+        """
+        previous_cwd = os.getcwd()
+        os.makedirs(os.path.join(self.workdir, 'data'), exist_ok=True)
+        self.__write_car_config()
+        # System paths are relative to the working dir
+        os.chdir(self.workdir)
+        try:
+            PCCamera.synthetic_speed = self.speed
+            MetricsConstants.EXPORT_PORT = 0
+            MemoryConstants.BUDGET_LIMIT = MEMORY_BUDGET
+            self.backend = LocalBackend(bucket_dir=os.path.join(self.workdir, 'bucket'), latency=self.latency, bandwidth=self.bandwidth)
+            self.aassl = AASSL(self.backend)
+            # Retries back off in simulated time too
+            outbox = self.aassl.crash_reporter.outbox
+            outbox.base_delay /= self.speed
+            outbox.max_delay /= self.speed
+            # So does the black box window after the crash
+            self.aassl.crash_reporter.export_after /= self.speed
+            self.logger.info(f"Running {self.scenario} at x{self.speed} in '{self.workdir}'")
+            Thread(name="SimulationScript", target=self.__script_job, daemon=True).start()
+            # Blocks until the script stops the system
+            self.aassl.boot()
+        finally:
+            # Writers finish on paths relative to the workdir, wait for them before leaving it
+            if self.aassl is not None:
+                self.aassl.crash_reporter.outbox.join(timeout=WRITERS_JOIN_TIMEOUT)
+            recorder.join(timeout=WRITERS_JOIN_TIMEOUT)
+            log_writer.close_file()
+            os.chdir(previous_cwd)
+        return self.report
+
+    def __write_car_config(self):
+        with open(os.path.join(self.workdir, 'data', utils.CONFIG_FILENAME), 'w') as config:
+            config.writelines([
+                f"{CarKeys.CAR_ID},SIM-{self.scenario.name}\n",
+                f"{CarKeys.CAR_MODEL},Simulated\n",
+                f"{CarKeys.CAR_OWNER},Simulation\n",
+                f"{CarKeys.EMERGENCY},+200000000001,+200000000002\n",
+            ])
+
+    def __script_job(self):
+        replay = None
+        try:
+            # Steps the scenario needs to be up
+            for step in ('car', 'camera', 'reporter'):
+                if not self.aassl.startup.wait(step, timeout=60):
+                    raise RuntimeError(f"Startup step '{step}' didn't succeed.")
+            self.memory.start()
+            replay = GPSReplay(self.aassl.gps, self.route, self.speed)
+            replay.start()
+            started_at = monotonic()
+            cpu_started_at = process_time()
+            for at, kind in self.scenario.timeline():
+                self.__sleep_until(started_at + at / self.speed)
+                self.__apply(kind)
+            self.__sleep_until(started_at + self.scenario.duration / self.speed)
+            settled = self.__wait_settled(timeout=max(60.0, 2 * self.scenario.duration / self.speed))
+            self.report = self.__build_report(monotonic() - started_at, process_time() - cpu_started_at, settled)
+        except Exception as e:
+            self.logger.error(f"Scenario '{self.scenario.name}' failed. Reason: {e}")
+            self.report = {'scenario': self.scenario.name, 'error': str(e), 'passed': False}
+        finally:
+            if replay is not None:
+                replay.stop()
+            self.memory.stop()
+            self.aassl.stop_system()
+
+    @staticmethod
+    def __sleep_until(deadline: float):
+        delay = deadline - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+    def __apply(self, kind: str):
+        if kind == 'crash':
+            self.logger.info("Pressing crash button...")
+            self.triggers.append(current_time())
+            gpio.pulse(IOPins.PIN_CRASHING_BUTTON, hold=0.3)
+        elif kind == 'outage_start':
+            self.logger.warning("Network is down.")
+            self.backend.server.error_rate = 1.0
+            self.outages.append([current_time(), None])
+        elif kind == 'outage_end':
+            self.logger.info("Network is back.")
+            self.backend.server.error_rate = 0.0
+            self.outages[-1][1] = current_time()
+
+    def __notifications(self, stage: str):
+        """ Returns the first notification of every accident of the stage by its timestamp. """
+        with self.backend.server.lock:
+            messages = list(self.backend.server.notifications)
+        received = {}
+        for message in messages:
+            data = message.get('data', {})
+            if data.get(AccidentKeys.STAGE) == stage:
+                received.setdefault(data.get(AccidentKeys.TIMESTAMP), message['received_at'])
+        return received
+
+    def __wait_settled(self, timeout: float):
+        """ Waits for every detected accident to be handled & fully reported.
+
+        Returns:
+            bool: True if the system settled in time, False otherwise.
+        """
+        deadline = monotonic() + timeout
+        detector = self.aassl.car.crash_detector
+        while monotonic() < deadline:
+            accidents = self.aassl.accidents_count.value
+            if detector.detecting and self.aassl.crash_reporter.outbox.pending_count == 0 and len(self.__notifications(ReportingStages.VIDEO_READY)) >= accidents:
+                return True
+            sleep(0.1)
+        self.logger.warning(f"System didn't settle within {timeout:.0f} secs.")
+        return False
+
+    def __build_report(self, elapsed: float, cpu: float, settled: bool):
+        alerts = self.__notifications(ReportingStages.ALERT)
+        videos = self.__notifications(ReportingStages.VIDEO_READY)
+        timestamps = sorted(int(timestamp) for timestamp in alerts if timestamp)
+        # Match every press to the first accident detected after it
+        accidents = []
+        for index, trigger in enumerate(self.triggers):
+            until = self.triggers[index + 1] if index + 1 < len(self.triggers) else math.inf
+            timestamp = next((timestamp for timestamp in timestamps if trigger <= timestamp / 1000 < until), None)
+            accident = {'triggered_at': trigger, 'timestamp': timestamp}
+            if timestamp is not None:
+                accident['detect'] = timestamp / 1000 - trigger
+                accident['alert'] = alerts[f"{timestamp}"] - trigger
+                if f"{timestamp}" in videos:
+                    accident['video_ready'] = videos[f"{timestamp}"] - trigger
+            accidents.append(accident)
+
+        def latency(stage: str):
+            values = [accident[stage] for accident in accidents if stage in accident]
+            if len(values) == 0:
+                return None
+            return {'p50': utils.percentile(values, 50), 'p95': utils.percentile(values, 95), 'max': max(values)}
+
+        frames = registry.counter('camera_frames_captured_total').value
+        dropped = registry.counter('camera_frames_dropped_total').value
+        missed = registry.counter('camera_frames_missed_total').value
+        encode = registry.histogram('accident_encode_seconds')
+        samples = self.memory.samples or [utils.process_rss()]
+        bucket_dir = os.path.join(self.workdir, 'bucket')
+        uploaded = sum(entry.stat().st_size for entry in os.scandir(bucket_dir) if entry.is_file() and not entry.name.startswith('.')) if os.path.isdir(bucket_dir) else 0
+        detected = sum(1 for accident in accidents if accident['timestamp'] is not None)
+        reported = sum(1 for accident in accidents if 'video_ready' in accident)
+        return {
+            'scenario': self.scenario.name,
+            'speed': self.speed,
+            'workdir': self.workdir,
+            'elapsed': elapsed,
+            'passed': settled and detected == len(self.triggers) and reported == detected,
+            'accidents': {
+                'triggered': len(self.triggers),
+                'detected': detected,
+                'reported': reported,
+                'sms_sent': len(self.aassl.gsm_simulator.sent_messages),
+            },
+            'latency': {
+                'detect': latency('detect'),
+                'alert': latency('alert'),
+                'video_ready': latency('video_ready'),
+                'encode': encode.sum / encode.count if encode.count > 0 else None,
+            },
+            'throughput': {
+                'frames_per_sec': frames / elapsed if elapsed > 0 else 0.0,
+                'frames_captured': frames,
+                'frames_dropped': dropped,
+                'frames_missed': missed,
+                'uploaded_bytes': uploaded,
+                'cpu_secs': cpu,
+                'cpu_ratio': cpu / elapsed if elapsed > 0 else 0.0,
+            },
+            'memory': {
+                'rss_start': samples[0],
+                'rss_peak': max(samples),
+                'rss_end': samples[-1],
+            },
+            'outages': self.outages,
+            'details': accidents,
+        }
+
+
+def format_report(report: dict):
+    """ Returns the report as a few human readable lines. """
+    if 'error' in report:
+        return f"[{report['scenario']}] FAILED: {report['error']}"
+
+    def ms(value):
+        return f"{value * 1000:.0f} ms" if value is not None else "-"
+
+    def stats(value):
+        return f"p50 {ms(value['p50'])} / p95 {ms(value['p95'])} / max {ms(value['max'])}" if value is not None else "-"
+
+    mb = 1024 * 1024
+    accidents, latency, throughput, memory = report['accidents'], report['latency'], report['throughput'], report['memory']
+    return "\n".join([
+        f"[{report['scenario']}] {'PASSED' if report['passed'] else 'FAILED'} in {report['elapsed']:.1f} secs (x{report['speed']}) | Workdir= {report['workdir']}",
+        f"  Accidents: triggered {accidents['triggered']} | detected {accidents['detected']} | reported {accidents['reported']} | SMS {accidents['sms_sent']}",
+        f"  Detect: {stats(latency['detect'])}",
+        f"  Alert: {stats(latency['alert'])}",
+        f"  Video ready: {stats(latency['video_ready'])} | Encode avg {ms(latency['encode'])}",
+        f"  Throughput: {throughput['frames_per_sec']:.1f} fps | dropped {throughput['frames_dropped']} | missed {throughput['frames_missed']} | uploaded {throughput['uploaded_bytes'] / 1024:.0f} KB | CPU {throughput['cpu_ratio'] * 100:.0f}%",
+        f"  Memory: RSS start {memory['rss_start'] / mb:.1f} MB | peak {memory['rss_peak'] / mb:.1f} MB | end {memory['rss_end'] / mb:.1f} MB",
+    ])
+
+
+def run_isolated(name: str, speed: float):
+    """ Runs the scenario in a process of its own (system singletons & memory stats are per process). """
+    fd, report_path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        subprocess.run([sys.executable, os.path.abspath(__file__), name, '--speed', f"{speed}", '--report', report_path], check=False)
+        with open(report_path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        return {'scenario': name, 'error': f"No report. Reason: {e}", 'passed': False}
+    finally:
+        os.remove(report_path)
+
+
+def main(args=None):
+    parser = ArgumentParser(description="Runs AASSL scenarios on emulated hardware.")
+    parser.add_argument('scenarios', nargs='*', default=['single_crash'], help=f"{', '.join(SCENARIOS)} or all")
+    parser.add_argument('--speed', type=float, default=10.0, help="Times faster than real time")
+    parser.add_argument('--report', help="Writes the JSON report(s) to this file")
+    params = parser.parse_args(args)
+    names = list(SCENARIOS) if 'all' in params.scenarios else params.scenarios
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error(f"Unknown scenario '{name}'.")
+    if len(names) == 1:
+        reports = [Simulation(SCENARIOS[names[0]], speed=params.speed).run()]
+    else:
+        reports = [run_isolated(name, params.speed) for name in names]
+    if params.report:
+        with open(params.report, 'w') as file:
+            json.dump(reports[0] if len(reports) == 1 else reports, file, indent=2)
+    print("\n".join(format_report(report) for report in reports))
+    return 0 if all(report['passed'] for report in reports) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
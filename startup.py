@@ -0,0 +1,122 @@
+from threading import Condition, Event
+from time import perf_counter_ns
+from concurrent.futures import ThreadPoolExecutor
+
+from logger import Logger
+
+
+class StartupStep:
+
+    def __init__(self, name: str, job, deps: tuple, critical: bool) -> None:
+        self.name = name
+        self.job = job
+        self.deps = deps
+        self.critical = critical
+        self.done_signal = Event()
+        self.scheduled = False
+        self.succeeded = False
+        self.elapsed = 0.0  # Secs
+        self.error = None
+
+
+class StartupGraph:
+    """
+    Runs startup steps concurrently, each as soon as the steps it depends on are done.
+
+    Steps whose dependencies failed are skipped. Once every critical step is done the
+    `on_armed` callback runs right away, without waiting for the rest of the graph.
+    """
+
+    def __init__(self, max_workers=4) -> None:
+        self.logger = Logger("Startup")
+        self.steps = {}
+        self.max_workers = max_workers
+        self.condition = Condition()
+        self.pending = 0
+        self.armed = False
+        self.on_armed = None
+
+    def add(self, name: str, job, deps=(), critical=False):
+        for dep in deps:
+            if dep not in self.steps:
+                raise ValueError(f"Step '{name}' depends on unknown step '{dep}'.")
+        self.steps[name] = StartupStep(name, job, tuple(deps), critical)
+        return self
+
+    def wait(self, name: str, timeout=None):
+        """ Waits for the step to be done.
+
+        Returns:
+            bool: True if the step is done and succeeded, False otherwise.
+        """
+        step = self.steps[name]
+        return step.done_signal.wait(timeout) and step.succeeded
+
+    def run(self, on_armed=None):
+        """ Runs the whole graph and blocks until every step is done.
+
+        Returns:
+            bool: True if all steps succeeded, False otherwise.
+        """
+        self.on_armed = on_armed
+        self.pending = len(self.steps)
+        self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="StartupStep")
+        for step in self.steps.values():
+            if len(step.deps) == 0:
+                step.scheduled = True
+                self.pool.submit(self.__run_step, step)
+        self.__check_armed()
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending == 0)
+        self.pool.shutdown(wait=False)
+        return all(step.succeeded for step in self.steps.values())
+
+    def summary(self):
+        return " | ".join(
+            f"{step.name}= {step.elapsed * 1000:.0f} ms" if step.succeeded else f"{step.name}= failed"
+            for step in self.steps.values()
+        )
+
+    def __run_step(self, step: StartupStep):
+        started_at = perf_counter_ns()
+        try:
+            step.job()
+            step.succeeded = True
+        except Exception as e:
+            step.error = e
+            self.logger.error(f"Startup step '{step.name}' failed. Reason: {e}")
+        step.elapsed = (perf_counter_ns() - started_at) / 1e9
+        self.__finish(step)
+
+    def __finish(self, step: StartupStep):
+        step.done_signal.set()
+        ready = []
+        skipped = []
+        with self.condition:
+            self.pending -= 1
+            for other in self.steps.values():
+                if other.scheduled or step.name not in other.deps:
+                    continue
+                deps = [self.steps[dep] for dep in other.deps]
+                if any(dep.done_signal.is_set() and not dep.succeeded for dep in deps):
+                    other.scheduled = True
+                    skipped.append(other)
+                elif all(dep.done_signal.is_set() for dep in deps):
+                    other.scheduled = True
+                    ready.append(other)
+            self.condition.notify_all()
+        for other in skipped:
+            self.logger.warning(f"Skipped startup step '{other.name}' as its dependencies failed.")
+            self.__finish(other)
+        for other in ready:
+            self.pool.submit(self.__run_step, other)
+        self.__check_armed()
+
+    def __check_armed(self):
+        with self.condition:
+            critical = [step for step in self.steps.values() if step.critical]
+            if self.armed or not all(step.done_signal.is_set() for step in critical):
+                return
+            self.armed = True
+        if self.on_armed is not None:
+            self.on_armed(all(step.succeeded for step in critical))
@@ -0,0 +1,184 @@
+import os
+import asyncio
+from time import monotonic
+
+from logger import Logger
+from metrics import registry
+from scheduler import Scheduler
+
+
+class Heartbeat:
+    """ Counter a worker bumps on every iteration, the supervisor samples it. """
+
+    __slots__ = ('count',)
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def beat(self):
+        self.count += 1
+
+
+class SupervisedComponent:
+
+    def __init__(self, name: str, heartbeat: Heartbeat, timeout: float, restart, is_active=None, critical=False, max_inactive=None) -> None:
+        """
+        Args:
+            max_inactive (float): Secs the component may stay inactive before it's stalled too (None for no bound).
+        """
+        self.name = name
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.restart = restart
+        self.is_active = is_active
+        self.critical = critical
+        self.max_inactive = max_inactive
+        # Runtime
+        self.last_count = heartbeat.count
+        self.last_change = monotonic()
+        self.inactive_since = None
+        self.healthy = True
+        self.failures = 0
+        self.next_restart_at = 0.0
+        # Metrics
+        labels = {'component': name}
+        self.restarts = registry.counter('supervisor_restarts_total', 'Components restarted by the supervisor.', labels)
+        registry.gauge('component_healthy', 'Whether the component beats as expected (1) or not (0).', labels).set_function(lambda: int(self.healthy))
+
+    @property
+    def active(self):
+        """ Whether beats are expected now (a suspended worker doesn't beat). """
+        return self.is_active is None or self.is_active()
+
+
+class Supervisor:
+    """
+    Watches the heartbeats of the system workers.
+
+    A worker that stops beating for `timeout` secs while it's active (or stays inactive
+    past its `max_inactive` bound) is restarted, with an exponential backoff between restarts that keep failing, without touching the
+    others. The hardware watchdog is fed only while every critical component is
+    healthy, so the board is rebooted if restarting them doesn't help.
+    Beating costs an attribute increment, the supervisor samples counts every `interval` secs.
+    """
+
+    def __init__(self, scheduler: Scheduler, watchdog_path=None, interval=1.0, base_delay=2.0, max_delay=60.0) -> None:
+        self.scheduler = scheduler
+        self.watchdog_path = watchdog_path
+        self.interval = interval
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.logger = Logger("Supervisor")
+        self.components = {}
+        self.watchdog_fd = None
+        self.running = False
+
+    def watch(self, name: str, heartbeat: Heartbeat, timeout: float, restart, is_active=None, critical=False, max_inactive=None):
+        self.components[name] = SupervisedComponent(name, heartbeat, timeout, restart, is_active, critical, max_inactive)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.__open_watchdog()
+        self.scheduler.spawn("Supervisor", self.__supervisor_job)
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.scheduler.cancel("Supervisor")
+        self.__close_watchdog()
+
+    @property
+    def healthy(self):
+        return all(component.healthy for component in self.components.values() if component.critical)
+
+    def check(self):
+        """ Samples heartbeats and restarts the components that stalled.
+
+        Returns:
+            list: Components due to be restarted.
+        """
+        now = monotonic()
+        due = []
+        for component in list(self.components.values()):
+            count = component.heartbeat.count
+            active = component.active
+            if active:
+                component.inactive_since = None
+            elif component.inactive_since is None:
+                component.inactive_since = now
+            # Inactive for too long is stuck, not idle
+            overdue = not active and component.max_inactive is not None and now - component.inactive_since >= component.max_inactive
+            if count != component.last_count or (not active and not overdue):
+                # Beating (or not expected to), reset the clock
+                component.last_count = count
+                component.last_change = now
+                if not component.healthy:
+                    self.logger.success("Component '%s' recovered.", component.name)
+                component.healthy = True
+                component.failures = 0
+                continue
+            if not overdue and now - component.last_change < component.timeout:
+                continue
+            if component.healthy:
+                component.healthy = False
+                if overdue:
+                    self.logger.error(f"Component '{component.name}' was inactive for {now - component.inactive_since:.1f} secs.")
+                else:
+                    self.logger.error(f"Component '{component.name}' stalled for {now - component.last_change:.1f} secs.")
+            if now >= component.next_restart_at:
+                delay = min(self.max_delay, self.base_delay * (2 ** component.failures))
+                component.failures += 1
+                component.next_restart_at = now + delay
+                due.append(component)
+        return due
+
+    async def __supervisor_job(self):
+        self.logger.success(f"Supervising {len(self.components)} component(s) | Watchdog= {self.watchdog_fd is not None}")
+        while True:
+            for component in self.check():
+                # Restarts block on hardware, keep them off the loop
+                self.scheduler.spawn(f"Restart:{component.name}", self.__restart, component)
+            if self.healthy:
+                self.__feed_watchdog()
+            await asyncio.sleep(self.interval)
+
+    async def __restart(self, component: SupervisedComponent):
+        self.logger.warning("Restarting component '%s' (attempt %d)...", component.name, component.failures)
+        component.restarts.inc()
+        try:
+            await self.scheduler.to_thread(component.restart)
+        except Exception as e:
+            self.logger.error(f"Can't restart component '{component.name}'. Reason: {e}")
+        # Give it a full timeout (& inactive bound) to beat again
+        component.last_change = monotonic()
+        component.inactive_since = None
+
+    def __open_watchdog(self):
+        if self.watchdog_path is None:
+            return
+        try:
+            self.watchdog_fd = os.open(self.watchdog_path, os.O_WRONLY)
+        except OSError as e:
+            self.logger.warning(f"Can't open hardware watchdog '{self.watchdog_path}'. Reason: {e}")
+
+    def __feed_watchdog(self):
+        if self.watchdog_fd is None:
+            return
+        try:
+            os.write(self.watchdog_fd, b'\0')
+        except OSError as e:
+            self.logger.error(f"Can't feed hardware watchdog. Reason: {e}")
+
+    def __close_watchdog(self):
+        if self.watchdog_fd is None:
+            return
+        try:
+            # Magic close disarms the watchdog on a clean stop
+            os.write(self.watchdog_fd, b'V')
+            os.close(self.watchdog_fd)
+        except OSError:
+            pass
+        self.watchdog_fd = None
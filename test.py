@@ -1,10 +1,21 @@
-
 if __name__ == '__main__':
     import constants
-    from aassl import AASSL
-    
+
+    # Modules pick the emulated hardware once they're imported, so switch first
     constants.set_test_mode(True)
 
+    from threading import Thread
+    from constants import IOPins
+    from pc_toolkit import gpio
+    from aassl import AASSL
+
+    def press_crash_button():
+        # Scenarios at accelerated time are run by simulation.py
+        while True:
+            input("Press Enter to simulate a crash...\n")
+            gpio.pulse(IOPins.PIN_CRASHING_BUTTON)
+
+    Thread(name="CrashButton", target=press_crash_button, daemon=True).start()
+
     aassl = AASSL()
-    aassl.setup_system()
-    aassl.start_system()
+    aassl.boot()
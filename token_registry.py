@@ -0,0 +1,170 @@
+import os
+import json
+from time import time as current_time, monotonic
+from threading import Event, Lock, Thread
+
+from logger import Logger
+from tracing import tracer
+
+
+class TokenRegistry:
+    """
+    Cache of client tokens that are notified on accidents.
+
+    Tokens are persisted to disk so a freshly booted unit without network still knows
+    its targets. A background worker refreshes them every `ttl` secs. The alert path never
+    waits on the network for more than `fetch_timeout` secs: with no cached tokens it waits
+    that long for a fetch, with a cache older than `hard_limit` secs it's used as is while
+    it's refreshed in background.
+    Ages are measured on the monotonic clock, the wall clock of a unit without RTC
+    jumps once NTP syncs. Only the age of a cache loaded from disk comes from its
+    persisted wall clock stamp.
+    """
+
+    def __init__(self, filepath: str, fetcher, ttl=600.0, hard_limit=86400.0, fetch_timeout=5.0) -> None:
+        """
+        Args:
+            filepath (str): Path of the file tokens are persisted to.\n
+            fetcher (callable): Returns a tuple of (tokens map, etag) fetched from remote.
+        """
+        self.filepath = filepath
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.hard_limit = hard_limit
+        self.fetch_timeout = fetch_timeout
+        self.logger = Logger("TokenRegistry")
+        # Runtime
+        self.lock = Lock()
+        self.save_lock = Lock()  # Writers share the temp file
+        self.refreshing = None  # Event set once the refresh in background is done
+        self.switcher = Event()
+        self.wakeup_signal = Event()
+        self.tokens = {}
+        self.etag = ""
+        self.refreshed_at = 0.0  # Wall clock secs (persisted)
+        self.refreshed_mono = None  # Monotonic secs of refreshed_at
+
+    @property
+    def age(self):
+        if self.refreshed_mono is None:
+            return float('inf')
+        return monotonic() - self.refreshed_mono
+
+    @property
+    def stale(self):
+        return self.age > self.ttl
+
+    def load(self):
+        """ Loads tokens persisted by a previous run (if found). """
+        if not os.path.exists(self.filepath):
+            return False
+        try:
+            with open(self.filepath, 'r') as file:
+                cached = json.load(file)
+            with self.lock:
+                self.tokens = dict(cached.get('tokens', {}))
+                self.etag = cached.get('etag', "")
+                self.refreshed_at = float(cached.get('refreshed_at', 0.0))
+                if self.refreshed_at > 0:
+                    age = current_time() - self.refreshed_at
+                    # Clock is behind the stamp (not synced yet), the age can't be told so refresh soon
+                    self.refreshed_mono = monotonic() - (age if age >= 0 else self.ttl)
+            self.logger.info(f"Loaded {len(self.tokens)} cached token(s). Age= {self.age:.0f} secs")
+            return True
+        except Exception as e:
+            self.logger.warning(f"Can't load cached tokens. Reason: {e}")
+            return False
+
+    def save(self):
+        with self.save_lock:
+            # Snapshot under the save lock so the last write is the latest state
+            with self.lock:
+                cached = {'tokens': dict(self.tokens), 'etag': self.etag, 'refreshed_at': self.refreshed_at}
+            # Write to a temp file first so a power cut never leaves a half written cache
+            tmp_path = f"{self.filepath}.tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump(cached, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.filepath)
+
+    def refresh(self):
+        try:
+            with tracer.span("token_refresh"):
+                tokens_map, new_etag = self.fetcher()
+            with self.lock:
+                changed = self.etag != new_etag or self.tokens != tokens_map
+                self.tokens = dict(tokens_map)
+                self.etag = new_etag
+                self.refreshed_at = current_time()
+                self.refreshed_mono = monotonic()
+            self.save()
+            if changed:
+                self.logger.info(f"Tokens refreshed successfully. Count= {len(self.tokens)}")
+            return True
+        except Exception as e:
+            self.logger.error(f"Can't refresh tokens. Reason: {e}")
+            return False
+
+    def get_tokens(self):
+        """ Returns the cached tokens to be used on the alert path.
+
+        Only waits on the network when there are no cached tokens, for `fetch_timeout` secs
+        at most (the fetch carries on in background). Tokens older than the hard limit are
+        returned as they are while they're refreshed in background.
+        """
+        if self.refreshed_mono is None:
+            self.logger.warning("No cached tokens. Fetching them...")
+            if not self.__refresh_in_background().wait(self.fetch_timeout):
+                self.logger.warning(f"Tokens weren't fetched within {self.fetch_timeout} secs.")
+        elif self.age > self.hard_limit:
+            self.logger.warning(f"Cached tokens are too old ({self.age:.0f} secs). Refreshing them in background...")
+            self.__refresh_in_background()
+        with self.lock:
+            return dict(self.tokens)
+
+    def __refresh_in_background(self):
+        """ Starts a refresh unless one is running already.
+
+        Returns:
+            Event: Set once the refresh is done.
+        """
+        with self.lock:
+            if self.refreshing is None:
+                self.refreshing = Event()
+                Thread(name="TokenRefresh", target=self.__refresh_once, args=(self.refreshing,), daemon=True).start()
+            return self.refreshing
+
+    def __refresh_once(self, done: Event):
+        try:
+            self.refresh()
+        finally:
+            with self.lock:
+                self.refreshing = None
+            done.set()
+
+    def remove(self, client_uid):
+        with self.lock:
+            removed = self.tokens.pop(client_uid, None) is not None
+        if removed:
+            self.save()
+        return removed
+
+    def start(self):
+        if not self.switcher.is_set():
+            self.switcher.set()
+            self.wakeup_signal.clear()
+            Thread(name="TokenRegistry", target=self.__refresh_job, daemon=True).start()
+
+    def stop(self):
+        if self.switcher.is_set():
+            self.switcher.clear()
+            self.wakeup_signal.set()
+
+    def __refresh_job(self):
+        while self.switcher.is_set():
+            if self.stale:
+                self.refresh()
+            # Retry sooner if the last refresh failed
+            delay = self.ttl - self.age if not self.stale else min(60.0, self.ttl)
+            self.wakeup_signal.wait(max(1.0, delay))
@@ -0,0 +1,149 @@
+import json
+import threading
+from contextlib import contextmanager
+from time import perf_counter_ns, time_ns
+
+
+class Span:
+    """ Context manager recording a span in the tracer on exit. """
+
+    __slots__ = ('tracer', 'name', 'accident', 'start')
+
+    def __init__(self, tracer: 'Tracer', name: str, accident=None) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.accident = accident
+        self.start = 0
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, perf_counter_ns(), self.accident)
+        return False
+
+
+class Tracer:
+    """
+    Lightweight tracer of the accident pipeline.
+
+    Spans are kept in a ring of preallocated slots on the monotonic clock so recording
+    one costs a few list stores. Spans can be tagged with the accident (its timestamp in
+    millis) they belong to, directly or by binding the accident to the recording thread.
+    Untagged ones are attributed to accidents by time, from a second before the accident
+    is opened until it's closed once its reporting is done. Both ends are taken on the
+    monotonic clock, the wall clock of a unit without RTC jumps once NTP or GPS syncs.
+    """
+
+    # Closed accidents kept around
+    MAX_CLOSED = 64
+
+    def __init__(self, capacity=4096) -> None:
+        self.capacity = capacity
+        self.names = [None] * capacity
+        self.starts = [0] * capacity
+        self.ends = [0] * capacity
+        self.threads = [0] * capacity
+        self.accidents = [None] * capacity
+        self.count = 0
+        self.lock = threading.Lock()
+        self.thread_names = {}
+        self.bound = threading.local()
+        self.opened = {}
+        self.closed = {}
+
+    def span(self, name: str, accident=None):
+        return Span(self, name, accident)
+
+    @contextmanager
+    def bind(self, accident):
+        """ Tags spans recorded by the current thread with the accident until exited. """
+        previous = self.bound_accident()
+        self.bound.accident = accident
+        try:
+            yield
+        finally:
+            self.bound.accident = previous
+
+    def bound_accident(self):
+        return getattr(self.bound, 'accident', None)
+
+    def open(self, accident: int):
+        """ Starts the window untagged spans are attributed to the accident in (call it on the crash). """
+        with self.lock:
+            self.opened.setdefault(accident, perf_counter_ns())
+            while len(self.opened) > self.MAX_CLOSED:
+                self.opened.pop(next(iter(self.opened)))
+
+    def close(self, accident: int):
+        """ Ends the window untagged spans are attributed to the accident in (the first close counts). """
+        with self.lock:
+            self.closed.setdefault(accident, perf_counter_ns())
+            while len(self.closed) > self.MAX_CLOSED:
+                self.closed.pop(next(iter(self.closed)))
+
+    def record(self, name: str, start: int, end: int, accident=None):
+        if accident is None:
+            accident = self.bound_accident()
+        tid = threading.get_ident()
+        with self.lock:
+            slot = self.count % self.capacity
+            self.count += 1
+        self.names[slot] = name
+        self.starts[slot] = start
+        self.ends[slot] = end
+        self.threads[slot] = tid
+        self.accidents[slot] = accident
+        if tid not in self.thread_names:
+            self.thread_names[tid] = threading.current_thread().name
+
+    @staticmethod
+    def wall_to_mono(timestamp_ms: int):
+        # Offset is taken now, the wall clock may have jumped since start
+        return timestamp_ms * 1_000_000 + perf_counter_ns() - time_ns()
+
+    def records(self, accident: int):
+        """ Returns (name, start, end, tid) of spans of the accident (its timestamp in millis). """
+        found = []
+        with self.lock:
+            count = self.count
+            window_start = self.opened.get(accident)
+            window_end = self.closed.get(accident)
+        # Accidents not opened in this run are placed by their wall clock timestamp
+        if window_start is None:
+            window_start = self.wall_to_mono(accident)
+        window_start -= 1_000_000_000  # Detection happens before timestamp
+        for idx in range(max(0, count - self.capacity), count):
+            slot = idx % self.capacity
+            tag = self.accidents[slot]
+            if tag == accident or (tag is None and self.ends[slot] >= window_start and (window_end is None or self.ends[slot] <= window_end)):
+                found.append((self.names[slot], self.starts[slot], self.ends[slot], self.threads[slot]))
+        return found
+
+    def chrome_trace(self, accident: int):
+        """ Returns spans of the accident as Chrome trace events (open in chrome://tracing or Perfetto). """
+        records = self.records(accident)
+        origin = min((record[1] for record in records), default=0)
+        events = [{
+            'name': name, 'ph': 'X', 'pid': 1, 'tid': tid,
+            'ts': (start - origin) / 1000, 'dur': (end - start) / 1000,
+        } for name, start, end, tid in records]
+        for tid in {record[3] for record in records}:
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': self.thread_names.get(tid, str(tid))}})
+        return {'traceEvents': events, 'otherData': {'accident': accident}}
+
+    def dump_chrome_trace(self, accident: int, filepath: str):
+        """ Writes spans of the accident as Chrome trace events to filepath.
+
+        Returns:
+            int: Count of written spans.
+        """
+        trace = self.chrome_trace(accident)
+        with open(filepath, 'w') as file:
+            json.dump(trace, file)
+        return sum(1 for event in trace['traceEvents'] if event['ph'] == 'X')
+
+
+# Shared by the whole pipeline
+tracer = Tracer()
@@ -0,0 +1,192 @@
+import os
+import shutil
+import subprocess
+
+import utils
+from logger import Logger
+from constants import TranscodeConstants
+
+# Container & audio-less mp4 overhead on top of the video bitrate
+CONTAINER_OVERHEAD = 1.05
+
+
+class EncodeProfile:
+
+    def __init__(self, name: str, codec: str, scale: float, bitrate: int) -> None:
+        """
+        Args:
+            scale (float): Factor applied to the camera resolution.\n
+            bitrate (int): Video bitrate in bits per sec.
+        """
+        self.name = name
+        self.codec = codec
+        self.scale = scale
+        self.bitrate = bitrate
+
+    def estimated_size(self, duration: float):
+        return int(self.bitrate / 8 * duration * CONTAINER_OVERHEAD)
+
+    def __repr__(self) -> str:
+        return f'EncodeProfile[{self.name}: codec= {self.codec}, scale= {self.scale}, bitrate= {self.bitrate // 1000} kbps]'
+
+
+# (name, scale, bitrate) ordered from best to smallest
+PROFILES_RUNGS = [
+    ('high', 1.0, 1_500_000),
+    ('medium', 1.0, 800_000),
+    ('low', 0.75, 400_000),
+    ('lower', 0.5, 200_000),
+    ('lowest', 0.5, 100_000),
+]
+
+# Rungs of every codec
+PROFILES_LADDER = {codec: [EncodeProfile(name, codec, scale, bitrate) for name, scale, bitrate in PROFILES_RUNGS] for codec in TranscodeConstants.CODECS}
+
+# Args the encoders of the codecs take on top of the common ones
+CODEC_ARGS = {
+    'h264_v4l2m2m': ['-pix_fmt', 'yuv420p'],
+    'libx264': ['-preset', 'veryfast', '-threads', '{threads}'],
+}
+
+
+def list_encoders():
+    """ Returns names of the video encoders ffmpeg was built with. """
+    output = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True, check=True, timeout=30).stdout
+    encoders = set()
+    for line in output.splitlines():
+        fields = line.split()
+        # Encoder lines look like ' V....D libx264    libx264 H.264 ...'
+        if len(fields) >= 2 and len(fields[0]) == 6 and fields[0].startswith('V'):
+            encoders.add(fields[1])
+    return encoders
+
+
+class EncodePlan:
+
+    def __init__(self, profile: EncodeProfile = None, start=0.0, duration=0.0) -> None:
+        self.profile = profile
+        self.start = start
+        self.duration = duration
+
+    @property
+    def keeps_original(self):
+        return self.profile is None
+
+    def __repr__(self) -> str:
+        if self.keeps_original:
+            return 'EncodePlan[original]'
+        return f'EncodePlan[{self.profile.name} ({self.profile.codec}), start= {self.start:.1f}s, duration= {self.duration:.1f}s]'
+
+
+class Transcoder:
+    """
+    Re-encodes accident videos so their upload takes about `target_upload_secs`
+    on the uplink throughput measured by the uploader.
+
+    Originals are kept untouched in captures for a later full quality sync, the
+    transcoded copy is written next to them as '<name>_tx.mp4'.
+    """
+
+    def __init__(self, estimator, target_upload_secs=TranscodeConstants.TARGET_UPLOAD_SECS) -> None:
+        self.estimator = estimator
+        self.target_upload_secs = target_upload_secs
+        # Encoder threads (0 lets ffmpeg pick), every thread takes more memory
+        self.threads = 0
+        self.logger = Logger("Transcoder")
+        self.available = shutil.which('ffmpeg') is not None and shutil.which('ffprobe') is not None
+        self.codecs = []
+        if not self.available:
+            self.logger.warning("ffmpeg isn't installed. Videos will be uploaded as captured.")
+            return
+        try:
+            encoders = list_encoders()
+            self.codecs = [codec for codec in TranscodeConstants.CODECS if codec in encoders]
+        except Exception as e:
+            self.logger.warning(f"Can't list ffmpeg encoders. Reason: {e}")
+            self.codecs = list(TranscodeConstants.CODECS)
+        if len(self.codecs) == 0:
+            self.available = False
+            self.logger.warning(f"ffmpeg has none of the {TranscodeConstants.CODECS} encoders. Videos will be uploaded as captured.")
+        else:
+            self.logger.info(f"Encoding videos with {self.codecs[0]} (fallbacks: {self.codecs[1:]})")
+
+    @staticmethod
+    def transcoded_filename(filename: str):
+        name, ext = os.path.splitext(filename)
+        return f"{name}_tx{ext}"
+
+    def plan(self, size: int, duration: float, codec=None) -> EncodePlan:
+        """ Picks the best profile of the codec (preferred one by default) that uploads within the target time.
+
+        The video is trimmed around its middle (where the crash is) if even the
+        smallest profile doesn't fit.
+        """
+        ladder = PROFILES_LADDER[codec or self.codecs[0]]
+        rate = self.estimator.estimate(TranscodeConstants.ASSUMED_UPLINK_RATE)
+        budget = rate * self.target_upload_secs
+        if size <= budget or duration <= 0:
+            return EncodePlan()
+        for profile in ladder:
+            if profile.estimated_size(duration) <= budget:
+                return EncodePlan(profile, 0.0, duration)
+        # Trim the clip keeping the crash in the middle
+        smallest = ladder[-1]
+        trimmed = max(TranscodeConstants.MIN_DURATION, budget / smallest.estimated_size(1.0))
+        trimmed = min(duration, trimmed)
+        return EncodePlan(smallest, (duration - trimmed) / 2, trimmed)
+
+    def prepare(self, filename: str):
+        """ Returns filename of the video to be uploaded (transcoded or original). """
+        if not self.available:
+            return filename
+        filepath = utils.get_capture_file_path(filename)
+        tx_filename = self.transcoded_filename(filename)
+        tx_filepath = utils.get_capture_file_path(tx_filename)
+        # Reuse the copy made in a previous attempt so its upload can be resumed
+        if os.path.exists(tx_filepath) and os.path.getsize(tx_filepath) > 0:
+            return tx_filename
+        try:
+            size, duration = os.path.getsize(filepath), self.probe_duration(filepath)
+            for codec in list(self.codecs):
+                plan = self.plan(size, duration, codec)
+                self.logger.info(f"Encoding plan of '{filename}': {plan}")
+                if plan.keeps_original:
+                    return filename
+                try:
+                    self.__transcode(filepath, tx_filepath, plan)
+                    break
+                except subprocess.CalledProcessError as e:
+                    if codec == self.codecs[-1]:
+                        raise
+                    # The encoder is listed but unusable (no hardware or driver), don't try it again
+                    self.codecs.remove(codec)
+                    self.logger.warning(f"Can't encode with {codec}, falling back to {self.codecs[0]}. Reason: {e}")
+            self.logger.success("Transcoded '{}' | Size= ({:.2f} KB -> {:.2f} KB)".format(
+                filename, os.path.getsize(filepath) / 1024.0, os.path.getsize(tx_filepath) / 1024.0))
+            return tx_filename
+        except Exception as e:
+            self.logger.error(f"Can't transcode '{filename}', uploading it as captured. Reason: {e}")
+            if os.path.exists(tx_filepath):
+                os.remove(tx_filepath)
+            return filename
+
+    def probe_duration(self, filepath: str):
+        output = subprocess.run(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', filepath],
+            capture_output=True, text=True, check=True, timeout=30
+        ).stdout
+        return float(output.strip() or 0)
+
+    def __transcode(self, filepath: str, tx_filepath: str, plan: EncodePlan):
+        profile = plan.profile
+        # Write to a temp file first so a partial encode is never uploaded
+        tmp_filepath = f"{tx_filepath}.part"
+        subprocess.run([
+            'ffmpeg', '-y', '-v', 'error',
+            '-ss', f"{plan.start:.2f}", '-t', f"{plan.duration:.2f}", '-i', filepath,
+            '-vf', f"scale=trunc(iw*{profile.scale}/2)*2:-2",
+            '-c:v', profile.codec, *[arg.format(threads=self.threads) for arg in CODEC_ARGS.get(profile.codec, [])],
+            '-b:v', str(profile.bitrate), '-maxrate', str(profile.bitrate), '-bufsize', str(profile.bitrate * 2),
+            '-an', '-movflags', '+faststart', '-f', 'mp4', tmp_filepath
+        ], check=True, timeout=TranscodeConstants.TIMEOUT, stdin=subprocess.DEVNULL)
+        os.replace(tmp_filepath, tx_filepath)
@@ -0,0 +1,271 @@
+import os
+import json
+from threading import Lock
+from time import sleep, monotonic
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+
+from logger import Logger
+
+# Resumable upload chunks must be multiple of this (except the last one)
+CHUNK_GRANULARITY = 256 * 1024
+# Size of pieces a chunk is streamed in when shaping bandwidth
+PIECE_SIZE = 16 * 1024
+
+
+class UploadError(Exception):
+
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class BandwidthShaper:
+    """ Token bucket that keeps the upload rate under a cap. """
+
+    def __init__(self, max_rate=None, burst=PIECE_SIZE * 4) -> None:
+        """
+        Args:
+            max_rate (int): Max bytes per sec, None means uncapped.\n
+            burst (int): Bytes that can be sent at once before being throttled.
+        """
+        self.max_rate = max_rate
+        self.burst = burst
+        self.allowance = burst
+        self.last_check = monotonic()
+        self.lock = Lock()
+
+    def throttle(self, nbytes: int):
+        if not self.max_rate:
+            return
+        with self.lock:
+            now = monotonic()
+            self.allowance = min(self.burst, self.allowance + (now - self.last_check) * self.max_rate)
+            self.last_check = now
+            self.allowance -= nbytes
+            deficit = -self.allowance
+        if deficit > 0:
+            sleep(deficit / self.max_rate)
+
+
+class ThroughputEstimator:
+    """ Running estimate of the uplink throughput out of recently sent chunks. """
+
+    def __init__(self, smoothing=0.3, max_age=900.0) -> None:
+        self.smoothing = smoothing
+        self.max_age = max_age
+        self.rate = 0.0  # Bytes per sec (EWMA)
+        self.updated_at = 0.0
+        self.lock = Lock()
+
+    def record(self, nbytes: int, elapsed: float):
+        if elapsed <= 0:
+            return
+        sample = nbytes / elapsed
+        with self.lock:
+            self.rate = sample if self.rate == 0 else (1 - self.smoothing) * self.rate + self.smoothing * sample
+            self.updated_at = monotonic()
+
+    def estimate(self, default: float):
+        """ Returns the measured rate, or default if nothing was measured recently. """
+        with self.lock:
+            if self.rate == 0 or monotonic() - self.updated_at > self.max_age:
+                return default
+            return self.rate
+
+
+class UploadSessionStore:
+    """ Persists resumable upload sessions so they survive process restarts. """
+
+    def __init__(self, filepath: str) -> None:
+        self.filepath = filepath
+        self.lock = Lock()
+
+    def __load(self):
+        if not os.path.exists(self.filepath):
+            return {}
+        try:
+            with open(self.filepath, 'r') as file:
+                return json.load(file)
+        except Exception:
+            return {}
+
+    def __dump(self, sessions: dict):
+        tmp_path = f"{self.filepath}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(sessions, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.filepath)
+
+    def get(self, filepath: str):
+        with self.lock:
+            return self.__load().get(filepath)
+
+    def put(self, filepath: str, session: dict):
+        with self.lock:
+            sessions = self.__load()
+            sessions[filepath] = session
+            self.__dump(sessions)
+
+    def remove(self, filepath: str):
+        with self.lock:
+            sessions = self.__load()
+            if sessions.pop(filepath, None) is not None:
+                self.__dump(sessions)
+
+
+class ResumableUploader:
+    """
+    Uploads files in chunks over a resumable upload session (GCS protocol).
+
+    The session url is persisted so an interrupted upload continues from the last
+    byte the server acknowledged, even after a restart. Chunk size follows the
+    measured throughput and the upload rate can be capped to leave headroom for alerts.
+    """
+
+    def __init__(self, sessions_filepath: str, max_rate=None, target_chunk_secs=2.0,
+                 min_chunk_size=CHUNK_GRANULARITY, max_chunk_size=32 * CHUNK_GRANULARITY,
+                 max_retries=5, max_restarts=2, timeout=30, progress_callback=None) -> None:
+        self.logger = Logger("Uploader")
+        self.sessions = UploadSessionStore(sessions_filepath)
+        self.shaper = BandwidthShaper(max_rate)
+        self.target_chunk_secs = target_chunk_secs
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.max_retries = max_retries
+        self.max_restarts = max_restarts
+        self.timeout = timeout
+        self.progress_callback = progress_callback
+        # Runtime
+        self.chunk_size = min_chunk_size
+        self.estimator = ThroughputEstimator()
+
+    @property
+    def throughput(self):
+        return self.estimator.rate
+
+    def upload(self, filepath: str, remote_path: str, create_session) -> bool:
+        """ Uploads the file at filepath, resuming a previous session if found.
+
+        Sessions that expire on the server are started over up to `max_restarts` times.
+
+        Args:
+            filepath (str): Path of the local file.\n
+            remote_path (str): Path of the file in remote storage.\n
+            create_session (callable): Takes the file size and returns a new session url.
+        """
+        for restart in range(self.max_restarts + 1):
+            uploaded = self.__upload_session(filepath, remote_path, create_session)
+            if uploaded is not None:
+                return uploaded
+            # Session expired on server, start over
+            self.sessions.remove(filepath)
+            if restart < self.max_restarts:
+                self.logger.warning(f"Upload session of '{remote_path}' expired. Starting over ({restart + 1}/{self.max_restarts})...")
+        self.logger.error(f"Giving up uploading '{remote_path}'. Its upload session expired {self.max_restarts + 1} times.")
+        return False
+
+    def __upload_session(self, filepath: str, remote_path: str, create_session):
+        """ Uploads the file in one session.
+
+        Returns:
+            bool: Whether the file was uploaded, None if the session expired on server.
+        """
+        total_size = os.path.getsize(filepath)
+        stamp = os.path.getmtime(filepath)
+        session = self.sessions.get(filepath)
+        # Drop sessions of files that changed since
+        if session is not None and (session['size'] != total_size or session['mtime'] != stamp or session['remote_path'] != remote_path):
+            session = None
+        if session is None:
+            session = {'url': create_session(total_size), 'remote_path': remote_path, 'size': total_size, 'mtime': stamp}
+            self.sessions.put(filepath, session)
+            offset = 0
+        else:
+            offset = self.__query_offset(session['url'], total_size)
+            if offset is None:
+                return None
+            self.logger.info(f"Resuming upload of '{remote_path}' from byte {offset}/{total_size}.")
+
+        retries = 0
+        with open(filepath, 'rb') as file:
+            while offset < total_size:
+                length = min(self.chunk_size, total_size - offset)
+                try:
+                    started_at = monotonic()
+                    offset = self.__put_chunk(session['url'], file, offset, length, total_size)
+                    self.__adapt_chunk_size(length, monotonic() - started_at)
+                    retries = 0
+                    self.__report_progress(remote_path, offset, total_size)
+                except (URLError, OSError, UploadError) as e:
+                    retries += 1
+                    if retries > self.max_retries:
+                        self.logger.error(f"Giving up uploading '{remote_path}' at byte {offset}/{total_size}. Reason: {e}")
+                        return False
+                    # Shrink chunks on flaky links then ask server where we are
+                    self.chunk_size = self.min_chunk_size
+                    sleep(min(30, 2 ** retries))
+                    try:
+                        acknowledged = self.__query_offset(session['url'], total_size)
+                    except (URLError, OSError, UploadError):
+                        continue
+                    if acknowledged is None:
+                        return None
+                    offset = acknowledged
+        self.sessions.remove(filepath)
+        return True
+
+    def __put_chunk(self, url: str, file, offset: int, length: int, total_size: int):
+        file.seek(offset)
+        chunk = file.read(length)
+        end = offset + len(chunk) - 1
+        request = Request(url, data=self.__shaped(chunk), method='PUT', headers={
+            'Content-Length': str(len(chunk)),
+            'Content-Range': f"bytes {offset}-{end}/{total_size}",
+        })
+        acknowledged = self.__send(request)
+        if acknowledged is None:
+            raise UploadError("Upload session expired.")
+        return acknowledged if acknowledged < total_size else total_size
+
+    def __query_offset(self, url: str, total_size: int):
+        request = Request(url, data=b'', method='PUT', headers={
+            'Content-Length': '0',
+            'Content-Range': f"bytes */{total_size}",
+        })
+        acknowledged = self.__send(request)
+        return None if acknowledged is None else min(acknowledged, total_size)
+
+    def __send(self, request: Request):
+        """ Returns count of bytes acknowledged by server or None if session is gone. """
+        try:
+            with urlopen(request, timeout=self.timeout):
+                # Upload is complete
+                return 1 << 62
+        except HTTPError as e:
+            if e.code == 308:
+                received = e.headers.get('Range')
+                return 0 if received is None else int(received.split('-')[1]) + 1
+            if e.code in (404, 410):
+                return None
+            raise UploadError(f"Server responded with {e.code}.")
+
+    def __shaped(self, chunk: bytes):
+        view = memoryview(chunk)
+        for idx in range(0, len(view), PIECE_SIZE):
+            piece = view[idx:idx + PIECE_SIZE]
+            self.shaper.throttle(len(piece))
+            yield piece
+
+    def __adapt_chunk_size(self, length: int, elapsed: float):
+        if elapsed <= 0:
+            return
+        self.estimator.record(length, elapsed)
+        # Aim for chunks that take target_chunk_secs at current throughput
+        target = int(self.throughput * self.target_chunk_secs) // CHUNK_GRANULARITY * CHUNK_GRANULARITY
+        self.chunk_size = max(self.min_chunk_size, min(self.max_chunk_size, target))
+
+    def __report_progress(self, remote_path: str, sent: int, total_size: int):
+        self.logger.info("Uploading '%s': %.0f%% (%d/%d bytes) at %.0f KB/s", remote_path, sent * 100 / max(1, total_size), sent, total_size, self.throughput / 1024)
+        if self.progress_callback is not None:
+            self.progress_callback(remote_path, sent, total_size)
@@ -1,9 +1,16 @@
+import math
 import random
 from time import sleep
-from os import path, mkdir
+from os import path, mkdir, sysconf
 
 CAPTURES_DIR_NAME = 'captures/'
 CONFIG_FILENAME = 'config.csv'
+OUTBOX_FILENAME = 'outbox.db'
+TOKENS_FILENAME = 'tokens.json'
+UPLOADS_FILENAME = 'uploads.json'
+METRICS_FILENAME = 'metrics.json'
+GEOINDEX_FILENAME = 'geoindex.bin'
+PAGE_SIZE = sysconf('SC_PAGE_SIZE')
 
 
 def captures_dir_path():
@@ -18,6 +25,30 @@ def config_file_path():
     return path.join('./data/', CONFIG_FILENAME)
 
 
+def outbox_file_path():
+    return path.join('./data/', OUTBOX_FILENAME)
+
+
+def tokens_file_path():
+    return path.join('./data/', TOKENS_FILENAME)
+
+
+def uploads_file_path():
+    return path.join('./data/', UPLOADS_FILENAME)
+
+
+def metrics_file_path():
+    return path.join('./data/', METRICS_FILENAME)
+
+
+def geoindex_file_path():
+    return path.join('./data/', GEOINDEX_FILENAME)
+
+
+def blackbox_dir_path():
+    return path.join(data_dir_path(), 'blackbox')
+
+
 def captures_dir_exists():
     return path.exists(captures_dir_path())
 
@@ -43,10 +74,65 @@ def get_capture_file_path(filename: str):
     return path.join(captures_dir_path(), filename)
 
 
+def get_trace_file_path(timestamp: int):
+    return path.join(captures_dir_path(), f"{timestamp}.trace.json")
+
+
+def get_blackbox_file_path(timestamp: int):
+    return path.join(captures_dir_path(), f"{timestamp}.bbx")
+
+
+def get_keyframe_file_path(timestamp: int, rank: int):
+    return path.join(captures_dir_path(), f"{timestamp}_kf{rank}.jpg")
+
+
+def get_keyframe_file_paths(timestamp: int):
+    """ Returns paths of the keyframes saved of the accident (best first). """
+    filepaths = []
+    while path.exists(get_keyframe_file_path(timestamp, len(filepaths))):
+        filepaths.append(get_keyframe_file_path(timestamp, len(filepaths)))
+    return filepaths
+
+
+def get_video_filename(timestamp: int):
+    return f"{timestamp}.mp4"
+
+
+def get_package_filename(video_filename: str):
+    return f"{path.splitext(video_filename)[0]}.aapk"
+
+
 def capture_file_exists(filename: str) -> bool:
     return path.exists(get_capture_file_path(filename))
 
 
+def system_uptime():
+    """ Returns secs since the system was powered on (None if unknown). """
+    try:
+        with open('/proc/uptime', 'r') as file:
+            return float(file.read().split()[0])
+    except Exception:
+        return None
+
+
+def process_rss():
+    """ Returns the resident memory of this process in bytes (0 if unknown). """
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * PAGE_SIZE
+    except Exception:
+        return 0
+
+
+def percentile(values, q: float):
+    """ Returns the q-th percentile (0-100) of the values by nearest rank (None if empty). """
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
 def isempty(s: str):
     if s is None or len(s) == 0:
         return True